@@ -0,0 +1,111 @@
+"""
+CPU inference benchmark.
+
+Judges the same qrel sample with the current bf16 path and the CPU paths
+(`--device cpu`, optionally `--quant int8` and `--compile`) and reports
+load time, pairs/sec, peak RSS and how many scores agree with bf16. Each
+configuration runs in its own process so peak RSS is not shared.
+
+Usage:
+    python benchmarks/bench_cpu_inference.py --model google/flan-t5-large \\
+        --test_qrel_path ./data/dl2019/2019qrels-pass.txt \\
+        --queries_path ./data/dl2019/msmarco-test2019-queries.tsv \\
+        --docs_path ./data/dl2019/dl2019_document.jsonl --pairs 64
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+# name -> get_model_baseline options
+CONFIGS = {
+    "bf16": {"device": "auto"},
+    "cpu-bf16": {"device": "cpu"},
+    "cpu-int8": {"device": "cpu", "quant": "int8"},
+    "cpu-int8-compile": {"device": "cpu", "quant": "int8", "compile_model": True},
+}
+
+
+def run_config(args, name: str) -> dict:
+    """Load the model with one configuration and judge the sample (runs in a child process)."""
+    from data_processing import load_data_files
+    from model_utils import get_model_baseline
+    from prompts import get_umbrella_prompt
+    from relevance_processors import lookup_pair
+    from relevance_scoring import judge_prompts
+
+    docid_to_doc, qid_to_query, test_qrel = load_data_files(args.docs_path, args.queries_path, args.test_qrel_path)
+    prompts = []
+    for eachline in test_qrel.head(args.pairs).itertuples(index=True):
+        _, _, query, passage = lookup_pair(eachline, docid_to_doc, qid_to_query)
+        prompts.append(get_umbrella_prompt(query, passage, args.prompt_mode))
+
+    start = time.perf_counter()
+    pipeline = get_model_baseline(args.model, num_threads=args.num_threads, **CONFIGS[name])
+    load_time = time.perf_counter() - start
+
+    scores = []
+    start = time.perf_counter()
+    for i in range(0, len(prompts), args.batch_size):
+        judgments = judge_prompts(prompts[i:i + args.batch_size], pipeline, "", args.scoring)
+        scores.extend(judgment["final_relevance_score"] for judgment in judgments)
+    elapsed = time.perf_counter() - start
+    return {
+        "config": name,
+        "load_s": load_time,
+        "pairs_per_s": len(prompts) / elapsed,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "scores": scores,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare bf16 and CPU int8 inference on a qrel sample.")
+    parser.add_argument("--model", type=str, required=True)
+    parser.add_argument("--test_qrel_path", type=str, required=True)
+    parser.add_argument("--queries_path", type=str, required=True)
+    parser.add_argument("--docs_path", type=str, required=True)
+    parser.add_argument("--prompt_mode", type=str, default="zeroshot_bing")
+    parser.add_argument("--scoring", type=str, default="generate", choices=["generate", "logits"])
+    parser.add_argument("--pairs", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--configs", type=str, default=",".join(CONFIGS),
+                        help=f"Comma-separated subset of {list(CONFIGS)}")
+    parser.add_argument("--run_config", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_config is not None:
+        print(json.dumps(run_config(args, args.run_config)))
+        return
+
+    results = []
+    for name in args.configs.split(","):
+        command = [sys.executable, __file__, *sys.argv[1:], "--run_config", name]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(f"{name}: failed\n{completed.stderr[-2000:]}")
+            continue
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    if not results:
+        return
+    reference = results[0]
+    print(f"{'config':<18}{'load (s)':>10}{'pairs/s':>10}{'speedup':>10}{'peak RSS (MB)':>15}"
+          f"{'agree w/ ' + reference['config']:>18}")
+    for result in results:
+        agree = sum(a == b for a, b in zip(result["scores"], reference["scores"]))
+        print(f"{result['config']:<18}{result['load_s']:>10.1f}{result['pairs_per_s']:>10.2f}"
+              f"{result['pairs_per_s'] / reference['pairs_per_s']:>9.2f}x{result['peak_rss_mb']:>15.0f}"
+              f"{agree:>12}/{len(reference['scores'])}")
+
+
+if __name__ == "__main__":
+    main()
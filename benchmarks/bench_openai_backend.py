@@ -0,0 +1,129 @@
+"""
+Checks and throughput of the OpenAI-compatible backend against an
+in-process stub server (see stub_pipelines.StubOpenAIServer).
+
+Checks that
+    - free generation and logprobs scoring through `judge_prompts` return
+      the stub's grades (and, with logprobs, its grade distribution),
+    - a run reuses the pooled keep-alive connections instead of opening one
+      per request, and never has more requests in flight than the pool size,
+    - 429 answers are retried and a request slower than the timeout fails,
+then times batch 1 (one blocking request per pair) against parallel
+batches at a simulated server latency. With `--check`, exits with status
+1 when a check fails.
+
+Usage:
+    python benchmarks/bench_openai_backend.py [--pairs 64] [--latency_ms 20] [--pool 8] [--check]
+"""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from model_utils import OpenAICompatiblePipeline
+from prompts import get_umbrella_prompt
+from relevance_scoring import judge_prompts
+from stub_pipelines import StubOpenAIServer, stub_output
+
+WORDS = ["river", "capital", "city", "france", "passage", "answer", "query", "relevant", "history", "bridge"]
+
+
+def make_prompts(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [get_umbrella_prompt(query=" ".join(rng.choices(WORDS, k=5)),
+                                passage=" ".join(rng.choices(WORDS, k=rng.randint(20, 80))),
+                                mode="zeroshot_bing")
+            for _ in range(count)]
+
+
+def expected_grade(prompt: str) -> int:
+    return int(stub_output(prompt)[-1])
+
+
+def judge_in_batches(prompts, pipeline, batch_size: int, scoring: str = "generate"):
+    judgments = []
+    for start in range(0, len(prompts), batch_size):
+        judgments.extend(judge_prompts(prompts[start:start + batch_size], pipeline, "", scoring))
+    return judgments
+
+
+def run_checks(args):
+    """Run the functional checks; returns a list of failure messages."""
+    failures = []
+    prompts = make_prompts(args.pairs)
+    expected = [expected_grade(prompt) for prompt in prompts]
+
+    with StubOpenAIServer() as server:
+        pipeline = OpenAICompatiblePipeline("stub", server.base_url, max_in_flight=args.pool)
+        judgments = judge_in_batches(prompts, pipeline, args.pool)
+        if [j["final_relevance_score"] for j in judgments] != expected:
+            failures.append("generate: scores differ from the stub's grades")
+        judgments = judge_in_batches(prompts, pipeline, args.pool, scoring="logits")
+        if [j["final_relevance_score"] for j in judgments] != expected:
+            failures.append("logits: argmax of the logprobs distribution differs from the stub's grades")
+        if any(abs(j["score_distribution"][grade] - 0.7) > 1e-6 for j, grade in zip(judgments, expected)):
+            failures.append("logits: distribution does not match the stub's logprobs")
+        if server.connections > args.pool:
+            failures.append(f"pooling: {server.connections} connections for {server.requests} requests "
+                            f"(pool of {args.pool})")
+        if server.max_active > args.pool:
+            failures.append(f"backpressure: {server.max_active} requests in flight (pool of {args.pool})")
+        print(f"generate + logits: {server.requests} requests over {server.connections} connections, "
+              f"at most {server.max_active} in flight")
+
+    with StubOpenAIServer(fail_first=3, retry_after="0") as server:
+        pipeline = OpenAICompatiblePipeline("stub", server.base_url, max_in_flight=1, max_retries=5)
+        judgment = judge_prompts(prompts[:1], pipeline, "")[0]
+        if judgment["final_relevance_score"] != expected[0] or pipeline.retry_count != 3:
+            failures.append(f"retries: {pipeline.retry_count} retries for 3 rate-limited answers")
+        print(f"retries: {pipeline.retry_count} after 3 answers with HTTP 429")
+
+    with StubOpenAIServer(latency_ms=500) as server:
+        pipeline = OpenAICompatiblePipeline("stub", server.base_url, timeout=0.1, max_retries=0)
+        start = time.perf_counter()
+        try:
+            judge_prompts(prompts[:1], pipeline, "")
+            failures.append("timeout: a request slower than the timeout succeeded")
+        except Exception as e:
+            print(f"timeout: {type(e).__name__} after {time.perf_counter() - start:.2f}s")
+    return failures
+
+
+def run_throughput(args):
+    prompts = make_prompts(args.pairs)
+    print(f"\n{'batch size':>10}{'pairs/s':>10}{'connections':>13}")
+    for batch_size in (1, args.pool):
+        with StubOpenAIServer(latency_ms=args.latency_ms) as server:
+            pipeline = OpenAICompatiblePipeline("stub", server.base_url, max_in_flight=args.pool)
+            start = time.perf_counter()
+            judge_in_batches(prompts, pipeline, batch_size)
+            elapsed = time.perf_counter() - start
+        print(f"{batch_size:>10}{len(prompts) / elapsed:>10.1f}{server.connections:>13}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and time the OpenAI-compatible backend against a stub server.")
+    parser.add_argument("--pairs", type=int, default=64)
+    parser.add_argument("--latency_ms", type=float, default=20.0,
+                        help="Simulated server latency per request for the throughput runs")
+    parser.add_argument("--pool", type=int, default=8,
+                        help="Pooled connections (and the parallel batch size)")
+    parser.add_argument("--check", action="store_true",
+                        help="Exit with status 1 when a check fails")
+    args = parser.parse_args()
+
+    failures = run_checks(args)
+    run_throughput(args)
+    if failures:
+        print("\n".join(["", "Checks failed:"] + failures))
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Microbenchmark of per-pair prompt construction.
+
+Compares the original path (read the template file and str.format on every
+pair, then apply the chat template and tokenize the whole prompt) with the
+preloaded PromptTemplateRegistry (cached templates, pre-rendered chat
+scaffolding and cached token ids of the static segments).
+
+Usage:
+    python benchmarks/bench_prompt_construction.py [--tokenizer PATH_OR_ID] [--pairs N]
+"""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from prompts import FILE_MAPPING, PROMPTS_DIR, VALID_MODES, PromptTemplateRegistry
+
+WORDS = "the of capital river passage answer query relevant city some extra information".split()
+
+
+def legacy_get_umbrella_prompt(query: str, passage: str, mode: str) -> str:
+    """The per-call implementation that the registry replaced."""
+    template_path = PROMPTS_DIR / FILE_MAPPING[mode]
+    if not template_path.exists():
+        raise FileNotFoundError(f"Prompt template file not found: {template_path}")
+    with open(template_path, "r") as f:
+        prompt_template = f.read()
+    return prompt_template.format(query=query, passage=passage)
+
+
+def make_pairs(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [(" ".join(rng.choices(WORDS, k=rng.randint(3, 10))),
+             " ".join(rng.choices(WORDS, k=rng.randint(20, 200))))
+            for _ in range(count)]
+
+
+def time_per_pair(fn, pairs) -> float:
+    start = time.perf_counter()
+    for query, passage in pairs:
+        fn(query, passage)
+    return (time.perf_counter() - start) / len(pairs) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-pair prompt construction.")
+    parser.add_argument("--tokenizer", type=str, default=None,
+                        help="Tokenizer to include chat templating and tokenization in the comparison")
+    parser.add_argument("--pairs", type=int, default=2000)
+    parser.add_argument("--system_message", type=str, default="")
+    args = parser.parse_args()
+
+    pairs = make_pairs(args.pairs)
+    registry = PromptTemplateRegistry()
+    tokenizer = None
+    if args.tokenizer is not None:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+    print(f"{'mode':<16}{'stage':<22}{'before (us/pair)':>18}{'after (us/pair)':>18}{'speedup':>10}")
+    for mode in VALID_MODES:
+        if mode in registry.invalid_modes:
+            print(f"{mode:<16}skipped: {registry.invalid_modes[mode]}")
+            continue
+        before = time_per_pair(lambda q, p: legacy_get_umbrella_prompt(q, p, mode), pairs)
+        after = time_per_pair(lambda q, p: registry.render(q, p, mode), pairs)
+        print(f"{mode:<16}{'render':<22}{before:>18.2f}{after:>18.2f}{before / after:>9.1f}x")
+
+        if tokenizer is None:
+            continue
+        messages = lambda prompt: [{"role": "system", "content": args.system_message},
+                                   {"role": "user", "content": prompt}]
+
+        def before_tokenized(query, passage):
+            prompt = legacy_get_umbrella_prompt(query, passage, mode)
+            text = tokenizer.apply_chat_template(messages(prompt), tokenize=False, add_generation_prompt=True)
+            return tokenizer(text)["input_ids"]
+
+        def after_tokenized(query, passage):
+            return registry.encode_pair(query, passage, mode, tokenizer, args.system_message)
+
+        before = time_per_pair(before_tokenized, pairs)
+        after = time_per_pair(after_tokenized, pairs)
+        print(f"{mode:<16}{'render+chat+tokenize':<22}{before:>18.2f}{after:>18.2f}{before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
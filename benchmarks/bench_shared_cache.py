@@ -0,0 +1,167 @@
+"""
+Check of shard processes sharing one judgment cache, the way
+`launch_shards.py` runs them (every shard uses the same `--cache_dir`).
+
+Generates a synthetic dataset and runs two shard processes of
+`grade_pq_pairs` with the stub local backend against one cache directory,
+twice: a first round judges every other pair of each shard and fills the
+cache, and a re-run judges every pair, so each shard alternates cache hits
+with model calls while the other shard writes. The shards use a busy
+timeout shorter than the stub's latency, so a write lock held from a cache
+hit across a model call makes the other shard's cache calls fail. Checks
+that
+    - no pair lands in cuda_errors/ or generation_errors/,
+    - every score is the stub's grade for the pair's prompt,
+    - the re-run is served from the cache for the pairs judged before,
+    - no cache lookup or write failed on the database lock.
+With `--check`, exits with status 1 when a check fails.
+
+Usage:
+    python benchmarks/bench_shared_cache.py [--queries 10] [--docs_per_query 10] [--latency_ms 50] [--check]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+NUM_SHARDS = 2
+PROMPT_MODE = "zeroshot_bing"
+
+
+def run_shard(args):
+    """Judge one shard against the shared cache and print a JSON summary."""
+    from data_processing import load_data_files
+    from judgment_cache import JudgmentCache
+    from relevance_processors import grade_pq_pairs
+    from sharding import select_shard
+    from stub_pipelines import StubHFPipeline
+
+    data_dir = Path(args.work_dir) / "data"
+    docid_to_doc, qid_to_query, test_qrel = load_data_files(
+        str(data_dir / "docs.jsonl"), str(data_dir / "queries.tsv"), str(data_dir / "qrels.txt"))
+    shard_qrel = select_shard(test_qrel, NUM_SHARDS, args.shard_id)
+    if args.every_other:
+        shard_qrel = shard_qrel.iloc[::2]
+    result_path = Path(args.work_dir) / args.round / f"shard{args.shard_id}.txt"
+    JudgmentCache.BUSY_TIMEOUT_MS = args.busy_timeout_ms
+    cache = JudgmentCache(str(Path(args.work_dir) / "cache"), "stub/hf")
+    with contextlib.redirect_stdout(io.StringIO()):
+        grade_pq_pairs(shard_qrel, docid_to_doc, qid_to_query, str(result_path),
+                       StubHFPipeline(latency_ms=args.latency_ms), "", PROMPT_MODE, cache=cache)
+    cache.close()
+    print(json.dumps({"hits": cache.hits, "misses": cache.misses, "errors": cache.errors}))
+
+
+def expected_scores(work_dir: Path):
+    """(qid, docid) -> the stub's grade, as a stub-backed run without a cache scores it."""
+    from data_processing import load_data_files
+    from prompts import get_umbrella_prompt
+    from relevance_scoring import apply_chat_template, build_messages
+    from stub_pipelines import StubTokenizer, stub_output
+    data_dir = work_dir / "data"
+    docid_to_doc, qid_to_query, test_qrel = load_data_files(
+        str(data_dir / "docs.jsonl"), str(data_dir / "queries.tsv"), str(data_dir / "qrels.txt"))
+    tokenizer = StubTokenizer()
+    expected = {}
+    for row in test_qrel.itertuples():
+        prompt = get_umbrella_prompt(qid_to_query[row.qid], docid_to_doc[str(row.docid)], PROMPT_MODE)
+        rendered = apply_chat_template(prompt, build_messages(prompt, ""), tokenizer)
+        expected[(str(row.qid), str(row.docid))] = int(stub_output(rendered)[-1])
+    return expected
+
+
+def run_round(args, work_dir: Path, round_name: str, every_other: bool = False):
+    """Start every shard process at once and collect their summaries."""
+    command = [sys.executable, __file__, "--shard", "--work_dir", str(work_dir), "--round", round_name,
+               "--latency_ms", str(args.latency_ms), "--busy_timeout_ms", str(args.busy_timeout_ms)]
+    if every_other:
+        command.append("--every_other")
+    processes = [subprocess.Popen(command + ["--shard_id", str(shard_id)],
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                 for shard_id in range(NUM_SHARDS)]
+    summaries = []
+    for process in processes:
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"Shard process failed:\n{stderr[-2000:]}")
+        summaries.append(json.loads(stdout.strip().splitlines()[-1]))
+    return summaries
+
+
+def check_round(work_dir: Path, round_name: str, expected, summaries):
+    """Return failure messages for one round's outputs and cache counters."""
+    failures = []
+    round_dir = work_dir / round_name
+    for error_dir in ("cuda_errors", "generation_errors"):
+        for path in (round_dir / error_dir).glob("*.txt"):
+            if path.read_text().strip():
+                failures.append(f"{round_name}: pairs recorded in {error_dir}/{path.name}")
+    for shard_id in range(NUM_SHARDS):
+        for line in (round_dir / f"shard{shard_id}.txt").read_text().splitlines():
+            qid, _, docid, score, *_ = line.split()
+            if expected[(qid, docid)] != int(score):
+                failures.append(f"{round_name}: pair ({qid}, {docid}) scored {score}, "
+                                f"expected {expected[(qid, docid)]}")
+                break
+    errors = sum(summary["errors"] for summary in summaries)
+    if errors:
+        failures.append(f"{round_name}: {errors} cache lookups or writes failed on the database")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check shard processes sharing one judgment cache.")
+    parser.add_argument("--queries", type=int, default=10)
+    parser.add_argument("--docs_per_query", type=int, default=10)
+    parser.add_argument("--latency_ms", type=float, default=50.0,
+                        help="Simulated model latency per pair")
+    parser.add_argument("--busy_timeout_ms", type=int, default=10,
+                        help="SQLite busy timeout of the shards' caches (keep below --latency_ms)")
+    parser.add_argument("--check", action="store_true",
+                        help="Exit with status 1 when a check fails")
+    # Options of the shard processes this script starts
+    parser.add_argument("--shard", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--shard_id", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--work_dir", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--round", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--every_other", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.shard:
+        return run_shard(args)
+
+    from synthetic_data import generate_dataset
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(tmp)
+        generate_dataset(str(work_dir / "data"), num_queries=args.queries, docs_per_query=args.docs_per_query)
+        expected = expected_scores(work_dir)
+
+        failures = []
+        first = run_round(args, work_dir, "first", every_other=True)
+        failures += check_round(work_dir, "first", expected, first)
+        rerun = run_round(args, work_dir, "rerun")
+        failures += check_round(work_dir, "rerun", expected, rerun)
+        hits = sum(summary["hits"] for summary in rerun)
+        judged_before = sum(summary["misses"] for summary in first)
+        if hits < judged_before:
+            failures.append(f"rerun: {hits} cache hits for {judged_before} pairs judged in the first round")
+        for name, summaries in (("first", first), ("rerun", rerun)):
+            print(f"{name}: " + ", ".join(f"shard {i}: {s['hits']} hits, {s['misses']} misses, "
+                                          f"{s['errors']} database errors"
+                                          for i, s in enumerate(summaries)))
+
+    if failures:
+        print("\n".join(["", "Checks failed:"] + failures))
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
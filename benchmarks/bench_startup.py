@@ -0,0 +1,116 @@
+"""
+Startup benchmark of the command-line entry points.
+
+Imports each entry point module in a fresh interpreter under
+`python -X importtime`, reports the cumulative import time and lists the
+heavy libraries (torch, transformers, together) that were pulled in. None
+of the entry points should import them at module load: they are only
+needed once a local model or the Together client is actually created.
+With `--check`, exits with status 1 when an entry point imports a heavy
+library or takes longer than `--budget_ms`, so it can gate CI.
+
+Usage:
+    python benchmarks/bench_startup.py [--repeats 5] [--check] [--budget_ms 1500]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+
+# Entry point -> module imported by its command
+ENTRY_POINTS = {
+    "main.py (API run)": "main",
+    "run_jobs.py": "run_jobs",
+    "make_rubric_format.py": "make_rubric_format",
+    "convert_rubrics.py": "convert_rubrics",
+    "compact_log.py": "compact_log",
+    "sharding.py (merge)": "sharding",
+    "judge_server.py": "judge_server",
+}
+
+HEAVY_MODULES = ("torch", "transformers", "together", "bitsandbytes")
+
+
+def run_importtime(command: List[str], env: Optional[Dict[str, str]] = None) -> str:
+    """
+    Run `python -X importtime <command>` from src/ in a fresh interpreter.
+
+    Returns:
+        The interpreter's stderr, which holds the import time report
+    """
+    env = dict(os.environ, PYTHONPATH=str(SRC_DIR), **(env or {}))
+    completed = subprocess.run([sys.executable, "-X", "importtime", *command],
+                               cwd=SRC_DIR, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed:\n{completed.stderr[-2000:]}")
+    return completed.stderr
+
+
+def parse_importtime(stderr: str, module: Optional[str] = None) -> Tuple[float, List[str]]:
+    """
+    Read an -X importtime report.
+
+    Returns:
+        Tuple of (cumulative import time of `module` in ms, heavy top-level
+        packages imported)
+    """
+    total_us = 0
+    imported = set()
+    for line in stderr.splitlines():
+        # "import time:      self [us] |  cumulative | imported package"
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[0].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        imported.add(name.split(".")[0])
+        if name == module:
+            total_us = int(fields[1])
+    return total_us / 1000, sorted(imported.intersection(HEAVY_MODULES))
+
+
+def measure_import(module: str) -> Tuple[float, List[str]]:
+    """
+    Import `module` in a fresh interpreter with -X importtime.
+
+    Returns:
+        Tuple of (cumulative import time in ms, heavy top-level packages imported)
+    """
+    return parse_importtime(run_importtime(["-c", f"import {module}"]), module)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import-time startup cost of the entry points.")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="Fresh interpreters per entry point; the fastest one is reported")
+    parser.add_argument("--check", action="store_true",
+                        help="Exit with status 1 on a heavy import or an entry point over --budget_ms")
+    parser.add_argument("--budget_ms", type=float, default=1500.0,
+                        help="Import-time budget per entry point for --check")
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'entry point':<26}{'import (ms)':>12}  heavy imports")
+    for entry_point, module in ENTRY_POINTS.items():
+        runs = [measure_import(module) for _ in range(args.repeats)]
+        import_ms = min(ms for ms, _ in runs)
+        heavy = runs[0][1]
+        print(f"{entry_point:<26}{import_ms:>12.0f}  {', '.join(heavy) or '-'}")
+        if heavy:
+            failures.append(f"{entry_point} imports {', '.join(heavy)} at startup")
+        if import_ms > args.budget_ms:
+            failures.append(f"{entry_point} takes {import_ms:.0f} ms to import (budget {args.budget_ms:.0f} ms)")
+
+    if args.check and failures:
+        print("\n".join(["", "Startup check failed:"] + failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
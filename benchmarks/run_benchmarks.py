@@ -0,0 +1,275 @@
+"""
+Offline benchmark suite.
+
+Generates a synthetic DL-style dataset (see synthetic_data.py) and times
+the hot paths of a judging run against it, with stub backends (see
+stub_pipelines.py) in place of real models:
+
+    load_data_files         lazy document store and eager dict loading
+    get_umbrella_prompt     prompt rendering per pair
+    find_first_number       score parsing per model output
+    grade_pq_pairs          end to end, Together and local code paths
+    process_log_to_rubric   log to rubric conversion
+
+Each case runs in a fresh interpreter so its peak RSS is its own. Results
+(items/s, p50/p99 latency per item or round, peak RSS) are written as JSON;
+`--baseline` compares a run against an earlier one and, with `--check`,
+exits with status 1 when a case got slower than `--max_regression`.
+
+The same cases run under pytest in tests/test_benchmarks.py, on a small
+dataset and with a throughput floor per case.
+
+Usage:
+    python benchmarks/run_benchmarks.py --output benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --baseline benchmarks/baseline.json --check
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from synthetic_data import generate_dataset
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def timed_calls(fn, inputs) -> List[float]:
+    """Call `fn` on every input and return the latency of each call."""
+    latencies = []
+    for item in inputs:
+        start = time.perf_counter()
+        fn(*item)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def load_pairs(paths: Dict[str, str]) -> List[Tuple[str, str, str, str]]:
+    from data_processing import load_data_files
+    from relevance_processors import lookup_pair
+    docid_to_doc, qid_to_query, test_qrel = load_data_files(
+        paths["docs_path"], paths["queries_path"], paths["test_qrel_path"])
+    return [lookup_pair(row, docid_to_doc, qid_to_query) for row in test_qrel.itertuples(index=True)]
+
+
+def case_load_data_files(paths, args, lazy_docs: bool):
+    from data_processing import load_data_files
+    latencies = []
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        docid_to_doc, _, test_qrel = load_data_files(
+            paths["docs_path"], paths["queries_path"], paths["test_qrel_path"], lazy_docs=lazy_docs)
+        latencies.append(time.perf_counter() - start)
+    # Throughput in qrel rows per second, latency per full load
+    return len(test_qrel) * args.rounds, sum(latencies), latencies, "round"
+
+
+def case_get_umbrella_prompt(paths, args):
+    from prompts import get_umbrella_prompt
+    pairs = [(query, passage, args.prompt_mode) for _, _, query, passage in load_pairs(paths)]
+    latencies = timed_calls(get_umbrella_prompt, pairs * args.rounds)
+    return len(latencies), sum(latencies), latencies, "pair"
+
+
+def case_find_first_number(paths, args):
+    from relevance_scoring import find_first_number
+    rng = random.Random(0)
+    filler = "The passage mentions the query topic and gives some context. "
+    formats = ["{f}##final score: {s}", "{f}\nO: {s}\n", "{f}I would say {s}.", "{f}no score given"]
+    outputs = [(rng.choice(formats).format(f=filler * rng.randint(0, 6), s=rng.randint(0, 3)),)
+               for _ in range(args.parse_outputs)]
+    latencies = timed_calls(find_first_number, outputs * args.rounds)
+    return len(latencies), sum(latencies), latencies, "output"
+
+
+def case_grade_pq_pairs(paths, args, backend: str):
+    from data_processing import load_data_files
+    from relevance_processors import grade_pq_pairs
+    from stub_pipelines import StubHFPipeline, StubTogetherPipeline
+    stub_class = StubTogetherPipeline if backend == "together" else StubHFPipeline
+    pipeline = stub_class(latency_ms=args.stub_latency_ms, ms_per_1k_chars=args.stub_ms_per_1k_chars,
+                          jitter=args.stub_jitter)
+    docid_to_doc, qid_to_query, test_qrel = load_data_files(
+        paths["docs_path"], paths["queries_path"], paths["test_qrel_path"])
+    with tempfile.TemporaryDirectory() as out_dir:
+        start = time.perf_counter()
+        grade_pq_pairs(test_qrel, docid_to_doc, qid_to_query, str(Path(out_dir) / "run.txt"),
+                       pipeline, "", args.prompt_mode)
+        elapsed = time.perf_counter() - start
+    # Sequential path: the gap between consecutive completions is one pair's latency
+    completed = [start] + pipeline.latency.completed_at
+    latencies = [b - a for a, b in zip(completed, completed[1:])]
+    return len(test_qrel), elapsed, latencies, "pair"
+
+
+def case_process_log_to_rubric(paths, args):
+    from make_rubric_format import process_log_to_rubric
+    from relevance_scoring import build_scoring_log
+    from stub_pipelines import stub_output
+    pairs = load_pairs(paths)
+    latencies = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        log_path = Path(out_dir) / "run.jsonl"
+        with open(log_path, 'w', encoding='utf-8') as f:
+            for qidx, docidx, query, passage in pairs:
+                output = stub_output(query + passage)
+                judgment = {"LLMs_output": output, "final_relevance_score": int(output[-1])}
+                f.write(json.dumps(build_scoring_log(query, passage, judgment, qidx, docidx, args.prompt_mode)) + "\n")
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            process_log_to_rubric(str(log_path), str(Path(out_dir) / "run_rubric.jsonl.gz"),
+                                  paths["test_qrel_path"], model_name="stub/model")
+            latencies.append(time.perf_counter() - start)
+    return len(pairs) * args.rounds, sum(latencies), latencies, "round"
+
+
+CASES = {
+    "load_data_files[lazy]": lambda paths, args: case_load_data_files(paths, args, lazy_docs=True),
+    "load_data_files[eager]": lambda paths, args: case_load_data_files(paths, args, lazy_docs=False),
+    "get_umbrella_prompt": case_get_umbrella_prompt,
+    "find_first_number": case_find_first_number,
+    "grade_pq_pairs[together_stub]": lambda paths, args: case_grade_pq_pairs(paths, args, "together"),
+    "grade_pq_pairs[hf_stub]": lambda paths, args: case_grade_pq_pairs(paths, args, "hf"),
+    "process_log_to_rubric": case_process_log_to_rubric,
+}
+
+
+def run_case(name: str, paths: Dict[str, str], args) -> Dict:
+    """Run one case in this process and summarise it."""
+    # Keep progress bars and per-run prints out of the JSON on stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        items, elapsed, latencies, latency_unit = CASES[name](paths, args)
+    return {
+        "items": items,
+        "items_per_s": items / elapsed if elapsed else 0.0,
+        "latency_unit": latency_unit,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def compare(results: Dict, baseline: Dict, max_regression: float) -> List[str]:
+    """Print the change of every case against the baseline and return the regressions."""
+    regressions = []
+    if baseline.get("config") != results["config"]:
+        print(f"\nWarning: the baseline was recorded with a different configuration: {baseline.get('config')}")
+    print(f"\n{'case':<32}{'items/s':>12}{'baseline':>12}{'change':>10}{'RSS change':>12}")
+    for name, result in results["cases"].items():
+        reference = baseline.get("cases", {}).get(name)
+        if reference is None:
+            print(f"{name:<32}{result['items_per_s']:>12,.0f}{'-':>12}")
+            continue
+        change = result["items_per_s"] / reference["items_per_s"] - 1
+        rss_change = result["peak_rss_mb"] - reference["peak_rss_mb"]
+        print(f"{name:<32}{result['items_per_s']:>12,.0f}{reference['items_per_s']:>12,.0f}"
+              f"{change:>+10.1%}{rss_change:>+10.0f}MB")
+        if change < -max_regression:
+            regressions.append(f"{name}: {change:+.1%} items/s")
+    return regressions
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Run the offline benchmark suite on synthetic data with stub backends.")
+    parser.add_argument("--cases", type=str, default=",".join(CASES),
+                        help=f"Comma-separated subset of {list(CASES)}")
+    parser.add_argument("--data_dir", type=str, default=None,
+                        help="Reuse or create the synthetic dataset here (default: a temporary directory)")
+    parser.add_argument("--num_queries", type=int, default=40)
+    parser.add_argument("--docs_per_query", type=int, default=50)
+    parser.add_argument("--length_distribution", type=str, default="lognormal",
+                        choices=["fixed", "uniform", "lognormal"])
+    parser.add_argument("--mean_words", type=int, default=60)
+    parser.add_argument("--prompt_mode", type=str, default="zeroshot_bing")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="Repetitions of each case")
+    parser.add_argument("--parse_outputs", type=int, default=5000,
+                        help="Synthetic model outputs parsed per round by find_first_number")
+    parser.add_argument("--stub_latency_ms", type=float, default=0.0,
+                        help="Simulated latency per model call")
+    parser.add_argument("--stub_ms_per_1k_chars", type=float, default=0.0,
+                        help="Simulated latency per 1k prompt characters")
+    parser.add_argument("--stub_jitter", type=float, default=0.0,
+                        help="Relative jitter of the simulated latency")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Write the results JSON here (e.g. to record a new baseline)")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="Results JSON of an earlier run to compare against")
+    parser.add_argument("--max_regression", type=float, default=0.2,
+                        help="Allowed relative items/s drop against the baseline for --check")
+    parser.add_argument("--check", action="store_true",
+                        help="Exit with status 1 if a case regressed beyond --max_regression")
+    parser.add_argument("--run_case", type=str, default=None, help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    dataset_args = dict(num_queries=args.num_queries, docs_per_query=args.docs_per_query,
+                        length_distribution=args.length_distribution, mean_words=args.mean_words)
+    if args.run_case is not None:
+        paths = {key: str(Path(args.data_dir) / name) for key, name in
+                 [("docs_path", "docs.jsonl"), ("queries_path", "queries.tsv"), ("test_qrel_path", "qrels.txt")]}
+        print(json.dumps(run_case(args.run_case, paths, args)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        if not (Path(data_dir) / "qrels.txt").exists():
+            generate_dataset(data_dir, **dataset_args)
+        results = {
+            "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                            "cpus": os.cpu_count()},
+            "config": {**dataset_args, "prompt_mode": args.prompt_mode, "rounds": args.rounds,
+                       "stub_latency_ms": args.stub_latency_ms,
+                       "stub_ms_per_1k_chars": args.stub_ms_per_1k_chars},
+            "cases": {},
+        }
+        print(f"{'case':<32}{'items/s':>12}{'p50 (ms)':>12}{'p99 (ms)':>12}  per     {'peak RSS (MB)':>14}")
+        for name in args.cases.split(","):
+            argv = [arg for arg in sys.argv[1:] if not arg.startswith("--data_dir")]
+            command = [sys.executable, __file__, *argv, "--data_dir", data_dir, "--run_case", name]
+            completed = subprocess.run(command, capture_output=True, text=True)
+            if completed.returncode != 0:
+                print(f"{name}: failed\n{completed.stderr[-2000:]}")
+                continue
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            results["cases"][name] = result
+            print(f"{name:<32}{result['items_per_s']:>12,.0f}{result['p50_ms']:>12.4f}{result['p99_ms']:>12.4f}"
+                  f"  {result['latency_unit']:<8}{result['peak_rss_mb']:>14.0f}")
+
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        if args.check and regressions:
+            print("\n".join(["", "Benchmark regressions:"] + regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Deterministic stand-ins for the model backends, for offline benchmarks.
+
+`StubTogetherPipeline` takes the Together code path (it is a
+`TogetherPipeline`) and `StubHFPipeline` the local text-generation path
+(chat-templated prompt in, prompt plus completion out). `StubOpenAIServer`
+is an in-process OpenAI-compatible HTTP server for
+`OpenAICompatiblePipeline`, with logprobs and injectable failures. All
+answer every prompt with "##final score: X", X derived from a hash of the
+prompt, after a configurable simulated latency, and record when each call
+finished so benchmarks can derive per-pair latencies.
+"""
+
+import json
+import math
+import random
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from model_utils import TogetherPipeline
+
+
+class StubLatency:
+    """Simulated model latency: a fixed cost plus a cost per 1k prompt characters, with seeded jitter."""
+    def __init__(self, latency_ms: float = 0.0, ms_per_1k_chars: float = 0.0,
+                 jitter: float = 0.0, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.ms_per_1k_chars = ms_per_1k_chars
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.completed_at: List[float] = []
+
+    def wait(self, prompt_chars: int):
+        delay_ms = self.latency_ms + self.ms_per_1k_chars * prompt_chars / 1000
+        if self.jitter:
+            delay_ms *= 1 + self.rng.uniform(-self.jitter, self.jitter)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+        self.completed_at.append(time.perf_counter())
+
+
+def stub_output(prompt: str) -> str:
+    """The stub's answer to a prompt; the same prompt always gets the same score."""
+    return f"##final score: {zlib.crc32(prompt.encode('utf-8')) % 4}"
+
+
+class StubTogetherPipeline(TogetherPipeline):
+    """`TogetherPipeline` that answers locally instead of calling the API."""
+    def __init__(self, model_name: str = "stub/together", **latency_kwargs):
+        # No API key or client: the stub never reaches the network
+        self.model_name = model_name
+        self.latency = StubLatency(**latency_kwargs)
+
+    def __call__(self, messages: List[Dict], max_new_tokens=100, **kwargs):
+        prompt = messages[-1]["content"]
+        self.latency.wait(len(prompt))
+        return [{"generated_text": stub_output(prompt)}]
+
+
+class StubTokenizer:
+    """The tokenizer attributes the local generation path reads."""
+    eos_token_id = 1
+    pad_token_id = 0
+    padding_side = "left"
+    chat_template = "stub"
+
+    def convert_tokens_to_ids(self, token: str) -> int:
+        return 2
+
+    def apply_chat_template(self, messages: List[Dict], tokenize: bool = False,
+                            add_generation_prompt: bool = False) -> str:
+        rendered = "".join(f"<|{m['role']}|>\n{m['content']}\n" for m in messages)
+        return rendered + ("<|assistant|>\n" if add_generation_prompt else "")
+
+
+class StubHFPipeline:
+    """HF text-generation pipeline look-alike: returns the prompt followed by the completion."""
+    task = "text-generation"
+
+    def __init__(self, model_name: str = "stub/hf", **latency_kwargs):
+        self.model_name = model_name
+        self.tokenizer = StubTokenizer()
+        self.latency = StubLatency(**latency_kwargs)
+
+    def __call__(self, prompts, **generation_kwargs):
+        if isinstance(prompts, str):
+            self.latency.wait(len(prompts))
+            return [{"generated_text": prompts + stub_output(prompts)}]
+        outputs = []
+        for prompt in prompts:
+            self.latency.wait(len(prompt))
+            outputs.append([{"generated_text": prompt + stub_output(prompt)}])
+        return outputs
+
+
+def stub_logprobs(prompt: str, top_logprobs: int) -> List[Dict]:
+    """OpenAI-style logprobs of `stub_output`: the stub's grade gets 70% of the mass, the others 10% each."""
+    grade = stub_output(prompt)[-1]
+    tokens = ["##", "final", " score", ":", f" {grade}"]
+    content = [{"token": token, "logprob": 0.0, "top_logprobs": [{"token": token, "logprob": 0.0}]}
+               for token in tokens]
+    candidates = [{"token": f" {g}", "logprob": math.log(0.7 if str(g) == grade else 0.1)} for g in range(4)]
+    content[-1] = {"token": tokens[-1], "logprob": math.log(0.7),
+                   "top_logprobs": sorted(candidates, key=lambda c: -c["logprob"])[:top_logprobs]}
+    return content
+
+
+class StubOpenAIServer:
+    """
+    OpenAI-compatible chat completions server on a free localhost port, run
+    in a background thread of the current process.
+
+    Counts requests, accepted TCP connections and the most requests served
+    at once, so callers can check connection reuse and backpressure. The
+    first `fail_first` requests are answered with `fail_status` and a
+    Retry-After of `retry_after` seconds.
+    """
+    def __init__(self, fail_first: int = 0, fail_status: int = 429, retry_after: str = "0",
+                 **latency_kwargs):
+        self.latency = StubLatency(**latency_kwargs)
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def send_json(self, status: int, body: Dict, headers: Dict = None):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with stub.lock:
+                    stub.requests += 1
+                    failing = stub.requests <= stub.fail_first
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                try:
+                    if failing:
+                        self.send_json(stub.fail_status, {"error": {"message": "stub failure"}},
+                                       {"Retry-After": stub.retry_after})
+                        return
+                    prompt = request["messages"][-1]["content"]
+                    stub.latency.wait(len(prompt))
+                    choice = {"index": 0, "finish_reason": "stop",
+                              "message": {"role": "assistant", "content": stub_output(prompt)}}
+                    if request.get("logprobs"):
+                        choice["logprobs"] = {"content": stub_logprobs(prompt, request.get("top_logprobs", 5))}
+                    self.send_json(200, {
+                        "id": f"stub-{stub.requests}", "object": "chat.completion",
+                        "created": int(time.time()), "model": request["model"],
+                        "choices": [choice],
+                        "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": 5,
+                                  "total_tokens": len(prompt) // 4 + 5},
+                    })
+                finally:
+                    with stub.lock:
+                        stub.active -= 1
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+            def process_request(self, request, client_address):
+                with stub.lock:
+                    stub.connections += 1
+                super().process_request(request, client_address)
+
+            def handle_error(self, request, client_address):
+                # Clients that time out close the connection before the answer
+                if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+                    super().handle_error(request, client_address)
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
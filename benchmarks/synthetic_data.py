@@ -0,0 +1,115 @@
+"""
+Synthetic DL-style datasets for offline benchmarks.
+
+Writes a documents JSONL ({"docid", "doc"} per line), a queries TSV
+(qid<TAB>query) and a qrel file ("qid 0 docid grade") in the layout of
+the TREC DL files under ./data/, so `load_data_files` and `main.py` read
+them unchanged. Passage lengths follow a fixed, uniform or log-normal
+(long-tailed, like MS MARCO passages) distribution. Output is fully
+determined by the seed.
+
+Usage:
+    python benchmarks/synthetic_data.py --out_dir /tmp/synthetic_dl --num_queries 50 \\
+        --docs_per_query 200 --length_distribution lognormal --mean_words 60
+"""
+
+import argparse
+import json
+import math
+import random
+from pathlib import Path
+from typing import Dict
+
+SYLLABLES = ["ka", "lo", "mi", "ra", "ten", "vo", "shi", "pu", "den", "ar", "el", "ix", "on", "tra", "mo"]
+# Grade distribution of the DL qrels: mostly non-relevant, few perfectly relevant
+GRADE_WEIGHTS = [0.5, 0.25, 0.15, 0.1]
+
+
+def make_vocabulary(rng: random.Random, size: int = 5000):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(SYLLABLES, k=rng.randint(1, 4))))
+    return sorted(words)
+
+
+def passage_length(rng: random.Random, distribution: str, mean_words: int) -> int:
+    """Draw a passage length in words."""
+    if distribution == "fixed":
+        return mean_words
+    if distribution == "uniform":
+        return rng.randint(max(1, mean_words // 2), mean_words * 3 // 2)
+    # Log-normal with the requested mean and a long right tail
+    sigma = 0.6
+    mu = math.log(mean_words) - sigma ** 2 / 2
+    return max(5, int(rng.lognormvariate(mu, sigma)))
+
+
+def generate_dataset(out_dir: str, num_queries: int = 50, docs_per_query: int = 100,
+                     length_distribution: str = "lognormal", mean_words: int = 60,
+                     docid_style: str = "int", seed: int = 0) -> Dict[str, str]:
+    """
+    Write a synthetic docs/queries/qrels triple.
+
+    Args:
+        out_dir: Directory for the three files
+        num_queries: Number of queries
+        docs_per_query: Judged passages per query (the qrel has
+            num_queries x docs_per_query rows)
+        length_distribution: "fixed", "uniform" or "lognormal"
+        mean_words: Mean passage length in words
+        docid_style: "int" for numeric MS MARCO v1 ids (DL19/20),
+            "msmarco" for "msmarco_passage_XX_N" ids (DL23)
+        seed: Random seed
+
+    Returns:
+        Dictionary with docs_path, queries_path and test_qrel_path
+    """
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    paths = {
+        "docs_path": str(out / "docs.jsonl"),
+        "queries_path": str(out / "queries.tsv"),
+        "test_qrel_path": str(out / "qrels.txt"),
+    }
+
+    with open(paths["docs_path"], 'w', encoding='utf-8') as docs_f, \
+         open(paths["queries_path"], 'w', encoding='utf-8') as queries_f, \
+         open(paths["test_qrel_path"], 'w', encoding='utf-8') as qrels_f:
+        doc_number = 0
+        for q in range(num_queries):
+            qid = 1000 + q
+            queries_f.write(f"{qid}\t{' '.join(rng.choices(vocabulary, k=rng.randint(3, 10)))}\n")
+            for _ in range(docs_per_query):
+                doc_number += 1
+                if docid_style == "msmarco":
+                    docid = f"msmarco_passage_{doc_number % 70:02d}_{doc_number * 7919}"
+                else:
+                    docid = str(doc_number * 7919)
+                words = rng.choices(vocabulary, k=passage_length(rng, length_distribution, mean_words))
+                docs_f.write(json.dumps({"docid": docid, "doc": " ".join(words)}) + "\n")
+                grade = rng.choices(range(4), weights=GRADE_WEIGHTS)[0]
+                qrels_f.write(f"{qid} 0 {docid} {grade}\n")
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic DL-style docs/queries/qrels dataset.")
+    parser.add_argument("--out_dir", type=str, required=True)
+    parser.add_argument("--num_queries", type=int, default=50)
+    parser.add_argument("--docs_per_query", type=int, default=100)
+    parser.add_argument("--length_distribution", type=str, default="lognormal",
+                        choices=["fixed", "uniform", "lognormal"])
+    parser.add_argument("--mean_words", type=int, default=60)
+    parser.add_argument("--docid_style", type=str, default="int", choices=["int", "msmarco"])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths = generate_dataset(args.out_dir, args.num_queries, args.docs_per_query,
+                             args.length_distribution, args.mean_words, args.docid_style, args.seed)
+    print(f"Wrote {args.num_queries * args.docs_per_query} qrel rows: {paths}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Length-bucketed batch scheduling.
+A padded batch costs as much as its longest prompt times its size, and qrel
+files list passages of very different lengths next to each other. The
+scheduler estimates each pair's prompt length from the cached token ids of
+the template segments, groups a window of pairs into length buckets and
+forms batches under a padded-token budget instead of a fixed pair count.
+Callers write results back in qrel order.
+"""
+
+from typing import List, Optional, Tuple
+
+from prompts import get_prompt_registry
+
+
+class LengthBucketScheduler:
+    """
+    Plans token-budgeted batches over a window of pairs and tracks padding.
+
+    Pairs are sorted by length bucket (a stable sort, so pairs within a
+    bucket keep their qrel order) and packed greedily while
+    `batch size x longest prompt` stays within `max_batch_tokens`.
+    """
+    def __init__(self, tokenizer, system_message: str, max_batch_tokens: int,
+                 max_batch_size: Optional[int] = None, bucket_width: int = 32):
+        self.tokenizer = tokenizer
+        self.system_message = system_message
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.bucket_width = bucket_width
+        self.lengths: List[int] = []
+
+        self.batches = 0
+        self.prompt_tokens = 0
+        self.padded_tokens = 0
+        self.model_time = 0.0
+
+    def prompt_length(self, query: str, passage: str, mode: str) -> int:
+        """Number of input tokens of one pair's chat-templated prompt."""
+        return len(get_prompt_registry().encode_pair(query, passage, mode, self.tokenizer, self.system_message))
+
+    def plan(self, pairs: List[Tuple[str, str, str, str]], mode: str) -> List[List[int]]:
+        """
+        Split a window of (qidx, docidx, query, passage) pairs into batches.
+
+        Returns:
+            List of batches, each a list of indices into `pairs`
+        """
+        self.lengths = [self.prompt_length(query, passage, mode) for _, _, query, passage in pairs]
+        order = sorted(range(len(pairs)), key=lambda i: self.lengths[i] // self.bucket_width)
+
+        batches, batch, longest = [], [], 0
+        for i in order:
+            new_longest = max(longest, self.lengths[i])
+            too_many = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (too_many or new_longest * (len(batch) + 1) > self.max_batch_tokens):
+                batches.append(batch)
+                batch, new_longest = [], self.lengths[i]
+            batch.append(i)
+            longest = new_longest
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def record(self, batch: List[int], elapsed: float):
+        """Account one finished batch from the last planned window."""
+        lengths = [self.lengths[i] for i in batch]
+        self.batches += 1
+        self.prompt_tokens += sum(lengths)
+        self.padded_tokens += len(lengths) * max(lengths)
+        self.model_time += elapsed
+
+    def report(self):
+        """Print the padding ratio and prompt-token throughput of the scheduled batches."""
+        if not self.batches:
+            return
+        padding_ratio = 1 - self.prompt_tokens / self.padded_tokens
+        throughput = self.prompt_tokens / self.model_time if self.model_time else 0.0
+        print(f"Length scheduler: {self.batches} batches, avg {self.padded_tokens / self.batches:.0f} padded tokens "
+              f"per batch, padding ratio {padding_ratio:.1%}, {throughput:,.0f} prompt tokens/s")
@@ -0,0 +1,193 @@
+"""
+Cascade judging.
+Every pair is first scored by a small local model in logits mode, which
+yields a 0-3 grade distribution for the price of one forward pass. Only pairs
+the small model is unsure about (low top-grade probability, or an expected
+relevance close to the boundary between two grades) are sent to the large,
+expensive backend. A random sample of the confident pairs is sent as well,
+to measure how often the two stages agree.
+"""
+
+import time
+import random
+import asyncio
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from model_utils import TogetherPipeline, AsyncTogetherPipeline
+from prompts import get_umbrella_prompt
+from relevance_scoring import (
+    build_messages, build_scoring_log, extract_final_score, judge_prompts, lookup_cached_judgment
+)
+
+if TYPE_CHECKING:
+    from early_stop import FinalScoreStoppingCriteria
+
+
+class CascadeJudge:
+    """
+    Two-stage judge: a small local model first, the large backend for uncertain pairs.
+
+    Log records carry `cascade_stage` ("small" or "large") and the small
+    model's `cascade_confidence`; escalated records also keep the small
+    model's score and distribution, and audited records the large model's
+    score in `cascade_audit_score`.
+    """
+    def __init__(self, small_pipeline, large_pipeline, system_message: str,
+                 confidence_threshold: float = 0.6, boundary_margin: float = 0.1,
+                 audit_rate: float = 0.05, seed: int = 0):
+        if isinstance(small_pipeline, TogetherPipeline):
+            raise ValueError("The small cascade model must be a local model (it is scored through logits)")
+        self.small_pipeline = small_pipeline
+        self.large_pipeline = large_pipeline
+        self.system_message = system_message
+        self.confidence_threshold = confidence_threshold
+        self.boundary_margin = boundary_margin
+        self.audit_rate = audit_rate
+        self.rng = random.Random(seed)
+        # Event loop of a concurrent large backend, created on the first escalation
+        # and kept for the run so its async client is built once
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self.pairs = 0
+        self.escalated = 0
+        self.audited = 0
+        self.audit_agreements = 0
+        self.small_time = 0.0
+        self.large_time = 0.0
+        self.large_calls = 0
+
+    def should_escalate(self, small_judgment: Dict) -> bool:
+        """Decide whether the small model's distribution is too uncertain to keep."""
+        if max(small_judgment["score_distribution"]) < self.confidence_threshold:
+            return True
+        # Distance of the expected grade from the nearest midpoint between grades
+        expected = small_judgment["expected_relevance"]
+        return abs(expected - round(expected - 0.5) - 0.5) < self.boundary_margin
+
+    def judge_large(self, prompts: List[str], cache=None, scoring: str = "generate",
+                    stopping_criterion: Optional["FinalScoreStoppingCriteria"] = None) -> List[Dict]:
+        """Judge prompts with the large backend, through the judgment cache."""
+        lookups = [lookup_cached_judgment(cache, prompt, self.large_pipeline, self.system_message,
+                                          scoring, stopping_criterion is not None)
+                   for prompt in prompts]
+        judgments = [cached for _, cached in lookups]
+        uncached = [i for i, cached in enumerate(judgments) if cached is None]
+        if uncached:
+            start = time.perf_counter()
+            uncached_prompts = [prompts[i] for i in uncached]
+            if isinstance(self.large_pipeline, AsyncTogetherPipeline):
+                new_judgments = self.run_async(self.ajudge_large(uncached_prompts))
+            else:
+                new_judgments = judge_prompts(uncached_prompts, self.large_pipeline, self.system_message,
+                                              scoring, stopping_criterion)
+            self.large_time += time.perf_counter() - start
+            self.large_calls += len(uncached)
+            for i, judgment in zip(uncached, new_judgments):
+                judgments[i] = judgment
+                if cache is not None:
+                    cache.put(lookups[i][0], judgment)
+        return judgments
+
+    def run_async(self, coroutine):
+        """Run a coroutine on the cascade's event loop, starting the large backend in it the first time."""
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.astart_large())
+        return self.loop.run_until_complete(coroutine)
+
+    async def astart_large(self):
+        # The async client and limiters must be created inside the loop that uses them
+        self.large_pipeline.start()
+
+    async def ajudge_large(self, prompts: List[str]) -> List[Dict]:
+        """Send escalated prompts to the concurrent Together backend all at once."""
+        llms_outputs = await asyncio.gather(*(
+            self.large_pipeline.agenerate(build_messages(prompt, self.system_message))
+            for prompt in prompts
+        ))
+        return [{"LLMs_output": llms_output, "final_relevance_score": extract_final_score(llms_output)}
+                for llms_output in llms_outputs]
+
+    def close(self):
+        """Close the large backend's async client and the cascade's event loop (if one was started)."""
+        if self.loop is None:
+            return
+        try:
+            self.loop.run_until_complete(self.large_pipeline.aclose())
+        finally:
+            self.loop.close()
+            self.loop = None
+
+    def grade_pairs(self, pairs: List[Tuple[str, str, str, str]], log_sink, mode: str,
+                    cache=None, scoring: str = "generate",
+                    stopping_criterion: Optional["FinalScoreStoppingCriteria"] = None) -> List[Tuple[int, Dict]]:
+        """
+        Grade a batch of pairs through the cascade and log them in input order.
+
+        Args:
+            pairs: Tuples of (qidx, docidx, query, passage)
+            log_sink: JudgmentLogSink receiving the scoring logs, or None when
+                the caller writes them itself
+            mode: UMBRELA prompt mode
+            cache: Optional JudgmentCache for the large backend
+            scoring: Scoring mode of the large backend
+            stopping_criterion: Optional early stop for a local large model
+
+        Returns:
+            List[Tuple[int, Dict]]: Final score and scoring log per pair, in input order
+        """
+        prompts = [get_umbrella_prompt(query=query, passage=passage, mode=mode)
+                   for _, _, query, passage in pairs]
+        start = time.perf_counter()
+        judgments = judge_prompts(prompts, self.small_pipeline, self.system_message, scoring="logits")
+        self.small_time += time.perf_counter() - start
+        for judgment in judgments:
+            judgment["cascade_stage"] = "small"
+            judgment["cascade_confidence"] = max(judgment["score_distribution"])
+
+        escalate = [i for i, judgment in enumerate(judgments) if self.should_escalate(judgment)]
+        escalated = set(escalate)
+        audit = [i for i in range(len(judgments))
+                 if i not in escalated and self.rng.random() < self.audit_rate]
+        large_judgments = self.judge_large([prompts[i] for i in escalate + audit], cache, scoring,
+                                           stopping_criterion)
+
+        for i, large_judgment in zip(escalate, large_judgments):
+            small_judgment = judgments[i]
+            judgments[i] = dict(
+                large_judgment,
+                cascade_stage="large",
+                cascade_confidence=small_judgment["cascade_confidence"],
+                cascade_small_score=small_judgment["final_relevance_score"],
+                cascade_small_distribution=small_judgment["score_distribution"],
+            )
+        for i, large_judgment in zip(audit, large_judgments[len(escalate):]):
+            judgments[i]["cascade_audit_score"] = large_judgment["final_relevance_score"]
+            self.audit_agreements += large_judgment["final_relevance_score"] == judgments[i]["final_relevance_score"]
+        # Counted once the large model answered, so a batch retried after a failure counts once
+        self.pairs += len(pairs)
+        self.escalated += len(escalate)
+        self.audited += len(audit)
+
+        results = []
+        for (qidx, docidx, query, passage), judgment in zip(pairs, judgments):
+            scoring_log = build_scoring_log(query, passage, judgment, qidx, docidx, mode)
+            if log_sink is not None:
+                log_sink.write_log(scoring_log)
+            results.append((scoring_log["final_relevance_score"], scoring_log))
+        return results
+
+    def report(self):
+        """Print the escalation rate, audit agreement and estimated time saved."""
+        escalation_rate = self.escalated / self.pairs if self.pairs else 0.0
+        print(f"Cascade: {self.escalated}/{self.pairs} pairs escalated to the large model "
+              f"({escalation_rate:.1%})")
+        if self.audited:
+            print(f"Cascade audit: small and large model agree on {self.audit_agreements}/{self.audited} "
+                  f"confident pairs ({self.audit_agreements / self.audited:.1%})")
+        if self.large_calls:
+            large_only_time = self.large_time / self.large_calls * self.pairs
+            cascade_time = self.small_time + self.large_time
+            print(f"Cascade time: {cascade_time:.1f}s (small {self.small_time:.1f}s, large {self.large_time:.1f}s) "
+                  f"vs. ~{large_only_time:.1f}s estimated for the large model alone; "
+                  f"~{large_only_time - cascade_time:.1f}s saved")
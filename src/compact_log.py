@@ -0,0 +1,200 @@
+"""
+Compact judgment log format.
+The JSONL log repeats the full query and passage text next to every model
+output, so most of its bytes are corpus text that already lives in the
+docs/queries files. A compact log keeps only the ids, prompt mode, score,
+raw output and extra judgment fields (such as the score distribution), as
+length-prefixed binary records; query and passage text are resolved from the
+document and query stores when the log is read.
+
+File layout: COMPACT_LOG_MAGIC, then one record per judgment made of a
+little-endian uint32 payload length and a UTF-8 JSON array payload
+[qidx, docidx, prompt_mode, final_relevance_score, LLMs_output, extras].
+JSON keeps the id types (int or str) the run used to look the pair up.
+
+Usage:
+    python src/compact_log.py to-compact logs/run.jsonl logs/run.umblog
+    python src/compact_log.py to-jsonl logs/run.umblog logs/run.jsonl \\
+        --docs_path docs.jsonl --queries_path queries.tsv
+"""
+
+import json
+import struct
+import argparse
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+COMPACT_LOG_MAGIC = b"UMBRELA-LOG\x01\n"
+COMPACT_LOG_SUFFIX = ".umblog"
+LOG_SUFFIXES = {"jsonl": ".jsonl", "compact": COMPACT_LOG_SUFFIX}
+
+RECORD_HEADER = struct.Struct("<I")
+# Fields stored positionally in every record; anything else goes to extras
+CORE_FIELDS = ("qidx", "docidx", "prompt_mode", "final_relevance_score", "LLMs_output")
+# Fields dropped from the compact record and resolved from the stores
+TEXT_FIELDS = ("query", "passage")
+
+
+def encode_record(scoring_log: Dict) -> bytes:
+    """Encode one scoring log as a length-prefixed compact record."""
+    extras = {k: v for k, v in scoring_log.items() if k not in CORE_FIELDS and k not in TEXT_FIELDS}
+    payload = json.dumps(
+        [scoring_log[field] for field in CORE_FIELDS] + [extras or None],
+        ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+    return RECORD_HEADER.pack(len(payload)) + payload
+
+
+def decode_record(payload: bytes, docid_to_doc=None, qid_to_query=None) -> Dict:
+    """
+    Decode one record payload into a scoring log.
+
+    Query and passage text are filled in when the matching store is given,
+    so the result has the same keys, in the same order, as a JSONL record.
+    """
+    qidx, docidx, mode, final_score, llms_output, extras = json.loads(payload)
+    scoring_log = {"prompt_mode": mode, "qidx": qidx, "docidx": docidx}
+    if qid_to_query is not None:
+        scoring_log["query"] = qid_to_query[qidx]
+    if docid_to_doc is not None:
+        scoring_log["passage"] = docid_to_doc[docidx]
+    scoring_log["LLMs_output"] = llms_output
+    scoring_log["final_relevance_score"] = final_score
+    if extras:
+        scoring_log.update(extras)
+    return scoring_log
+
+
+def is_compact_log(path) -> bool:
+    """Return True if `path` is a compact log (by suffix, or by its header when it exists)."""
+    path = Path(path)
+    if path.exists():
+        with open(path, 'rb') as f:
+            head = f.read(len(COMPACT_LOG_MAGIC))
+        if head == COMPACT_LOG_MAGIC:
+            return True
+        if len(head) == len(COMPACT_LOG_MAGIC) or not COMPACT_LOG_MAGIC.startswith(head):
+            return False
+    return path.suffix == COMPACT_LOG_SUFFIX
+
+
+def scan_compact_log(path) -> Iterator[Tuple[bytes, int]]:
+    """
+    Iterate over the record payloads of a compact log.
+
+    Stops quietly at a torn trailing record (left by a process killed
+    mid-write), so callers can truncate the file to the last offset seen.
+
+    Yields:
+        Tuples of (payload, file offset just past the record)
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(COMPACT_LOG_MAGIC))
+        if magic != COMPACT_LOG_MAGIC:
+            if COMPACT_LOG_MAGIC.startswith(magic):
+                # Empty file or torn header
+                return
+            raise ValueError(f"{path} is not a compact judgment log")
+        offset = len(COMPACT_LOG_MAGIC)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            (length,) = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            offset += RECORD_HEADER.size + length
+            yield payload, offset
+
+
+class LogRecordReader:
+    """
+    Iterate over the scoring logs of a JSONL or compact judgment log.
+
+    Unparseable JSONL lines are reported and skipped; their number is kept
+    in `errors`. For compact logs, query and passage text are resolved from
+    `docid_to_doc` and `qid_to_query` when they are given.
+    """
+    def __init__(self, path, docid_to_doc=None, qid_to_query=None):
+        self.path = Path(path)
+        self.docid_to_doc = docid_to_doc
+        self.qid_to_query = qid_to_query
+        self.errors = 0
+
+    def __iter__(self) -> Iterator[Dict]:
+        if is_compact_log(self.path):
+            for payload, _ in scan_compact_log(self.path):
+                yield decode_record(payload, self.docid_to_doc, self.qid_to_query)
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line.strip())
+                except json.JSONDecodeError as e:
+                    print(f"Error parsing JSON: {e}")
+                    self.errors += 1
+
+
+def jsonl_to_compact(input_file: str, output_file: str) -> int:
+    """
+    Convert a JSONL judgment log into a compact log.
+
+    Returns:
+        Number of records written
+    """
+    count = 0
+    with open(output_file, 'wb') as out_f:
+        out_f.write(COMPACT_LOG_MAGIC)
+        for scoring_log in LogRecordReader(input_file):
+            out_f.write(encode_record(scoring_log))
+            count += 1
+    return count
+
+
+def compact_to_jsonl(input_file: str, output_file: str,
+                     docid_to_doc: Optional[Dict] = None, qid_to_query: Optional[Dict] = None) -> int:
+    """
+    Convert a compact log back into the JSONL format.
+
+    Without the document and query stores the records have no query and
+    passage text and cannot be turned into rubric format.
+
+    Returns:
+        Number of records written
+    """
+    count = 0
+    with open(output_file, 'w', encoding='utf-8') as out_f:
+        for scoring_log in LogRecordReader(input_file, docid_to_doc, qid_to_query):
+            out_f.write(json.dumps(scoring_log) + "\n")
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert judgment logs between the JSONL and compact formats.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    to_compact = subparsers.add_parser("to-compact", help="JSONL log -> compact log")
+    to_compact.add_argument("input_file")
+    to_compact.add_argument("output_file")
+    to_jsonl = subparsers.add_parser("to-jsonl", help="compact log -> JSONL log")
+    to_jsonl.add_argument("input_file")
+    to_jsonl.add_argument("output_file")
+    to_jsonl.add_argument("--docs_path", type=str, required=True,
+                          help="Documents JSONL used to restore passage text")
+    to_jsonl.add_argument("--queries_path", type=str, required=True,
+                          help="Queries TSV used to restore query text")
+    args = parser.parse_args()
+
+    if args.command == "to-compact":
+        count = jsonl_to_compact(args.input_file, args.output_file)
+    else:
+        from data_processing import DocumentStore, get_all_query_id_to_query
+        docid_to_doc = DocumentStore(args.docs_path)
+        qid_to_query = get_all_query_id_to_query(args.queries_path)
+        count = compact_to_jsonl(args.input_file, args.output_file, docid_to_doc, qid_to_query)
+    print(f"Wrote {count} records to {args.output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+Batch rubric converter.
+Converts many judgment logs to rubric format in one go: qrels and DL23 id
+mappings are loaded once per dataset, records are parsed and compressed in
+chunks by a process pool, and each chunk becomes one member of a
+multi-member gzip file. Decompressed output is byte-identical to
+`process_log_to_rubric`.
+
+Usage:
+    python src/convert_rubrics.py --logs "results/logs/*.jsonl" --workers 8
+
+Datasets and models outside the built-in tables are converted by passing
+their files and model ids:
+    python src/convert_rubrics.py --logs "results/logs/robust04_*.jsonl" \
+        --test_qrel_path ./data/robust04/qrels.txt --model_alias Qwen2-7B=Qwen/Qwen2-7B-Instruct
+"""
+
+import os
+import glob
+import gzip
+import json
+import time
+import argparse
+import multiprocessing
+from collections import deque
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from compact_log import LOG_SUFFIXES, decode_record, is_compact_log, scan_compact_log
+from make_rubric_format import make_mapping_dict, make_qrel_dict, make_rubric_line
+
+# Default dataset files as laid out in run_command.sh, keyed by the result file prefix
+DATASETS = {
+    "dl19": {
+        "qrel_path": "./data/dl2019/2019qrels-pass.txt",
+        "queries_path": "./data/dl2019/msmarco-test2019-queries.tsv",
+        "docs_path": "./data/dl2019/dl2019_document.jsonl",
+        "is_dl23": False,
+    },
+    "dl20": {
+        "qrel_path": "./data/dl2020/2020qrels-pass.txt",
+        "queries_path": "./data/dl2020/msmarco-test2020-queries.tsv",
+        "docs_path": "./data/dl2020/dl2020_document.jsonl",
+        "is_dl23": False,
+    },
+    "dl23": {
+        "qrel_path": "./data/dl2023/llm4eval_test_qrel_2024_withRel.txt",
+        "queries_path": "./data/dl2023/llm4eval_query_2024.txt",
+        "docs_path": "./data/dl2023/llm4eval_document_2024.jsonl",
+        "is_dl23": True,
+        "doc_mapping_path": "./data/dl2023/docid_to_docidx.txt",
+        "query_mapping_path": "./data/dl2023/qid_to_qidx.txt",
+    },
+}
+
+# Default model ids keyed by the suffix used in result file names
+MODEL_NAMES = {
+    "Llama-3-8B-Instruct": "meta-llama/Meta-Llama-3-8B-Instruct",
+    "flan-t5-large": "google/flan-t5-large",
+    "DSV3": "deepseek-ai/DeepSeek-V3",
+}
+
+# Per-worker dataset state, set by `init_worker`
+_worker_state: Dict = {}
+
+
+def infer_dataset(log_path: Path) -> str:
+    """Return the dataset name of a log file: its name prefix."""
+    return log_path.name.split("_", 1)[0]
+
+
+def resolve_dataset(name: str, overrides: Dict[str, Optional[str]]) -> Dict:
+    """
+    Return the files of a dataset: the built-in layout of `name`, if any,
+    with every path given in `overrides` replacing the default. Passing DL23
+    mapping files marks the dataset as DL23.
+    """
+    dataset = dict(DATASETS.get(name, {"is_dl23": False}))
+    dataset.update({key: path for key, path in overrides.items() if path is not None})
+    if overrides.get("doc_mapping_path") or overrides.get("query_mapping_path"):
+        dataset["is_dl23"] = True
+    if "qrel_path" not in dataset:
+        raise ValueError(f"Unknown dataset {name!r} (built-in: {', '.join(sorted(DATASETS))}); "
+                         f"pass --test_qrel_path")
+    return dataset
+
+
+def infer_model_name(log_path: Path, model_names: Dict[str, str] = MODEL_NAMES) -> str:
+    """Return the model id of a log file from its name suffix."""
+    stem = log_path.name
+    for suffix in LOG_SUFFIXES.values():
+        stem = stem.replace(suffix, "")
+    for short_name, model_name in model_names.items():
+        if stem.endswith("_" + short_name):
+            return model_name
+    raise ValueError(f"Cannot tell the model of {log_path}; pass --model_name or --model_alias")
+
+
+def parse_model_alias(alias: str) -> Tuple[str, str]:
+    """Split a `SHORT_NAME=MODEL_ID` command-line value."""
+    short_name, sep, model_name = alias.partition("=")
+    if not sep or not short_name or not model_name:
+        raise argparse.ArgumentTypeError(f"expected SHORT_NAME=MODEL_ID, got {alias!r}")
+    return short_name, model_name
+
+
+def rubric_path_for(log_path: Path, output_dir: Optional[str]) -> Path:
+    """Place the rubric file where `main.py` would, or under `output_dir`."""
+    name = log_path.name
+    for suffix in LOG_SUFFIXES.values():
+        name = name.replace(suffix, "")
+    out_dir = Path(output_dir) if output_dir else log_path.parent.parent / "rubric_format"
+    return out_dir / f"{name}_rubric.jsonl.gz"
+
+
+def load_dataset(dataset: Dict, needs_text: bool) -> Dict:
+    """Load the qrels, DL23 mappings and (for compact logs) text stores of one dataset."""
+    state = {
+        "qrel_dict": make_qrel_dict(dataset["qrel_path"]),
+        "is_dl23": dataset["is_dl23"],
+        "passage_to_msmarco": None,
+        "qidtomsmarcoqids": None,
+        "docid_to_doc": None,
+        "qid_to_query": None,
+    }
+    if dataset["is_dl23"]:
+        state["passage_to_msmarco"] = make_mapping_dict(dataset["doc_mapping_path"])
+        state["qidtomsmarcoqids"] = make_mapping_dict(dataset["query_mapping_path"])
+    if needs_text:
+        from data_processing import DocumentStore, get_all_query_id_to_query
+        state["docid_to_doc"] = DocumentStore(dataset["docs_path"])
+        state["qid_to_query"] = get_all_query_id_to_query(dataset["queries_path"])
+    return state
+
+
+def init_worker(dataset: Dict, needs_text: bool):
+    _worker_state.clear()
+    _worker_state.update(load_dataset(dataset, needs_text))
+
+
+def convert_chunk(task: Tuple[List, bool, str, int, frozenset]) -> Tuple[List, bytes, int, int]:
+    """
+    Convert one chunk of raw log records into a gzip member.
+
+    Args:
+        task: Tuple of (raw JSONL lines or compact payloads, whether they are
+            compact, model name, compression level, pair keys to skip)
+
+    Returns:
+        Tuple of (pair keys written in order, gzip member, records written,
+        records that could not be converted)
+    """
+    records, compact, model_name, compresslevel, skip_keys = task
+    state = _worker_state
+    keys, lines = [], []
+    seen = set(skip_keys)
+    errors = 0
+    for record in records:
+        try:
+            if compact:
+                log = decode_record(record, state["docid_to_doc"], state["qid_to_query"])
+            else:
+                log = json.loads(record.strip())
+            pair_key, json_line = make_rubric_line(
+                log, state["qrel_dict"], model_name, state["is_dl23"],
+                state["passage_to_msmarco"], state["qidtomsmarcoqids"])
+        except json.JSONDecodeError as e:
+            print(f"Error parsing JSON: {e}")
+            errors += 1
+            continue
+        except KeyError as e:
+            print(f"Missing key in entry: {e}")
+            errors += 1
+            continue
+        if pair_key not in seen:
+            seen.add(pair_key)
+            keys.append(pair_key)
+            lines.append(json_line + "\n")
+    member = gzip.compress("".join(lines).encode("utf-8"), compresslevel=compresslevel)
+    return keys, member, len(lines), errors
+
+
+def iter_chunks(log_path: Path, compact: bool, chunk_size: int) -> Iterator[List]:
+    """Read a log as chunks of raw records without parsing them."""
+    chunk = []
+    if compact:
+        records = (payload for payload, _ in scan_compact_log(log_path))
+    else:
+        records = open(log_path, 'r', encoding='utf-8')
+    try:
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    finally:
+        if not compact:
+            records.close()
+    if chunk:
+        yield chunk
+
+
+def convert_log(pool, log_path: Path, output_file: Path, model_name: str,
+                compresslevel: int, chunk_size: int, max_pending: int) -> Tuple[int, int]:
+    """
+    Convert one log with the worker pool, keeping the first record of every pair.
+
+    At most `max_pending` chunks are in flight, so memory stays bounded for
+    large logs. Chunks are de-duplicated in their worker; a chunk that
+    repeats a pair from an earlier chunk (rare, only after appended re-runs)
+    is converted again with those pairs skipped.
+
+    Returns:
+        Tuple of (records written, records that could not be converted)
+    """
+    compact = is_compact_log(log_path)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    visited_pairs = set()
+    written = errors = 0
+    pending = deque()
+
+    def write_oldest(out_f):
+        nonlocal written, errors
+        chunk, async_result = pending.popleft()
+        keys, member, count, chunk_errors = async_result.get()
+        repeated = visited_pairs.intersection(keys)
+        if repeated:
+            keys, member, count, chunk_errors = pool.apply(
+                convert_chunk, ((chunk, compact, model_name, compresslevel, frozenset(repeated)),))
+        visited_pairs.update(keys)
+        out_f.write(member)
+        written += count
+        errors += chunk_errors
+
+    with open(output_file, 'wb') as out_f:
+        for chunk in iter_chunks(log_path, compact, chunk_size):
+            task = (chunk, compact, model_name, compresslevel, frozenset())
+            pending.append((chunk, pool.apply_async(convert_chunk, (task,))))
+            if len(pending) >= max_pending:
+                write_oldest(out_f)
+        while pending:
+            write_oldest(out_f)
+    return written, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert many judgment logs to rubric format in parallel.")
+    parser.add_argument("--logs", type=str, nargs="+", required=True,
+                        help="Log files or glob patterns (e.g. 'results/logs/*.jsonl')")
+    parser.add_argument("--output_dir", type=str, default=None,
+                        help="Directory for rubric files (default: rubric_format/ next to each logs/ dir)")
+    parser.add_argument("--dataset", type=str, default=None,
+                        help=f"Dataset of all logs (default: from each file name prefix); "
+                             f"built-in layouts: {', '.join(sorted(DATASETS))}")
+    parser.add_argument("--test_qrel_path", type=str, default=None,
+                        help="Qrel file of the logs (required for datasets without a built-in layout)")
+    parser.add_argument("--queries_path", type=str, default=None,
+                        help="Queries file, needed for compact logs of datasets without a built-in layout")
+    parser.add_argument("--docs_path", type=str, default=None,
+                        help="Documents file, needed for compact logs of datasets without a built-in layout")
+    parser.add_argument("--doc_mapping_path", type=str, default=None,
+                        help="DL23-style docid mapping file; marks the dataset as DL23")
+    parser.add_argument("--query_mapping_path", type=str, default=None,
+                        help="DL23-style qid mapping file; marks the dataset as DL23")
+    parser.add_argument("--model_name", type=str, default=None,
+                        help="Model id recorded in the rubric (default: from each file name suffix)")
+    parser.add_argument("--model_alias", type=parse_model_alias, action="append", default=[],
+                        metavar="SHORT_NAME=MODEL_ID",
+                        help="Map a result file name suffix to a model id, in addition to the built-in ones "
+                             "(repeatable)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes")
+    parser.add_argument("--chunk_size", type=int, default=2000,
+                        help="Records per chunk (and per gzip member)")
+    parser.add_argument("--compresslevel", type=int, default=6, choices=range(0, 10),
+                        help="gzip compression level")
+    args = parser.parse_args()
+
+    log_paths = sorted({Path(p) for pattern in args.logs for p in glob.glob(pattern)})
+    if not log_paths:
+        raise FileNotFoundError(f"No log files match {args.logs}")
+
+    overrides = {
+        "qrel_path": args.test_qrel_path,
+        "queries_path": args.queries_path,
+        "docs_path": args.docs_path,
+        "doc_mapping_path": args.doc_mapping_path,
+        "query_mapping_path": args.query_mapping_path,
+    }
+    model_names = {**MODEL_NAMES, **dict(args.model_alias)}
+    groups: Dict[Tuple[str, bool], List[Path]] = {}
+    for log_path in log_paths:
+        dataset = args.dataset or infer_dataset(log_path)
+        groups.setdefault((dataset, is_compact_log(log_path)), []).append(log_path)
+    # Resolve every dataset before converting anything, so a missing path fails fast
+    datasets = {}
+    for dataset, compact in groups:
+        datasets[dataset] = resolve_dataset(dataset, overrides)
+        if compact and not all(key in datasets[dataset] for key in ("docs_path", "queries_path")):
+            raise ValueError(f"Compact logs of dataset {dataset!r} need --docs_path and --queries_path")
+
+    total_records = total_bytes = 0
+    start = time.perf_counter()
+    for (dataset, compact), paths in groups.items():
+        print(f"Dataset {dataset}: {len(paths)} log files")
+        with multiprocessing.Pool(args.workers, initializer=init_worker,
+                                  initargs=(datasets[dataset], compact)) as pool:
+            for log_path in paths:
+                model_name = args.model_name or infer_model_name(log_path, model_names)
+                output_file = rubric_path_for(log_path, args.output_dir)
+                file_start = time.perf_counter()
+                written, errors = convert_log(pool, log_path, output_file, model_name,
+                                              args.compresslevel, args.chunk_size, 2 * args.workers)
+                elapsed = time.perf_counter() - file_start
+                size = log_path.stat().st_size
+                total_records += written
+                total_bytes += size
+                print(f"{log_path} -> {output_file}: {written} records, {errors} errors, "
+                      f"{written / elapsed:,.0f} records/s, {size / elapsed / 1e6:.1f} MB/s")
+    elapsed = time.perf_counter() - start
+    print(f"Converted {len(log_paths)} logs, {total_records} records in {elapsed:.1f}s "
+          f"({total_records / elapsed:,.0f} records/s, {total_bytes / elapsed / 1e6:.1f} MB/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,19 @@ Handles loading and processing of queries, documents, and relevance judgments.
 """
 
 import os
+import re
+import json
+import mmap
+import tempfile
 import jsonlines
 import pandas as pd
-from typing import Dict, Tuple
+from collections.abc import Mapping
+from typing import Dict, Iterator, Optional, Tuple
 from tqdm import tqdm
 from pathlib import Path
 
-def load_data_files(docs_path: str, queries_path: str, test_qrel_path: str) -> Tuple[Dict[str, str], Dict[str, str], pd.DataFrame]:
+def load_data_files(docs_path: str, queries_path: str, test_qrel_path: str,
+                    lazy_docs: bool = True) -> Tuple[Dict[str, str], Dict[str, str], pd.DataFrame]:
     """
     Load all required data files for relevance evaluation.
     
@@ -18,6 +24,8 @@ def load_data_files(docs_path: str, queries_path: str, test_qrel_path: str) -> T
         docs_path: Path to documents JSONL file
         queries_path: Path to queries TSV file
         test_qrel_path: Path to relevance judgments file
+        lazy_docs: Serve documents from a memory-mapped `DocumentStore`
+            instead of loading the whole corpus into a dict
     
     Returns:
         Tuple containing:
@@ -25,7 +33,7 @@ def load_data_files(docs_path: str, queries_path: str, test_qrel_path: str) -> T
         - Query mapping (qid -> query text)
         - Relevance judgments DataFrame
     """
-    docid_to_doc = get_all_docid_to_doc(docs_path)
+    docid_to_doc = DocumentStore(docs_path) if lazy_docs else get_all_docid_to_doc(docs_path)
     qid_to_query = get_all_query_id_to_query(queries_path)
     test_qrel = pd.read_csv(
         test_qrel_path, 
@@ -51,6 +59,132 @@ def get_all_docid_to_doc(docs_path: str) -> Dict[str, str]:
             docid_to_doc[obj['docid']] = obj['doc']
     return docid_to_doc
 
+class DocumentStore(Mapping):
+    """
+    Read-only docid -> document text mapping over a documents JSONL file.
+    
+    A persistent index of byte offsets (`<docs_path>.idx`) is built on first
+    use and rebuilt whenever the source file's size or modification time
+    changes. The JSONL file is memory-mapped and a document is only decoded
+    when it is looked up, so resident memory stays proportional to the
+    number of docids rather than the corpus size.
+    """
+    INDEX_VERSION = 2
+
+    def __init__(self, docs_path: str, index_path: Optional[str] = None):
+        self.docs_path = Path(docs_path)
+        self.index_path = Path(index_path) if index_path else self.docs_path.with_name(self.docs_path.name + ".idx")
+        self.offsets = self._load_or_build_index()
+        self._file = open(self.docs_path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def _source_signature(self) -> Dict:
+        stat = self.docs_path.stat()
+        return {"version": self.INDEX_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _load_or_build_index(self) -> Dict:
+        signature = self._source_signature()
+        if self.index_path.exists():
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                try:
+                    header = json.loads(f.readline())
+                except json.JSONDecodeError:
+                    header = None
+                if header == signature:
+                    offsets = {}
+                    for line in f:
+                        key, offset = line.rstrip("\n").rsplit("\t", 1)
+                        offsets[decode_docid(key)] = int(offset)
+                    return offsets
+        return self._build_index(signature)
+
+    def _build_index(self, signature: Dict) -> Dict:
+        offsets = {}
+        with open(self.docs_path, 'rb') as f:
+            offset = 0
+            for line in tqdm(f, desc=f"Indexing {self.docs_path.name}", unit=" docs"):
+                if line.strip():
+                    offsets[read_docid(line)] = offset
+                offset += len(line)
+
+        # A temp file of our own, so concurrent builders (pool workers, shard
+        # processes) never write to the same file; the last os.replace wins
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.index_path.parent, prefix=self.index_path.name + ".",
+                                            suffix=".tmp")
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(signature) + "\n")
+                for docid, offset in offsets.items():
+                    f.write(f"{encode_docid(docid)}\t{offset}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            # Read-only corpus location: keep the index in memory only
+            print(f"Warning: could not write document index {self.index_path}: {e}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return offsets
+
+    def __getitem__(self, docid):
+        offset = self.offsets[docid]
+        end = self._mmap.find(b"\n", offset)
+        if end == -1:
+            end = len(self._mmap)
+        return json.loads(self._mmap[offset:end])['doc']
+
+    def __contains__(self, docid) -> bool:
+        return docid in self.offsets
+
+    def __iter__(self) -> Iterator:
+        return iter(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+# Documents usually start with their docid, which is then read without
+# decoding the rest of the line
+DOCID_PREFIX = re.compile(rb'\s*\{\s*"docid"\s*:\s*')
+DOCID_PEEK_BYTES = 256
+_json_decoder = json.JSONDecoder()
+
+def read_docid(line: bytes):
+    """
+    Return the docid of one documents JSONL line. Only the first bytes are
+    decoded when the line starts with the docid; other key orders and very
+    long docids fall back to parsing the whole line.
+    """
+    match = DOCID_PREFIX.match(line)
+    if match:
+        head = line[match.end():match.end() + DOCID_PEEK_BYTES].decode('utf-8', errors='ignore')
+        try:
+            docid, end = _json_decoder.raw_decode(head)
+        except json.JSONDecodeError:
+            docid, end = None, len(head)
+        # A value running to the end of the peeked bytes may have been cut short
+        if end < len(head) and head[end:].lstrip()[:1] in (",", "}"):
+            return docid
+    return json.loads(line)['docid']
+
+def encode_docid(docid) -> str:
+    """
+    Encode a docid for the offset index as JSON, which keeps its type (int or
+    str) and escapes tabs and newlines that would break the index lines.
+    """
+    return json.dumps(docid)
+
+def decode_docid(key: str):
+    """Inverse of `encode_docid`."""
+    return json.loads(key)
+
 def get_all_query_id_to_query(query_path: str) -> Dict[str, str]:
     """
     Load queries from TSV file into a dictionary.
@@ -99,4 +233,35 @@ def clean_files(*file_paths: str) -> None:
     """
     for file_path in file_paths:
         if file_path and Path(file_path).exists():
-            Path(file_path).unlink()
\ No newline at end of file
+            Path(file_path).unlink()
+
+def atomic_write_text(file_path: str, text: str) -> None:
+    """
+    Replace a file's contents atomically.
+    
+    The text is written and fsynced to a temporary sibling file which is then
+    renamed over the target, so readers (or a killed process) only ever see
+    the old or the new contents.
+    
+    Args:
+        file_path: Path of the file to replace
+        text: New file contents
+    """
+    path = Path(file_path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def fsync_file(file_path: str) -> None:
+    """
+    Flush a file written through other handles to stable storage.
+    
+    Args:
+        file_path: Path of the file to sync; missing files are ignored
+    """
+    if Path(file_path).exists():
+        with open(file_path, 'rb') as f:
+            os.fsync(f.fileno())
@@ -0,0 +1,95 @@
+"""
+Early stopping of local free generation.
+Kept apart from relevance_scoring because it subclasses a transformers
+class, and only runs that generate with a local model should import it.
+"""
+
+from typing import Dict
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from relevance_scoring import FINAL_SCORE_PATTERN, GENERATION_PARAMS
+
+
+class FinalScoreStoppingCriteria(StoppingCriteria):
+    """
+    Stop each generated sequence once it contains "##final score: X".
+    
+    Only the primary UMBRELA pattern ends a sequence: the looser fallbacks of
+    `find_first_number` ("O: X", a bare digit) could be overridden by a
+    "##final score" line generated later. Works for single prompts and for
+    left-padded batches, where all rows share the same prompt length; call
+    `begin()` (or `generation_kwargs()`) before each generate call it is
+    attached to.
+    
+    Only the last `WINDOW_TOKENS` generated tokens are decoded at each step:
+    a match that was not there one step earlier has to end in the newest
+    token, so checking the tail keeps the cost per step constant.
+
+    Also counts how many sequences stopped early, and for generate calls that
+    this criterion ended (every row stopped here or at an end-of-sequence
+    token), the decode steps left in the `max_new_tokens` budget. That is an
+    upper bound of the saving: rows might have ended on their own earlier.
+    """
+    # Generated tokens decoded per check; "##final score: X" takes well under this many
+    WINDOW_TOKENS = 24
+
+    def __init__(self, tokenizer, max_new_tokens: int = GENERATION_PARAMS["max_new_tokens"]):
+        self.tokenizer = tokenizer
+        self.max_new_tokens = max_new_tokens
+        eos_ids = {tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|eot_id|>")}
+        eos_ids.discard(None)
+        eos_ids.discard(tokenizer.unk_token_id)
+        self.eos_ids = torch.tensor(sorted(eos_ids), dtype=torch.long)
+        self.prompt_length = None
+        self.stopped = None
+        self.sequences = 0
+        self.stopped_early = 0
+        self.calls = 0
+        self.calls_ended = 0
+        self.steps_saved = 0
+
+    def begin(self):
+        """Mark the start of a new generate call."""
+        self.prompt_length = None
+
+    def generation_kwargs(self) -> Dict:
+        """Start a new generate call and return the kwargs that attach this criterion to it."""
+        self.begin()
+        return {"stopping_criteria": StoppingCriteriaList([self])}
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        current_length = input_ids.shape[1]
+        if self.prompt_length is None:
+            # First step of a new generate call: one token beyond the prompt
+            self.prompt_length = current_length - 1
+            self.stopped = torch.zeros(input_ids.shape[0], dtype=torch.bool)
+            self.sequences += input_ids.shape[0]
+            self.calls += 1
+
+        generated_length = current_length - self.prompt_length
+        window_start = max(self.prompt_length, current_length - self.WINDOW_TOKENS)
+        newly_stopped = False
+        for row in range(input_ids.shape[0]):
+            if self.stopped[row]:
+                continue
+            text = self.tokenizer.decode(input_ids[row, window_start:], skip_special_tokens=True)
+            if FINAL_SCORE_PATTERN.search(text):
+                self.stopped[row] = True
+                self.stopped_early += 1
+                newly_stopped = True
+        if newly_stopped:
+            generated = input_ids[:, self.prompt_length:].cpu()
+            ended = torch.isin(generated, self.eos_ids).any(dim=1)
+            if bool((self.stopped | ended).all()):
+                # This step ends the generate call for the whole batch
+                self.calls_ended += 1
+                self.steps_saved += max(self.max_new_tokens - generated_length, 0)
+        return self.stopped.clone().to(input_ids.device)
+
+    def report(self, mode: str):
+        """Print early-stop statistics for a prompt mode."""
+        print(f"Early stop [{mode}]: {self.stopped_early}/{self.sequences} sequences stopped at the final score; "
+              f"{self.calls_ended}/{self.calls} generate calls ended early, skipping at most "
+              f"{self.steps_saved} decode steps")
@@ -0,0 +1,231 @@
+"""
+Failure handling for judging runs.
+A pair that fails used to be written to cuda_errors/ with score 0 straight
+away. Failures are now classified first:
+
+- transient API errors (rate limits, timeouts, 5xx) go to a retry queue
+  and are judged again after a jittered exponential backoff;
+- out-of-memory errors split the batch in half and retry each half. When
+  the halves fit without any pair failing on its own, later batches of
+  the run are capped at the size that fit, and the cap is doubled again
+  after a run of batches without an out-of-memory error. A single pair
+  that still runs out of memory sets a per-pair token budget below its
+  prompt length; later pairs over the budget are not sent to the model;
+- anything else, and pairs out of retries or over the token budget, are
+  permanent: they are recorded in cuda_errors/ and counted in the summary,
+  but get no line in the TREC results, so they never count as a score of
+  0. A failing group of pairs is bisected first, so only the pairs that
+  fail on their own are recorded. Passages are never shortened, so every
+  judgment written is of the full pair.
+
+Results still come back in input order, so callers keep writing the TREC
+file and the log in qrel order.
+"""
+
+import sys
+import time
+from collections import deque
+from typing import Any, Callable, List, Optional, Tuple
+
+from model_utils import is_transient_api_error, backoff_delay
+
+OOM_ERROR_NAMES = {"OutOfMemoryError", "MemoryError"}
+
+
+def is_out_of_memory_error(error: Exception) -> bool:
+    """Tell CUDA and CPU allocation failures from other errors."""
+    if type(error).__name__ in OOM_ERROR_NAMES:
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+
+def classify_failure(error: Exception) -> str:
+    """Return "oom", "transient" or "permanent"."""
+    if is_out_of_memory_error(error):
+        return "oom"
+    if is_transient_api_error(error):
+        return "transient"
+    return "permanent"
+
+
+def release_cached_memory():
+    """Hand the CUDA caching allocator's free blocks back before retrying (when torch is in use)."""
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class TokenBudgetExceeded(Exception):
+    """A pair whose prompt is longer than the per-pair token budget learned from out-of-memory errors."""
+    def __init__(self, tokens: int, budget: int):
+        super().__init__(f"prompt of {tokens} tokens exceeds the per-pair budget of {budget} tokens "
+                         f"set after a pair ran out of memory on its own")
+        self.tokens = tokens
+        self.budget = budget
+
+
+class FailureHandler:
+    """
+    Runs judging calls on groups of items and recovers from failures.
+
+    Args:
+        max_retries: Retries of a transient failure before it is permanent
+        backoff_base: Base delay in seconds of the retry backoff
+        backoff_cap: Longest delay in seconds between two retries
+        relax_after: Calls without an out-of-memory error after which the
+            batch size cap is doubled
+    """
+    def __init__(self, max_retries: int = 5, backoff_base: float = 1.0, backoff_cap: float = 60.0,
+                 relax_after: int = 20):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.relax_after = relax_after
+        self.batch_cap: Optional[int] = None
+        self.largest_call = 0
+        self.calls_since_oom = 0
+        self.token_budget: Optional[int] = None
+
+        self.retried = 0
+        self.recovered = 0
+        self.downsized = 0
+        self.over_budget = 0
+        self.gave_up = 0
+
+    def split(self, batch: List) -> List[List]:
+        """Cut a planned batch into chunks that respect the size cap learned from earlier OOMs."""
+        if self.batch_cap is None or len(batch) <= self.batch_cap:
+            return [batch]
+        return [batch[i:i + self.batch_cap] for i in range(0, len(batch), self.batch_cap)]
+
+    def run(self, items: List, judge: Callable[[List], List],
+            item_tokens: Optional[Callable[[Any], int]] = None) -> List:
+        """
+        Judge `items` with `judge` (items in, one result per item out).
+
+        Args:
+            items: Items of one call, e.g. (qidx, docidx, query, passage) pairs
+            judge: Judging call; may raise for the whole group
+            item_tokens: Prompt length in tokens of an item; enables the
+                per-pair token budget. Only called once a pair has run out
+                of memory on its own
+
+        Returns:
+            One result per item, in input order; permanent failures are
+            returned as the exception instead of a result
+        """
+        outcomes = [None] * len(items)
+        retry_queue = deque()
+        transient = set()
+        downsized = set()
+        indices = list(range(len(items)))
+        if self.token_budget is not None and item_tokens is not None:
+            indices = [i for i in indices if not self.over_token_budget(items, i, item_tokens, outcomes)]
+        self.largest_call = max(self.largest_call, len(indices))
+        if indices:
+            self.judge_group(items, indices, judge, item_tokens, outcomes, retry_queue, downsized, attempt=0)
+        while retry_queue:
+            indices, attempt, not_before = retry_queue.popleft()
+            transient.update(indices)
+            delay = not_before - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.judge_group(items, indices, judge, item_tokens, outcomes, retry_queue, downsized, attempt)
+        self.retried += len(transient)
+        self.recovered += sum(1 for i in transient if not isinstance(outcomes[i], Exception))
+        self.downsized += len(downsized)
+        self.relax_cap(ran_out_of_memory=bool(downsized))
+        return outcomes
+
+    def relax_cap(self, ran_out_of_memory: bool):
+        """Double the batch size cap after `relax_after` calls without an out-of-memory error."""
+        if ran_out_of_memory or self.batch_cap is None:
+            self.calls_since_oom = 0
+            return
+        self.calls_since_oom += 1
+        if self.calls_since_oom >= self.relax_after:
+            self.calls_since_oom = 0
+            self.batch_cap *= 2
+            if self.batch_cap >= self.largest_call:
+                self.batch_cap = None
+
+    def over_token_budget(self, items, i, item_tokens, outcomes) -> bool:
+        """Record item `i` as failed if its prompt is longer than the per-pair token budget."""
+        tokens = item_tokens(items[i])
+        if tokens <= self.token_budget:
+            return False
+        self.over_budget += 1
+        outcomes[i] = TokenBudgetExceeded(tokens, self.token_budget)
+        return True
+
+    def judge_group(self, items, indices, judge, item_tokens, outcomes, retry_queue, downsized,
+                    attempt) -> Tuple[int, bool]:
+        """
+        Judge `indices` of `items`, splitting them or queueing them for a
+        retry on failure.
+
+        Returns:
+            The largest group size that was judged in one call (0 if none),
+            and whether a single pair ran out of memory on its own
+        """
+        try:
+            results = judge([items[i] for i in indices])
+        except Exception as e:
+            kind = classify_failure(e)
+            if kind == "oom":
+                release_cached_memory()
+                if len(indices) > 1:
+                    downsized.update(indices)
+                    fitted, single_oom = self.judge_halves(items, indices, judge, item_tokens, outcomes,
+                                                           retry_queue, downsized, attempt)
+                    # Only cap the batch size when the halves fit as a whole; an over-long
+                    # pair that fails on its own says nothing about the batch size
+                    if fitted and not single_oom:
+                        self.batch_cap = fitted if self.batch_cap is None else min(self.batch_cap, fitted)
+                    return fitted, single_oom
+                if item_tokens is not None:
+                    # Prompts at least this long will not fit either; fail them up front from now on
+                    budget = item_tokens(items[indices[0]]) - 1
+                    self.token_budget = budget if self.token_budget is None else min(self.token_budget, budget)
+                self.gave_up += 1
+                outcomes[indices[0]] = e
+                return 0, True
+            elif kind == "transient" and attempt < self.max_retries:
+                not_before = time.monotonic() + backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+                retry_queue.append((indices, attempt + 1, not_before))
+                return 0, False
+            if len(indices) > 1:
+                # Isolate the pairs that fail on their own
+                return self.judge_halves(items, indices, judge, item_tokens, outcomes, retry_queue,
+                                         downsized, attempt)
+            self.gave_up += len(indices)
+            for i in indices:
+                outcomes[i] = e
+            return 0, False
+        for i, result in zip(indices, results):
+            outcomes[i] = result
+        return len(indices), False
+
+    def judge_halves(self, items, indices, judge, item_tokens, outcomes, retry_queue, downsized,
+                     attempt) -> Tuple[int, bool]:
+        """Judge both halves of `indices` with `judge_group` and combine what they return."""
+        half = len(indices) // 2
+        fitted, single_oom = 0, False
+        for part in (indices[:half], indices[half:]):
+            part_fitted, part_single_oom = self.judge_group(items, part, judge, item_tokens, outcomes,
+                                                            retry_queue, downsized, attempt)
+            fitted = max(fitted, part_fitted)
+            single_oom = single_oom or part_single_oom
+        return fitted, single_oom
+
+    def report(self):
+        """Print how many pairs were retried, downsized, over the token budget or given up on (if any)."""
+        if not (self.retried or self.downsized or self.over_budget or self.gave_up):
+            return
+        cap = f", batch size capped at {self.batch_cap}" if self.batch_cap is not None else ""
+        budget = f" (budget {self.token_budget} tokens)" if self.token_budget is not None else ""
+        print(f"Failure handling: {self.retried} pairs retried after transient errors "
+              f"({self.recovered} recovered), {self.downsized} pairs re-run in smaller batches after "
+              f"running out of memory{cap}, {self.over_budget} pairs over the per-pair token budget{budget}, "
+              f"{self.gave_up} pairs given up on")
@@ -0,0 +1,423 @@
+"""
+Judging service.
+Loads a backend once through `get_model_baseline` and answers relevance
+judgment requests over local HTTP, either on a TCP port bound to localhost
+or on a Unix socket. Concurrent requests are gathered into micro-batches:
+the batcher takes the first waiting request, then keeps collecting for at
+most `--max_wait_ms` or until `--max_batch` requests are in hand, and judges
+each prompt mode's share of the batch with one model call (local models) or
+in parallel (API backends). A batch that fails goes through the same
+`FailureHandler` as the batch path of `grade_pq_pairs` (retries of
+transient API errors, halving on out of memory), so only the requests that
+fail on their own get an error.
+
+Endpoints:
+    POST /judge   {"query": ..., "passage": ..., "prompt_mode": ..., "qid": ..., "docid": ...}
+                  (prompt_mode defaults to --prompt_mode; qid and docid are
+                  optional and only copied into the scoring log)
+                  -> {"final_relevance_score": ..., "scoring_log": {...}},
+                  the pair `grade_each_pq_pair` returns
+    GET  /stats   queue depth, batch sizes and latency percentiles
+    GET  /health  {"status": "ok", "model_id": ...}
+
+Usage:
+    python src/judge_server.py --model_id meta-llama/Meta-Llama-3-8B-Instruct \\
+        --prompt_mode zeroshot_bing --port 8800 --max_batch 8 --max_wait_ms 10
+    curl -s localhost:8800/judge -d '{"query": "...", "passage": "..."}'
+
+    With --unix_socket /tmp/judge.sock:
+    curl -s --unix-socket /tmp/judge.sock http://localhost/judge -d '{...}'
+"""
+
+import os
+import json
+import time
+import queue
+import signal
+import argparse
+import threading
+import socketserver
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from model_utils import TogetherPipeline, OpenAICompatiblePipeline, get_model_baseline
+from relevance_scoring import grade_pq_pair_batch
+from judgment_cache import JudgmentCache
+from failure_handling import FailureHandler
+from prompts import get_prompt_registry
+
+
+class JudgeRequest:
+    """One pending judgment and the event its HTTP handler waits on."""
+    def __init__(self, query: str, passage: str, mode: str, qid=None, docid=None):
+        self.query = query
+        self.passage = passage
+        self.mode = mode
+        self.qid = qid
+        self.docid = docid
+        self.enqueued = time.perf_counter()
+        self.started = None
+        self.done = threading.Event()
+        self.result: Optional[Tuple[int, Dict]] = None
+        self.error: Optional[Exception] = None
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class ServiceStats:
+    """Request, batch and latency counters of the service; latencies cover the last `window` requests."""
+    def __init__(self, window: int = 10000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.max_batch_seen = 0
+        self.latencies = deque(maxlen=window)
+        self.queue_waits = deque(maxlen=window)
+
+    def record_batch(self, size: int):
+        with self.lock:
+            self.batches += 1
+            self.batched_requests += size
+            self.max_batch_seen = max(self.max_batch_seen, size)
+
+    def record_request(self, request: JudgeRequest, finished: float):
+        with self.lock:
+            self.requests += 1
+            self.errors += request.error is not None
+            self.latencies.append(finished - request.enqueued)
+            self.queue_waits.append(request.started - request.enqueued)
+
+    def to_dict(self, queue_depth: int, in_flight: int) -> Dict:
+        with self.lock:
+            latencies = sorted(self.latencies)
+            queue_waits = sorted(self.queue_waits)
+            return {
+                "uptime_seconds": time.time() - self.started,
+                "queue_depth": queue_depth,
+                "in_flight": in_flight,
+                "requests": self.requests,
+                "errors": self.errors,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_requests / self.batches if self.batches else 0.0,
+                "max_batch_size": self.max_batch_seen,
+                "latency_ms": {name: percentile(latencies, fraction) * 1000
+                               for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+                "queue_wait_ms": {name: percentile(queue_waits, fraction) * 1000
+                                  for name, fraction in (("p50", 0.5), ("p95", 0.95))},
+            }
+
+
+class MicroBatcher:
+    """
+    Gathers concurrent judge requests into micro-batches on one worker thread.
+
+    Args:
+        pipeline: Backend returned by `get_model_baseline`
+        system_message: System message (empty for UMBRELA)
+        cache: Optional JudgmentCache consulted before every model call
+        scoring: "generate" or "logits" (not on Together)
+        stopping_criterion: Optional early stop for local free generation
+        max_batch: Most requests judged together
+        max_wait_ms: Longest a request waits for others to join its batch
+        api_workers: Parallel requests per batch on the Together backend
+        failure_handler: Retries, splits and isolates failing batches
+            (default: a `FailureHandler` with its default retries)
+    """
+    def __init__(self, pipeline, system_message: str = "", cache=None,
+                 scoring: str = "generate", stopping_criterion=None,
+                 max_batch: int = 8, max_wait_ms: float = 10.0, api_workers: int = 8,
+                 failure_handler: Optional[FailureHandler] = None):
+        self.pipeline = pipeline
+        self.system_message = system_message
+        self.cache = cache
+        self.scoring = scoring
+        self.stopping_criterion = stopping_criterion
+        self.failure_handler = failure_handler or FailureHandler()
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.requests: "queue.Queue[JudgeRequest]" = queue.Queue()
+        self.stats = ServiceStats()
+        self.in_flight = 0
+        # The Together backend has no batched call, so a batch fans out over threads
+        # (OpenAI-compatible backends send a batch's requests in parallel themselves)
+        self.api_executor = None
+        if isinstance(pipeline, TogetherPipeline) and not isinstance(pipeline, OpenAICompatiblePipeline):
+            self.api_executor = ThreadPoolExecutor(api_workers)
+        self.stopping = threading.Event()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.worker.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.worker.join()
+        if self.api_executor is not None:
+            self.api_executor.shutdown()
+
+    def submit(self, request: JudgeRequest, timeout: Optional[float] = None) -> Tuple[int, Dict]:
+        """Queue a request and block until it is judged; re-raises the judging error, if any."""
+        self.requests.put(request)
+        if not request.done.wait(timeout):
+            raise TimeoutError(f"No judgment within {timeout}s")
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def next_batch(self) -> List[JudgeRequest]:
+        """Block for the first request, then collect more until the batch is full or its wait is over."""
+        while not self.stopping.is_set():
+            try:
+                batch = [self.requests.get(timeout=0.1)]
+                break
+            except queue.Empty:
+                continue
+        else:
+            return []
+        deadline = batch[0].enqueued + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def judge(self, requests: List[JudgeRequest]):
+        """Judge requests that share a prompt mode and hand each its result or error."""
+        pairs = [(request.qid, request.docid, request.query, request.passage) for request in requests]
+        mode = requests[0].mode
+
+        def judge_pairs(group):
+            if self.api_executor is not None:
+                return list(self.api_executor.map(
+                    lambda pair: grade_pq_pair_batch([pair], self.pipeline, None, self.system_message,
+                                                     mode, self.cache, self.scoring)[0],
+                    group))
+            return grade_pq_pair_batch(group, self.pipeline, None, self.system_message, mode,
+                                       self.cache, self.scoring, self.stopping_criterion)
+
+        pair_tokens = None
+        if not isinstance(self.pipeline, TogetherPipeline):
+            def pair_tokens(pair):
+                return len(get_prompt_registry().encode_pair(pair[2], pair[3], mode, self.pipeline.tokenizer,
+                                                             self.system_message))
+
+        try:
+            outcomes = []
+            for batch in self.failure_handler.split(list(range(len(pairs)))):
+                outcomes.extend(self.failure_handler.run([pairs[i] for i in batch], judge_pairs, pair_tokens))
+        except Exception as e:
+            outcomes = [e] * len(requests)
+        for request, outcome in zip(requests, outcomes):
+            if isinstance(outcome, Exception):
+                request.error = outcome
+            else:
+                request.result = outcome
+        finished = time.perf_counter()
+        for request in requests:
+            self.stats.record_request(request, finished)
+            request.done.set()
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                return
+            started = time.perf_counter()
+            self.in_flight = len(batch)
+            self.stats.record_batch(len(batch))
+            by_mode: Dict[str, List[JudgeRequest]] = {}
+            for request in batch:
+                request.started = started
+                by_mode.setdefault(request.mode, []).append(request)
+            for requests in by_mode.values():
+                self.judge(requests)
+            self.in_flight = 0
+
+    def stats_dict(self) -> Dict:
+        return self.stats.to_dict(self.requests.qsize(), self.in_flight)
+
+
+class JudgeRequestHandler(BaseHTTPRequestHandler):
+    """HTTP front end of the service; `self.server` carries the batcher and its settings."""
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status: int, body: Dict):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.batcher.stats_dict())
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok", "model_id": self.server.model_id})
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/judge":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not isinstance(body, dict):
+                raise TypeError(f"expected a JSON object, got {type(body).__name__}")
+            mode = body.get("prompt_mode", self.server.default_mode)
+            get_prompt_registry().validate(mode)
+            request = JudgeRequest(body["query"], body["passage"], mode, body.get("qid"), body.get("docid"))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": f"Bad request: {e}"})
+            return
+        try:
+            final_score, scoring_log = self.server.batcher.submit(request, self.server.request_timeout)
+        except TimeoutError as e:
+            self.send_json(504, {"error": str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self.send_json(200, {"final_relevance_score": final_score, "scoring_log": scoring_log})
+
+    def log_message(self, format, *args):
+        # One line per request would drown the service output
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(batcher: MicroBatcher, model_id: str, default_mode: str,
+                host: str = "127.0.0.1", port: int = 8800, unix_socket: Optional[str] = None,
+                request_timeout: Optional[float] = None):
+    """Create the HTTP server (TCP, or a Unix socket when `unix_socket` is given) in front of `batcher`."""
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        server = UnixHTTPServer(unix_socket, JudgeRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), JudgeRequestHandler)
+        server.daemon_threads = True
+    server.batcher = batcher
+    server.model_id = model_id
+    server.default_mode = default_mode
+    server.request_timeout = request_timeout
+    return server
+
+
+def raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Serve UMBRELA relevance judgments from a model loaded once.")
+    parser.add_argument("--model_id", type=str, required=True,
+                      help="Model ID or path")
+    parser.add_argument("-together", action="store_true",
+                      help="Use the Together API instead of a local model")
+    parser.add_argument("--openai_base_url", type=str, default=None,
+                      help="Use the model --model_id served by an OpenAI-compatible server at this URL")
+    parser.add_argument("--api_timeout", type=float, default=120.0,
+                      help="Seconds before a request to --openai_base_url times out and is retried")
+    parser.add_argument("--device", type=str, default="auto", choices=["auto", "cpu"],
+                      help="'auto' places the model on the available GPUs; 'cpu' runs it on the CPU")
+    parser.add_argument("--quant", type=str, default=None, choices=["int8"],
+                      help="'int8': dynamic int8 quantisation of the linear layers (needs --device cpu)")
+    parser.add_argument("--num_threads", type=int, default=None,
+                      help="CPU threads for --device cpu (default: OMP_NUM_THREADS or the available cores)")
+    parser.add_argument("--prompt_mode", type=str, default="zeroshot_bing",
+                      help="Prompt mode of requests that do not name one")
+    parser.add_argument("--scoring", type=str, default="generate", choices=["generate", "logits"],
+                      help="'generate': free generation and regex parsing; 'logits': grade logits (local models) or grade logprobs (--openai_base_url)")
+    parser.add_argument("--early_stop", action="store_true",
+                      help="Stop local free generation once '##final score: X' has been emitted")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                      help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=8800,
+                      help="TCP port to listen on")
+    parser.add_argument("--unix_socket", type=str, default=None,
+                      help="Listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--max_batch", type=int, default=8,
+                      help="Most requests judged in one micro-batch")
+    parser.add_argument("--max_wait_ms", type=float, default=10.0,
+                      help="Longest a request waits for others to join its micro-batch")
+    parser.add_argument("--api_workers", type=int, default=8,
+                      help="Parallel API requests per micro-batch (pooled connections with --openai_base_url)")
+    parser.add_argument("--request_timeout", type=float, default=None,
+                      help="Seconds a request may wait for its judgment before the server answers 504")
+    parser.add_argument("--cache_dir", type=str, default="./cache",
+                      help="Directory of the persistent judgment cache")
+    parser.add_argument("--no_cache", action="store_true",
+                      help="Disable the judgment cache")
+    parser.add_argument("--cache_max_entries", type=int, default=1_000_000,
+                      help="Maximum number of cached judgments before the oldest are evicted")
+    parser.add_argument("--max_retries", type=int, default=5,
+                      help="Retries of a request after transient API errors (rate limits, timeouts, 5xx) before it fails")
+    parser.add_argument("--retry_backoff", type=float, default=1.0,
+                      help="Base delay in seconds of the exponential backoff between retries")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.scoring == "logits" and args.together:
+        raise ValueError("--scoring logits needs a local model and cannot be used with -together")
+    get_prompt_registry().validate(args.prompt_mode)
+    api_backend = args.together or args.openai_base_url
+    if not api_backend:
+        from main import probe_device
+        probe_device()
+    pipeline = get_model_baseline(args.model_id, args.together,
+                                  max_in_flight=args.api_workers if args.openai_base_url else None,
+                                  device=args.device, quant=args.quant, num_threads=args.num_threads,
+                                  base_url=args.openai_base_url, timeout=args.api_timeout,
+                                  # The batcher's FailureHandler retries, so the pipeline must not retry too
+                                  max_retries=0, retry_backoff=args.retry_backoff)
+    cache = None if args.no_cache else JudgmentCache(args.cache_dir, args.model_id, args.cache_max_entries)
+    stopping_criterion = None
+    if args.early_stop and args.scoring == "generate" and not api_backend:
+        from early_stop import FinalScoreStoppingCriteria
+        stopping_criterion = FinalScoreStoppingCriteria(pipeline.tokenizer)
+
+    batcher = MicroBatcher(pipeline, "", cache, args.scoring, stopping_criterion,
+                           args.max_batch, args.max_wait_ms, args.api_workers,
+                           FailureHandler(args.max_retries, args.retry_backoff))
+    server = make_server(batcher, args.model_id, args.prompt_mode, args.host, args.port,
+                         args.unix_socket, args.request_timeout)
+    batcher.start()
+    # Shut down cleanly (final stats, cache closed, socket removed) on SIGTERM as on Ctrl-C
+    signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+    address = args.unix_socket or f"http://{args.host}:{args.port}"
+    print(f"Judging with {args.model_id} on {address} "
+          f"(micro-batches of up to {args.max_batch}, {args.max_wait_ms:g} ms max wait)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+        print(json.dumps(batcher.stats_dict()))
+        batcher.failure_handler.report()
+        if cache is not None:
+            cache.close()
+        if args.unix_socket is not None and os.path.exists(args.unix_socket):
+            os.unlink(args.unix_socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Persistent judgment cache.
+Stores raw model outputs and parsed scores in a single SQLite file so that
+re-running a configuration (or judging passages shared between datasets)
+does not pay for the same LLM call twice.
+"""
+
+import json
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+
+class JudgmentCache:
+    """
+    Content-addressed, size-bounded LRU cache of LLM judgments.
+
+    Keys are SHA-256 hashes of the model id, the generation parameters and the
+    rendered prompt; values are the raw `LLMs_output`, the parsed score and any
+    extra judgment fields (such as the logits score distribution).
+    """
+
+    # Evict at most once per this many insertions to keep writes cheap
+    EVICTION_INTERVAL = 1000
+    # Write LRU touches of cache hits in one transaction per this many hits
+    TOUCH_FLUSH_INTERVAL = 100
+    # How long a statement waits for another process's write lock
+    BUSY_TIMEOUT_MS = 10000
+
+    def __init__(self, cache_dir: str, model_id: str, max_entries: int = 1_000_000):
+        self.path = Path(cache_dir) / "judgments.sqlite"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.inserts_since_eviction = 0
+        self.touched: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False,
+                                          timeout=self.BUSY_TIMEOUT_MS / 1000)
+        self.connection.execute(f"PRAGMA busy_timeout={self.BUSY_TIMEOUT_MS}")
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS judgments ("
+            " key TEXT PRIMARY KEY,"
+            " llms_output TEXT NOT NULL,"
+            " final_score INTEGER NOT NULL,"
+            " last_access INTEGER NOT NULL,"
+            " details TEXT)"
+        )
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(judgments)")}
+        if "details" not in columns:
+            self.connection.execute("ALTER TABLE judgments ADD COLUMN details TEXT")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS judgments_last_access ON judgments (last_access)"
+        )
+        self.connection.commit()
+        row = self.connection.execute("SELECT MAX(last_access) FROM judgments").fetchone()
+        self.clock = row[0] or 0
+
+    def make_key(self, rendered_prompt: str, generation_params: Dict) -> str:
+        """Hash the model id, generation parameters and rendered prompt into a cache key."""
+        material = json.dumps(
+            [self.model_id, generation_params, rendered_prompt],
+            sort_keys=True, ensure_ascii=False
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Return the cached judgment for a key, or None on a miss.
+
+        A database error (e.g. another process holding the write lock past
+        the busy timeout) counts as a miss, so the pair is judged instead.
+        """
+        with self.lock:
+            try:
+                row = self.connection.execute(
+                    "SELECT llms_output, final_score, details FROM judgments WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                self.database_error("lookup", e)
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.clock += 1
+            self.touched[key] = self.clock
+            if len(self.touched) >= self.TOUCH_FLUSH_INTERVAL:
+                self.flush_touches()
+            judgment = {"LLMs_output": row[0], "final_relevance_score": row[1]}
+            if row[2]:
+                judgment.update(json.loads(row[2]))
+            return judgment
+
+    def put(self, key: str, judgment: Dict):
+        """
+        Store a judgment, evicting least recently used entries past `max_entries`.
+
+        A database error skips the write (with a warning) instead of failing
+        the pair that was just judged.
+        """
+        details = {k: v for k, v in judgment.items()
+                   if k not in ("LLMs_output", "final_relevance_score")}
+        with self.lock:
+            self.clock += 1
+            self.touched.pop(key, None)
+            try:
+                self.write_touches()
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO judgments "
+                    "(key, llms_output, final_score, last_access, details) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, judgment["LLMs_output"], judgment["final_relevance_score"], self.clock,
+                     json.dumps(details) if details else None)
+                )
+                self.connection.commit()
+                self.inserts_since_eviction += 1
+                if self.inserts_since_eviction >= self.EVICTION_INTERVAL:
+                    self.evict()
+            except sqlite3.Error as e:
+                self.database_error("write", e)
+
+    def write_touches(self):
+        """Write the pending LRU touches of cache hits (inside the caller's transaction)."""
+        if self.touched:
+            self.connection.executemany(
+                "UPDATE judgments SET last_access = ? WHERE key = ?",
+                [(clock, key) for key, clock in self.touched.items()]
+            )
+            self.touched.clear()
+
+    def flush_touches(self):
+        """Commit the pending LRU touches in one short transaction, so no lock is held between calls."""
+        try:
+            self.write_touches()
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self.database_error("LRU update", e)
+
+    def database_error(self, operation: str, error: sqlite3.Error):
+        """Roll back the failed statement and warn once; the cache is an optimisation only."""
+        try:
+            self.connection.rollback()
+        except sqlite3.Error:
+            pass
+        self.touched.clear()
+        if not self.errors:
+            print(f"Warning: judgment cache {operation} failed ({error}); "
+                  f"continuing without the cache for this pair")
+        self.errors += 1
+
+    def evict(self):
+        """Drop the least recently used entries beyond `max_entries`."""
+        self.inserts_since_eviction = 0
+        (count,) = self.connection.execute("SELECT COUNT(*) FROM judgments").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                "DELETE FROM judgments WHERE key IN "
+                "(SELECT key FROM judgments ORDER BY last_access LIMIT ?)",
+                (excess,)
+            )
+            self.connection.commit()
+
+    def report(self):
+        """Print hit/miss counters for the run."""
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        errors = f", {self.errors} database errors" if self.errors else ""
+        print(f"Judgment cache: {self.hits} hits, {self.misses} misses "
+              f"({hit_rate:.1%} hit rate){errors} in {self.path}")
+
+    def close(self):
+        """Write pending LRU touches, apply pending evictions and close the database."""
+        with self.lock:
+            try:
+                self.write_touches()
+                self.evict()
+                self.connection.commit()
+            except sqlite3.Error as e:
+                self.database_error("close", e)
+            self.connection.close()
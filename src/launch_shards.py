@@ -0,0 +1,124 @@
+"""
+Local sharded launcher.
+Runs one `main.py --num_shards N --shard_id i` process per shard, each with
+its own model instance, then merges the shard outputs into the files a
+single-process run would have written and converts the merged log to rubric
+format. Shards are pinned to GPUs round-robin with `--devices`; on CPU each
+shard gets an equal share of the cores. All shards share the job's
+`--cache_dir`, so a re-run or resumed run is served from the judgments any
+shard cached (benchmarks/bench_shared_cache.py checks that concurrent
+shards do not lock each other out of it).
+
+Usage:
+    python src/launch_shards.py --num_shards 4 --devices 0,1,2,3 -- \\
+        --model_id meta-llama/Meta-Llama-3-8B-Instruct \\
+        --test_qrel_path ./data/dl2020/2020qrels-pass.txt \\
+        --queries_path ./data/dl2020/msmarco-test2020-queries.tsv \\
+        --docs_path ./data/dl2020/dl2020_document.jsonl \\
+        --prompt_mode zeroshot_bing \\
+        --result_file_path ./results/dl20_test_zeroshot_bing_Llama-3-8B-Instruct.txt
+
+Across machines, run `main.py ... --num_shards N --shard_id i` on each node
+against shared storage, then `python src/sharding.py` to merge.
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+from pathlib import Path
+
+from main import build_parser, validate_job
+from sharding import merge_shards, shard_result_path
+
+
+def shard_env(shard_id: int, devices, threads: int) -> dict:
+    """Environment of one shard process: its GPU, or its share of the CPU threads."""
+    env = dict(os.environ)
+    if devices:
+        env["CUDA_VISIBLE_DEVICES"] = devices[shard_id % len(devices)]
+    else:
+        env["CUDA_VISIBLE_DEVICES"] = ""
+        env["OMP_NUM_THREADS"] = str(threads)
+        env["MKL_NUM_THREADS"] = str(threads)
+    # Each shard is already one of several processes sharing the cores
+    env["TOKENIZERS_PARALLELISM"] = "false"
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a judging job as parallel shard processes and merge their outputs.",
+        usage="%(prog)s --num_shards N [--devices 0,1] [--threads_per_shard K] -- <main.py options>")
+    parser.add_argument("--num_shards", type=int, required=True,
+                        help="Number of shard processes")
+    parser.add_argument("--devices", type=str, default=None,
+                        help="Comma-separated CUDA devices assigned to shards round-robin (default: CPU)")
+    parser.add_argument("--threads_per_shard", type=int, default=None,
+                        help="CPU threads per shard (default: cores / shards)")
+    parser.add_argument("--no_merge", action="store_true",
+                        help="Leave the shard outputs unmerged")
+    args, job_argv = parser.parse_known_args()
+    if job_argv and job_argv[0] == "--":
+        job_argv = job_argv[1:]
+
+    job = build_parser().parse_args(job_argv)
+    job.num_shards = args.num_shards
+    validate_job(job)
+    devices = args.devices.split(",") if args.devices else []
+    threads = args.threads_per_shard or max(1, (os.cpu_count() or 1) // args.num_shards)
+    main_py = str(Path(__file__).with_name("main.py"))
+
+    start = time.perf_counter()
+    processes = []
+    for shard_id in range(args.num_shards):
+        shard_path = Path(shard_result_path(job.result_file_path, args.num_shards, shard_id))
+        stdout_path = shard_path.parent / "logs" / shard_path.name.replace(".txt", ".stdout")
+        stdout_path.parent.mkdir(parents=True, exist_ok=True)
+        command = [sys.executable, main_py, *job_argv,
+                   "--num_shards", str(args.num_shards), "--shard_id", str(shard_id), "--rubric", "off"]
+        stdout = open(stdout_path, 'w')
+        processes.append((shard_id, subprocess.Popen(command, stdout=stdout, stderr=subprocess.STDOUT,
+                                                     env=shard_env(shard_id, devices, threads)),
+                          stdout, stdout_path))
+        print(f"Shard {shard_id}: pid {processes[-1][1].pid}, output in {stdout_path}")
+
+    failed = []
+    for shard_id, process, stdout, stdout_path in processes:
+        returncode = process.wait()
+        stdout.close()
+        if returncode != 0:
+            failed.append(shard_id)
+            print(f"Shard {shard_id} exited with code {returncode}; see {stdout_path}")
+    print(f"Shards finished in {time.perf_counter() - start:.1f}s")
+    if failed:
+        sys.exit(f"Shards {failed} failed; rerun with --resume to finish them before merging")
+    if args.no_merge:
+        return
+
+    from data_processing import load_data_files
+    docid_to_doc, qid_to_query, test_qrel = load_data_files(
+        job.docs_path, job.queries_path, job.test_qrel_path, lazy_docs=not job.eager_docs)
+    counts = merge_shards(test_qrel, job.result_file_path, args.num_shards, job.max_pairs)
+    print(f"Merged {args.num_shards} shards into {job.result_file_path}: {counts['pairs']} pairs, "
+          f"{counts['failed']} failed, {counts['duplicate_judgments']} duplicate judgments and "
+          f"{counts['duplicate_records']} duplicate log records dropped")
+
+    if job.rubric != "off":
+        from compact_log import LOG_SUFFIXES
+        from make_rubric_format import process_log_to_rubric
+        result_path = Path(job.result_file_path)
+        process_log_to_rubric(
+            input_file=result_path.parent / "logs" / result_path.name.replace(".txt", LOG_SUFFIXES[job.log_format]),
+            output_file=result_path.parent / "rubric_format" / result_path.name.replace(".txt", "_rubric.jsonl.gz"),
+            qrel_file_path=job.test_qrel_path,
+            is_dl23="2019" not in job.docs_path and "2020" not in job.docs_path,
+            model_name=job.model_id,
+            docid_to_doc=docid_to_doc,
+            qid_to_query=qid_to_query
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,36 @@
-import torch
 import argparse
 import os
 import logging
+from functools import lru_cache
 from typing import Optional
 from pathlib import Path
-from data_processing import load_data_files, clean_files
+from data_processing import load_data_files
 from model_utils import get_model_baseline
 # from prompts import create_system_message
 from relevance_processors import grade_pq_pairs
-from make_rubric_format import process_log_to_rubric
+from judgment_cache import JudgmentCache
+from prompts import get_prompt_registry
+from make_rubric_format import process_log_to_rubric, RubricWriter
+from cascade import CascadeJudge
+from compact_log import LOG_SUFFIXES
+from sharding import select_shard, shard_result_path
+from metrics import RunMetrics, activate_metrics
 
-def setup_logging_and_device():
+def setup_logging():
+    logging.basicConfig(level=logging.WARNING)
+    return logging.getLogger(__name__)
+
+@lru_cache(maxsize=None)
+def probe_device():
+    """
+    Print the PyTorch and CUDA setup once per process. Imports torch, so it
+    is only called when a local model is loaded.
+    """
+    os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
+    import torch
     print(f"PyTorch version: {torch.__version__}")
     print(f"CUDA available: {torch.cuda.is_available()}")
     print(f"CUDA version: {torch.version.cuda}")
-    logging.basicConfig(level=logging.WARNING)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     
     # Add these print statements to confirm
@@ -25,11 +41,12 @@ def setup_logging_and_device():
     if torch.cuda.is_available():
         print(f"Current CUDA device name: {torch.cuda.get_device_name(0)}")
         print(f"CUDA device count: {torch.cuda.device_count()}")
-    
-    os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
-    return logging.getLogger(__name__), device
+    return device
 
-def parse_arguments():
+# Options of build_parser without a default, which every run (and every run_jobs job) sets
+REQUIRED_OPTIONS = ["model_id", "test_qrel_path", "queries_path", "docs_path", "result_file_path"]
+
+def build_parser() -> argparse.ArgumentParser:
     
     parser = argparse.ArgumentParser(description="Process relevance judgments using multi-criteria evaluation.")
     parser.add_argument("--model_id", type=str, required=True, 
@@ -46,43 +63,237 @@ def parse_arguments():
                       help="Valid values: 'zeroshot_bing', 'zeroshot_basic', 'fewshot_bing', 'fewshot_basic'")
     parser.add_argument("-together", action="store_true",
                       help="Use together.ai API")
+    parser.add_argument("--openai_base_url", type=str, default=None,
+                      help="Judge with the model --model_id served by an OpenAI-compatible server at this URL (e.g. http://localhost:8000/v1); OPENAI_API_KEY is sent when set")
+    parser.add_argument("--api_timeout", type=float, default=120.0,
+                      help="Seconds before a request to --openai_base_url times out and is retried")
+    parser.add_argument("--device", type=str, default="auto", choices=["auto", "cpu"],
+                      help="'auto': spread local models over the available devices; 'cpu': run on the CPU with tuned thread pools")
+    parser.add_argument("--quant", type=str, default=None, choices=["int8"],
+                      help="'int8': dynamic int8 quantisation of the linear layers (with --device cpu)")
+    parser.add_argument("--compile", action="store_true",
+                      help="Compile the local model's forward pass with torch.compile")
+    parser.add_argument("--num_threads", type=int, default=None,
+                      help="CPU threads for local inference with --device cpu (default: detected cores)")
+    parser.add_argument("--eager_docs", action="store_true",
+                      help="Load the whole documents file into memory instead of using the memory-mapped document store")
     parser.add_argument("--max_pairs", type=int, default=None,
                       help="Maximum number of pairs to process (default: process all)")
+    parser.add_argument("--batch_size", type=int, default=1,
+                      help="Number of pairs per model call; values above 1 run local pipelines on padded batches")
+    parser.add_argument("--max_batch_tokens", type=int, default=None,
+                      help="Form local batches from length buckets under this padded-token budget instead of a fixed --batch_size")
+    parser.add_argument("--schedule_window", type=int, default=1024,
+                      help="Number of qrel pairs grouped into length buckets at a time with --max_batch_tokens")
+    parser.add_argument("--num_shards", type=int, default=1,
+                      help="Split the qrel into this many shards by a hash of (qid, docid) and judge only --shard_id")
+    parser.add_argument("--shard_id", type=int, default=0,
+                      help="Shard judged by this process; outputs go to <result name>.shard-<id>-of-<n>.txt")
+    parser.add_argument("--staged", action="store_true",
+                      help="Prepare and tokenize batches on worker threads and write outputs on another, overlapping both with local inference")
+    parser.add_argument("--prepare_workers", type=int, default=2,
+                      help="Worker threads preparing batches with --staged")
+    parser.add_argument("--prefetch_batches", type=int, default=4,
+                      help="Prepared batches queued ahead of the model with --staged")
+    parser.add_argument("--concurrency", type=int, default=None,
+                      help="With -together, number of API requests kept in flight (default: one blocking call at a time); with --openai_base_url, pooled connections (default 8)")
+    parser.add_argument("--requests_per_minute", type=float, default=None,
+                      help="Request rate limit for concurrent Together runs")
+    parser.add_argument("--tokens_per_minute", type=float, default=None,
+                      help="Token rate limit for concurrent Together runs")
+    parser.add_argument("--cache_dir", type=str, default="./cache",
+                      help="Directory of the persistent judgment cache")
+    parser.add_argument("--no_cache", action="store_true",
+                      help="Disable the judgment cache")
+    parser.add_argument("--cache_max_entries", type=int, default=1_000_000,
+                      help="Maximum number of cached judgments before LRU eviction")
+    parser.add_argument("--resume", action="store_true",
+                      help="Skip pairs already judged in the existing log file and rebuild the results from it")
+    parser.add_argument("--checkpoint_interval", type=int, default=100,
+                      help="Number of pairs between durable checkpoints of the result files")
+    parser.add_argument("--log_flush_interval", type=float, default=5.0,
+                      help="Seconds after which buffered log and error records are written out")
+    parser.add_argument("--log_flush_records", type=int, default=64,
+                      help="Number of buffered log and error records that triggers a write")
+    parser.add_argument("--cascade_small_model", type=str, default=None,
+                      help="Small local model that judges every pair first; only uncertain pairs go to --model_id")
+    parser.add_argument("--cascade_threshold", type=float, default=0.6,
+                      help="Escalate pairs whose top grade probability under the small model is below this")
+    parser.add_argument("--cascade_boundary_margin", type=float, default=0.1,
+                      help="Also escalate pairs whose expected grade is this close to a boundary between two grades")
+    parser.add_argument("--cascade_audit_rate", type=float, default=0.05,
+                      help="Share of confident pairs also sent to the large model to measure agreement")
+    parser.add_argument("--rubric", type=str, default="post", choices=["post", "online", "off"],
+                      help="'post': convert the log to rubric format after grading; 'online': write rubric lines as judgments finish; 'off': no rubric file")
+    parser.add_argument("--log_format", type=str, default="jsonl", choices=["jsonl", "compact"],
+                      help="'jsonl': full records with query and passage text; 'compact': ids, scores and outputs only, as length-prefixed binary records")
+    parser.add_argument("--scoring", type=str, default="generate", choices=["generate", "logits"],
+                      help="'generate': free generation and regex parsing; 'logits': one forward pass reading the 0-3 grade logits (local models only)")
+    parser.add_argument("--early_stop", action="store_true",
+                      help="Stop local free generation once '##final score: X' has been emitted")
+    parser.add_argument("--prefix_cache", action="store_true",
+                      help="Reuse the KV cache of the static prompt prefix on local causal models (with --batch_size 1)")
+    parser.add_argument("--max_retries", type=int, default=5,
+                      help="Retries of a pair after transient API errors (rate limits, timeouts, 5xx) before it is recorded as failed in cuda_errors/ and left out of the results")
+    parser.add_argument("--retry_backoff", type=float, default=1.0,
+                      help="Base delay in seconds of the exponential backoff between retries")
+    parser.add_argument("--metrics", action="store_true",
+                      help="Time each judging stage, count prompt/output tokens and write <result>.metrics.json next to the result file")
+    parser.add_argument("--metrics_interval", type=float, default=None,
+                      help="Print a metrics summary line every N seconds (implies --metrics)")
 
-    return parser.parse_args()
-    
-    
+    return parser
 
-def main():
-    logger, device = setup_logging_and_device()
-    args = parse_arguments()
+def parse_arguments():
+    return build_parser().parse_args()
+
+def load_model(args):
+    """Load the backend described by the model options of `args`."""
+    if not args.together and not args.openai_base_url:
+        probe_device()
+    # Only the concurrent Together path retries inside the pipeline; every other
+    # path retries in grade_pq_pairs' FailureHandler, so its pipeline must not retry too
+    pipeline_retries_itself = (args.together and args.concurrency and not args.openai_base_url
+                               and args.cascade_small_model is None)
+    return get_model_baseline(
+        args.model_id, args.together,
+        max_in_flight=args.concurrency,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        device=args.device, quant=args.quant,
+        compile_model=args.compile, num_threads=args.num_threads,
+        base_url=args.openai_base_url, timeout=args.api_timeout,
+        max_retries=args.max_retries if pipeline_retries_itself else 0,
+        retry_backoff=args.retry_backoff
+    )
+
+def load_small_model(args):
+    """Load the small local model of a cascade run, or return None without one."""
+    if args.cascade_small_model is None:
+        return None
+    probe_device()
+    return get_model_baseline(args.cascade_small_model, device=args.device, quant=args.quant,
+                              compile_model=args.compile, num_threads=args.num_threads)
+
+def validate_job(args):
+    """Reject option combinations that cannot run, before any model is loaded."""
+    if args.scoring == "logits" and args.together:
+        raise ValueError("--scoring logits needs a local model and cannot be used with -together")
+    if args.quant == "int8" and args.device != "cpu":
+        raise ValueError("--quant int8 uses CPU dynamic quantisation and needs --device cpu")
+    if args.together and (args.device != "auto" or args.quant or args.compile):
+        raise ValueError("--device, --quant and --compile apply to local models and cannot be used with -together")
+    if args.openai_base_url and args.together:
+        raise ValueError("--openai_base_url and -together select different backends; use one of them")
+    if args.openai_base_url and (args.device != "auto" or args.quant or args.compile or args.staged):
+        raise ValueError("--device, --quant, --compile and --staged apply to local models and cannot be used with --openai_base_url")
+    if args.staged and (args.cascade_small_model or args.prefix_cache or args.max_batch_tokens):
+        raise ValueError("--staged cannot be combined with --cascade_small_model, --prefix_cache or --max_batch_tokens")
+    if args.prefix_cache and (args.batch_size > 1 or args.cascade_small_model or args.max_batch_tokens):
+        raise ValueError("--prefix_cache runs one pair at a time and cannot be combined with --batch_size > 1, "
+                         "--cascade_small_model or --max_batch_tokens")
+    if args.prefix_cache and (args.together or args.openai_base_url or "flan-t5" in args.model_id.lower()):
+        raise ValueError("--prefix_cache needs a local causal model; it cannot be used with API backends "
+                         "or seq2seq (Flan-T5) models")
+    if not 0 <= args.shard_id < args.num_shards:
+        raise ValueError(f"--shard_id must be in [0, {args.num_shards}), got {args.shard_id}")
+    # Load all templates once and fail fast on an unusable prompt mode
+    get_prompt_registry().validate(args.prompt_mode)
+
+def run_job(args, model, small_model=None):
+    """
+    Judge one dataset with one prompt mode against an already loaded model,
+    then convert its log to rubric format (or write the rubric while grading).
+    
+    Args:
+        args: Parsed arguments (or a job Namespace with the same fields)
+        model: Pipeline returned by `load_model`
+        small_model: Pipeline returned by `load_small_model` for cascade runs
+    """
     if "2019" not in args.docs_path and "2020" not in args.docs_path:
         is_dl23 = True
     else:
         is_dl23 = False
+    print(f"is_dl23:{is_dl23}")
     docid_to_doc, qid_to_query, test_qrel = load_data_files(
-        args.docs_path, args.queries_path, args.test_qrel_path
+        args.docs_path, args.queries_path, args.test_qrel_path,
+        lazy_docs=not args.eager_docs
     )
 
+    result_file_path, max_pairs = args.result_file_path, args.max_pairs
+    if args.num_shards > 1:
+        # Cut --max_pairs from the full qrel first, so the shards add up to the unsharded run
+        if max_pairs is not None:
+            test_qrel = test_qrel.head(max_pairs)
+        test_qrel = select_shard(test_qrel, args.num_shards, args.shard_id)
+        result_file_path = shard_result_path(result_file_path, args.num_shards, args.shard_id)
+        max_pairs = None
+        print(f"Shard {args.shard_id} of {args.num_shards}: {len(test_qrel)} pairs -> {result_file_path}")
+
     system_message = ""
-    model = get_model_baseline(args.model_id, args.together)
 
+    cache = None if args.no_cache else JudgmentCache(args.cache_dir, args.model_id, args.cache_max_entries)
 
-    grade_pq_pairs(
-        test_qrel, docid_to_doc, qid_to_query,
-        args.result_file_path, model, system_message,args.prompt_mode, args.max_pairs)
+    log_file ="."/ Path(result_file_path).parent / "logs" / Path(result_file_path).name.replace(".txt", LOG_SUFFIXES[args.log_format])
+    rubric_file = "."/ Path(result_file_path).parent / "rubric_format" / Path(result_file_path).name.replace(".txt", "_rubric.jsonl.gz")
+    rubric_writer = None
+    if args.rubric == "online":
+        # Reuses the loaded qrels instead of re-reading them after grading
+        rubric_writer = RubricWriter(rubric_file, test_qrel, args.model_id, is_dl23)
 
-    log_file ="."/ Path(args.result_file_path).parent / "logs" / Path(args.result_file_path).name.replace(".txt", ".jsonl")
-    rubric_file = "."/ Path(args.result_file_path).parent / "rubric_format" / Path(args.result_file_path).name.replace(".txt", "_rubric.jsonl.gz")
-    print(f"is_dl23:{is_dl23}")
-    # Convert to rubric format using the same result_path
-    process_log_to_rubric(
-        input_file=log_file,
-        output_file=rubric_file,
-        qrel_file_path=args.test_qrel_path,
-        is_dl23=is_dl23,  # Set to True for DL23 dataset
-        model_name=args.model_id
-    )
+    cascade = None
+    if small_model is not None:
+        cascade = CascadeJudge(
+            small_model, model, system_message,
+            confidence_threshold=args.cascade_threshold,
+            boundary_margin=args.cascade_boundary_margin,
+            audit_rate=args.cascade_audit_rate
+        )
+
+    metrics = None
+    if args.metrics or args.metrics_interval:
+        metrics = RunMetrics(args.prompt_mode, args.metrics_interval)
+
+    try:
+        with activate_metrics(metrics):
+            grade_pq_pairs(
+                test_qrel, docid_to_doc, qid_to_query,
+                result_file_path, model, system_message,args.prompt_mode, max_pairs,
+                batch_size=args.batch_size, cache=cache,
+                resume=args.resume, checkpoint_interval=args.checkpoint_interval,
+                scoring=args.scoring, early_stop=args.early_stop,
+                prefix_cache=args.prefix_cache,
+                log_flush_interval=args.log_flush_interval, log_flush_records=args.log_flush_records,
+                log_format=args.log_format, rubric_writer=rubric_writer, cascade=cascade,
+                max_batch_tokens=args.max_batch_tokens, schedule_window=args.schedule_window,
+                staged=args.staged, prepare_workers=args.prepare_workers, prefetch_batches=args.prefetch_batches,
+                max_retries=args.max_retries, retry_backoff=args.retry_backoff)
+    finally:
+        if cascade is not None:
+            cascade.close()
+    if metrics is not None:
+        metrics.write(Path(result_file_path).with_suffix(".metrics.json"))
+    if cache is not None:
+        cache.close()
+
+    if args.rubric == "post":
+        # Convert to rubric format using the same result_path
+        process_log_to_rubric(
+            input_file=log_file,
+            output_file=rubric_file,
+            qrel_file_path=args.test_qrel_path,
+            is_dl23=is_dl23,  # Set to True for DL23 dataset
+            model_name=args.model_id,
+            docid_to_doc=docid_to_doc,
+            qid_to_query=qid_to_query
+        )
+
+def main():
+    setup_logging()
+    args = parse_arguments()
+    validate_job(args)
+    model = load_model(args)
+    run_job(args, model, load_small_model(args))
 
 
 
@@ -1,8 +1,9 @@
 import json
 import os
 import gzip
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 from pathlib import Path
+from compact_log import LogRecordReader, is_compact_log
 
 
 
@@ -76,11 +77,66 @@ def make_mapping_dict(doc_mapping_path: str) -> Dict:
 
 
 
+def make_rubric_line(log: Dict, qrel_dict: Dict, model_name: str, is_dl23: bool = False,
+                     passage_to_msmarco: Optional[Dict] = None,
+                     qidtomsmarcoqids: Optional[Dict] = None) -> Tuple[Tuple, str]:
+    """
+    Turn one scoring log into its rubric JSON line.
+    
+    Returns:
+        Tuple of (pair key used for de-duplication, JSON line)
+    
+    Raises:
+        KeyError: If the log or a DL23 mapping lacks an entry
+    """
+    qid = log["qidx"]
+    docid = log["docidx"]
+
+    if is_dl23:
+        pair_key = (qidtomsmarcoqids[qid],passage_to_msmarco[docid])
+    else:
+        pair_key = (qid, docid)
+    # Try to get ground truth score
+    try:
+        ground_truth = qrel_dict[(qid, docid)]
+    except KeyError:
+        try:
+            ground_truth = qrel_dict[(str(qid), str(docid))]
+        except KeyError:
+            print(f"Warning: No ground truth found for pair {qid}, {docid}")
+            ground_truth = 0
+
+    json_line = generate_umbrella_json_line(
+        query_id=qid,
+        paragraph_id=docid,
+        text=log["passage"],
+        query_text=log["query"],
+        ground_truth_relevance_label=ground_truth,
+        model_output=log["LLMs_output"],
+        final_score=log["final_relevance_score"],
+        mode=log["prompt_mode"],
+        model_name=model_name,
+        passage_to_msmarco=passage_to_msmarco,
+        qidtomsmarcoqids=qidtomsmarcoqids
+    )
+    return pair_key, json_line
+
+
 def process_log_to_rubric(input_file: str, output_file: str, qrel_file_path: str,
                          is_dl23: bool = False, doc_mapping_path: Optional[str] = "./data/dl2023/docid_to_docidx.txt",
                          query_mapping_path: Optional[str] = "./data/dl2023/qid_to_qidx.txt",
-                         model_name: str = "meta-llama/Llama-3.3-70B-Instruct-Turbo"):
-    """Process UMBRELA log file to rubric format."""
+                         model_name: str = "meta-llama/Llama-3.3-70B-Instruct-Turbo",
+                         docid_to_doc: Optional[Dict] = None, qid_to_query: Optional[Dict] = None,
+                         compresslevel: int = 9):
+    """
+    Process UMBRELA log file to rubric format.
+    
+    Compact logs (see compact_log) carry no query or passage text, so they
+    need `docid_to_doc` and `qid_to_query` to resolve it. For many log files
+    at once, use convert_rubrics.py.
+    """
+    if is_compact_log(input_file) and (docid_to_doc is None or qid_to_query is None):
+        raise ValueError(f"{input_file} is a compact log; pass docid_to_doc and qid_to_query to resolve its text")
     # Load ground truth qrels
     qrel_dict = make_qrel_dict(qrel_file_path)
     
@@ -95,65 +151,109 @@ def process_log_to_rubric(input_file: str, output_file: str, qrel_file_path: str
     processed_count = 0
     error_count = 0
     
-    with gzip.open(output_file, 'wt', encoding='utf-8') as out_f:
-        with open(input_file, 'r', encoding='utf-8') as in_f:
-            for line in in_f:
-                try:
-                    log = json.loads(line.strip())
-                    qid = log["qidx"]
-                    docid = log["docidx"]
-                    # print(passage_to_msmarco)
-                    # print(qidtomsmarcoqids)
-                    # print(qid,docid)
+    log_records = LogRecordReader(input_file, docid_to_doc, qid_to_query)
+    with gzip.open(output_file, 'wt', encoding='utf-8', compresslevel=compresslevel) as out_f:
+        for log in log_records:
+            try:
+                pair_key, json_line = make_rubric_line(
+                    log, qrel_dict, model_name, is_dl23, passage_to_msmarco, qidtomsmarcoqids)
+                if pair_key not in visited_pairs:
+                    visited_pairs.add(pair_key)
+                    out_f.write(json_line + '\n')
+                    processed_count += 1
                     
-                    if is_dl23:
-                        pair_key = (qidtomsmarcoqids[qid],passage_to_msmarco[docid])
-                    else:
-                        pair_key = (qid, docid)
-                    # print(pair_key)
-                    # Try to get ground truth score
-                    try:
-                        ground_truth = qrel_dict[(qid, docid)]
-                    except KeyError:
-                        try:
-                            ground_truth = qrel_dict[(str(qid), str(docid))]
-                        except KeyError:
-                            print(f"Warning: No ground truth found for pair {qid}, {docid}")
-                            ground_truth = 0
-                            
-                    # print(ground_truth)
-                    if pair_key not in visited_pairs:
-                        visited_pairs.add(pair_key)
-                        
-                        json_line = generate_umbrella_json_line(
-                            query_id=qid,
-                            paragraph_id=docid,
-                            text=log["passage"],
-                            query_text=log["query"],
-                            ground_truth_relevance_label=ground_truth,
-                            model_output=log["LLMs_output"],
-                            final_score=log["final_relevance_score"],
-                            mode=log["prompt_mode"],
-                            model_name=model_name,
-                            passage_to_msmarco=passage_to_msmarco,
-                            qidtomsmarcoqids=qidtomsmarcoqids
-                        )
-                        out_f.write(json_line + '\n')
-                        print(processed_count)
-                        processed_count += 1
-                        
-                except json.JSONDecodeError as e:
-                    print(f"Error parsing JSON: {e}")
-                    error_count += 1
-                except KeyError as e:
-                    print(f"Missing key in entry: {e}")
-                    error_count += 1
+            except KeyError as e:
+                print(f"Missing key in entry: {e}")
+                error_count += 1
+    error_count += log_records.errors
 
     print(f"Processing complete:\n"
           f"Processed entries: {processed_count}\n"
           f"Errors encountered: {error_count}")
 
 
+def qrel_dict_from_frame(test_qrel) -> Dict:
+    """Build the `make_qrel_dict` lookup from an already loaded qrel DataFrame."""
+    qrel_dict = {}
+    for qid, docid, score in zip(test_qrel["qid"], test_qrel["docid"], test_qrel["rel_score"]):
+        try:
+            qrel_dict[(str(qid), str(docid))] = int(score)
+        except ValueError:
+            print(f"Warning: Invalid score in qrel file: {score}")
+    return qrel_dict
+
+
+class RubricWriter:
+    """
+    Writes rubric lines while grading runs, instead of re-reading the log.
+    
+    Fed every scoring log as it is written (and, on resume, the records
+    already in the log through `replay`), it covers the judgments of this
+    run. `process_log_to_rubric` reads the whole log file instead, and logs
+    are appended to, so after a run without --resume over an existing log
+    it keeps the first record of each pair, which may come from an earlier
+    run; the two files then differ for those pairs. The output is written
+    to a temporary file and only moved into place by `close`, so an
+    interrupted run never leaves a rubric file that looks complete.
+    """
+    def __init__(self, output_file: str, test_qrel, model_name: str, is_dl23: bool = False,
+                 doc_mapping_path: Optional[str] = "./data/dl2023/docid_to_docidx.txt",
+                 query_mapping_path: Optional[str] = "./data/dl2023/qid_to_qidx.txt",
+                 compresslevel: int = 9):
+        self.output_file = Path(output_file)
+        self.temp_file = self.output_file.with_name(self.output_file.name + ".tmp")
+        self.qrel_dict = qrel_dict_from_frame(test_qrel)
+        self.model_name = model_name
+        self.is_dl23 = is_dl23
+        self.passage_to_msmarco = make_mapping_dict(doc_mapping_path) if is_dl23 and doc_mapping_path else None
+        self.qidtomsmarcoqids = make_mapping_dict(query_mapping_path) if is_dl23 and query_mapping_path else None
+        self.visited_pairs = set()
+        self.processed_count = 0
+        self.error_count = 0
+        self.output_file.parent.mkdir(parents=True, exist_ok=True)
+        self.out_f = gzip.open(self.temp_file, 'wt', encoding='utf-8', compresslevel=compresslevel)
+
+    def write(self, log: Dict):
+        """Add one scoring log; later records of an already written pair are skipped."""
+        try:
+            pair_key, json_line = make_rubric_line(
+                log, self.qrel_dict, self.model_name, self.is_dl23,
+                self.passage_to_msmarco, self.qidtomsmarcoqids)
+        except KeyError as e:
+            print(f"Missing key in entry: {e}")
+            self.error_count += 1
+            return
+        if pair_key not in self.visited_pairs:
+            self.visited_pairs.add(pair_key)
+            self.out_f.write(json_line + '\n')
+            self.processed_count += 1
+
+    def replay(self, log_path: str, docid_to_doc: Optional[Dict] = None, qid_to_query: Optional[Dict] = None):
+        """Add the records of an existing log (used when a run resumes)."""
+        if not Path(log_path).exists():
+            return
+        log_records = LogRecordReader(log_path, docid_to_doc, qid_to_query)
+        for log in log_records:
+            self.write(log)
+        self.error_count += log_records.errors
+
+    def close(self, complete: bool = True):
+        """
+        Finish the gzip stream and move the rubric file into place. A run that
+        did not complete drops the partial file instead, leaving any earlier
+        rubric file untouched.
+        """
+        self.out_f.close()
+        if not complete:
+            self.temp_file.unlink()
+            print(f"Run did not complete; rubric file {self.output_file} not written")
+            return
+        os.replace(self.temp_file, self.output_file)
+        print(f"Processing complete:\n"
+              f"Processed entries: {self.processed_count}\n"
+              f"Errors encountered: {self.error_count}")
+
+
 # Usage example:
     # process_log_to_rubric(
     #     input_file="path/to/your/log.json",
@@ -0,0 +1,220 @@
+"""
+Run instrumentation.
+Stage timers (prompt rendering, chat templating, tokenization, the model
+call, score parsing, cache lookups, log I/O), prompt and output token counts
+per pair, and per-prompt-mode histograms of token counts and scores.
+
+Instrumented code calls `get_run_metrics()`, which returns a no-op
+`NullMetrics` unless `main.py --metrics` activated a `RunMetrics` for the
+run, so a disabled run pays one attribute lookup and a shared null context
+per stage. Stage times are busy seconds summed over threads and in-flight
+requests, so a stage's share of wall time can exceed 100%; with local HF
+pipelines, tokenization and generation both happen inside the pipeline
+call and are counted as "generate".
+"""
+
+import json
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Dict, Optional
+
+from tqdm import tqdm
+
+STAGES = ("render", "chat_template", "tokenize", "generate", "parse", "cache", "log_io", "token_count")
+# Upper bucket edges for token-count histograms; the last bucket is open-ended
+TOKEN_BUCKETS = (32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+_NULL_CONTEXT = nullcontext()
+
+
+class Histogram:
+    """Bucketed counts with a running sum, min and max."""
+    def __init__(self, edges=TOKEN_BUCKETS):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value: int):
+        self.counts[bisect_left(self.edges, value)] += 1
+        self.total += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def to_dict(self) -> Dict:
+        labels = [f"<={edge}" for edge in self.edges] + [f">{self.edges[-1]}"]
+        return {
+            "count": self.total,
+            "mean": self.sum / self.total if self.total else 0.0,
+            "min": self.min,
+            "max": self.max,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class NullMetrics:
+    """Stand-in used when instrumentation is off; every hook is a no-op."""
+    enabled = False
+
+    def stage(self, name: str):
+        return _NULL_CONTEXT
+
+    def record_tokens(self, prompt_tokens: int, output_tokens: int):
+        pass
+
+    def record_text_tokens(self, tokenizer, prompts, outputs):
+        pass
+
+    def record_pair(self, final_score=None):
+        pass
+
+
+class RunMetrics:
+    """
+    Collects stage timings, token counts and histograms for one judging run.
+
+    Args:
+        mode: Prompt mode of the run; histograms are keyed by it
+        report_interval: Seconds between periodic summary lines, or None
+    """
+    enabled = True
+
+    def __init__(self, mode: str, report_interval: Optional[float] = None):
+        self.mode = mode
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        self.stage_seconds = {name: 0.0 for name in STAGES}
+        self.stage_calls = {name: 0 for name in STAGES}
+        self.pairs = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.histograms: Dict[str, Dict[str, Histogram]] = {}
+        self.scores: Dict[str, Dict[str, int]] = {}
+        self.start_time = time.perf_counter()
+        self.stop_event = threading.Event()
+        self.reporter = None
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + elapsed
+                self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+
+    def _mode_histograms(self) -> Dict[str, Histogram]:
+        if self.mode not in self.histograms:
+            self.histograms[self.mode] = {"prompt_tokens": Histogram(), "output_tokens": Histogram()}
+        return self.histograms[self.mode]
+
+    def record_tokens(self, prompt_tokens: int, output_tokens: int):
+        """Account the prompt and output tokens of one model call for one pair."""
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.output_tokens += output_tokens
+            histograms = self._mode_histograms()
+            histograms["prompt_tokens"].add(prompt_tokens)
+            histograms["output_tokens"].add(output_tokens)
+
+    def record_text_tokens(self, tokenizer, prompts, outputs):
+        """Tokenize rendered prompts and outputs of a local model to account their tokens."""
+        with self.stage("token_count"):
+            prompt_ids = tokenizer(list(prompts), add_special_tokens=False)["input_ids"]
+            output_ids = tokenizer(list(outputs), add_special_tokens=False)["input_ids"]
+        for prompt_tokens, output_tokens in zip(prompt_ids, output_ids):
+            self.record_tokens(len(prompt_tokens), len(output_tokens))
+
+    def record_pair(self, final_score=None):
+        """Count one pair written to the results and its score."""
+        with self.lock:
+            self.pairs += 1
+            scores = self.scores.setdefault(self.mode, {})
+            scores[str(final_score)] = scores.get(str(final_score), 0) + 1
+
+    def summary_line(self) -> str:
+        """One-line progress summary: throughput, stage shares and token averages."""
+        wall = time.perf_counter() - self.start_time
+        with self.lock:
+            busy = {name: seconds for name, seconds in self.stage_seconds.items() if seconds > 0}
+            pairs, prompt_tokens, output_tokens = self.pairs, self.prompt_tokens, self.output_tokens
+            calls = self._mode_histograms()["prompt_tokens"].total
+        shares = ", ".join(f"{name} {seconds / wall:.0%}" for name, seconds in
+                           sorted(busy.items(), key=lambda item: -item[1]))
+        tokens = (f"; avg {prompt_tokens / calls:.0f} prompt / {output_tokens / calls:.0f} output tokens"
+                  if calls else "")
+        return f"[metrics] {pairs} pairs in {wall:.0f}s ({pairs / wall if wall else 0:.2f} pairs/s); {shares}{tokens}"
+
+    def to_dict(self) -> Dict:
+        wall = time.perf_counter() - self.start_time
+        with self.lock:
+            return {
+                "prompt_mode": self.mode,
+                "wall_seconds": wall,
+                "pairs": self.pairs,
+                "pairs_per_second": self.pairs / wall if wall else 0.0,
+                "stages": {name: {"seconds": self.stage_seconds[name], "calls": self.stage_calls[name],
+                                  "share_of_wall": self.stage_seconds[name] / wall if wall else 0.0}
+                           for name in self.stage_seconds},
+                "tokens": {"prompt": self.prompt_tokens, "output": self.output_tokens},
+                "histograms": {mode: {name: histogram.to_dict() for name, histogram in histograms.items()}
+                               for mode, histograms in self.histograms.items()},
+                "scores": self.scores,
+            }
+
+    def write(self, path):
+        """Write the metrics JSON."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        print(f"Metrics written to {path}")
+
+    def _report_periodically(self):
+        while not self.stop_event.wait(self.report_interval):
+            tqdm.write(self.summary_line())
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        if self.report_interval:
+            self.reporter = threading.Thread(target=self._report_periodically, daemon=True)
+            self.reporter.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.reporter is not None:
+            self.reporter.join()
+        print(self.summary_line())
+
+
+_active_metrics = NullMetrics()
+
+
+def get_run_metrics():
+    """Return the metrics of the running job (a no-op `NullMetrics` when instrumentation is off)."""
+    return _active_metrics
+
+
+@contextmanager
+def activate_metrics(metrics: Optional[RunMetrics]):
+    """Make `metrics` the active run metrics for the duration of the block (no-op for None)."""
+    global _active_metrics
+    if metrics is None:
+        yield
+        return
+    previous = _active_metrics
+    _active_metrics = metrics
+    metrics.start()
+    try:
+        yield
+    finally:
+        metrics.stop()
+        _active_metrics = previous
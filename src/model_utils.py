@@ -3,36 +3,38 @@ Model Utilities Module
 ---------------------
 Handles model loading and initialization for different types of language models:
 - Together AI models (API-based)
+- Models behind an OpenAI-compatible server (vLLM, llama.cpp, TGI, ...)
 - Flan-T5 models (sequence-to-sequence)
 - Causal language models (like LLaMA)
 
 All models are configured for optimal performance with appropriate data types
 and device mapping.
+
+torch, transformers and the together SDK are imported by the backend that
+uses them, so API-backed runs never load torch and local runs never load
+the together SDK.
 """
 
 from typing import Optional
-from transformers import (
-    AutoTokenizer,
-    AutoModelForCausalLM,
-    AutoModelForSeq2SeqLM,
-    pipeline,
-    BitsAndBytesConfig
-)
-import torch
-from together import Together
-import together
+import asyncio
+import random
+import time
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import *
 
+from metrics import get_run_metrics
 
 
 class TogetherPipeline:
-    def __init__(self, model_name: str):
+    def __init__(self, model_name: str, max_retries: Optional[int] = None):
         self.model_name = model_name
         self.api_key = os.getenv("TOGETHER_API_KEY")
         if not self.api_key:
             raise ValueError("TOGETHER_API_KEY environment variable is not set.")
-        self.client = Together(api_key=self.api_key)
+        from together import Together
+        # None keeps the SDK's own retries; 0 leaves retrying to the caller
+        self.client = Together(api_key=self.api_key, max_retries=max_retries)
     
     def __call__(self, messages: List[Dict], max_new_tokens=100, **kwargs):
         # Use Together API to generate responses
@@ -44,71 +46,433 @@ class TogetherPipeline:
             top_p=None,
             
         )
-        return [{"generated_text": response.choices[0].message.content}]
+        output = {"generated_text": response.choices[0].message.content}
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            output["usage"] = {"prompt_tokens": usage.prompt_tokens,
+                               "completion_tokens": usage.completion_tokens}
+        return [output]
+
+
+# HTTP status codes worth retrying: timeouts, conflicts, rate limits and server errors
+TRANSIENT_HTTP_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+TRANSIENT_ERROR_NAMES = {
+    "RateLimitError", "APIConnectionError", "Timeout", "APITimeoutError",
+    "ServiceUnavailableError", "InternalServerError",
+    "ReadTimeout", "ConnectTimeout", "ConnectionError",
+}
+
+
+def is_transient_api_error(error: Exception) -> bool:
+    """Tell retryable API failures (rate limits, timeouts, 5xx) from permanent ones."""
+    status = getattr(error, "http_status", None) or getattr(error, "status_code", None)
+    if status is not None:
+        return status in TRANSIENT_HTTP_STATUSES
+    return type(error).__name__ in TRANSIENT_ERROR_NAMES or isinstance(error, (asyncio.TimeoutError, ConnectionError))
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """The Retry-After (in seconds) a server sent with a failed request, if any."""
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is None:
+        # together SDK errors carry the response headers, httpx-based clients the response
+        headers = getattr(error, "headers", None) or getattr(getattr(error, "response", None), "headers", None)
+        if headers:
+            retry_after = headers.get("Retry-After") or headers.get("retry-after")
+    if isinstance(retry_after, str) and retry_after.replace(".", "", 1).isdigit():
+        return float(retry_after)
+    return None
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """Exponential backoff with full jitter for the given retry attempt (0-based)."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket refilled continuously at `rate_per_minute`.
+    
+    Used to keep request and token throughput under the provider's per-minute
+    limits. A bucket with no rate never blocks.
+    """
+    def __init__(self, rate_per_minute: Optional[float], capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0 if rate_per_minute else None
+        self.capacity = capacity or rate_per_minute or 0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        """Wait until `amount` tokens are available and take them."""
+        if self.rate is None:
+            return
+        # Requests larger than the bucket would wait forever; cap them at a full bucket
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def adjust(self, amount: float):
+        """Charge (positive) or refund (negative) tokens once the real cost is known."""
+        if self.rate is None:
+            return
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class AsyncTogetherPipeline(TogetherPipeline):
+    """
+    Together AI backend that keeps several requests in flight.
+    
+    Calls go through `AsyncTogether`, bounded by a semaphore of `max_in_flight`,
+    throttled by request and token buckets, and retried with jittered backoff
+    on transient errors, waiting at least as long as the server's Retry-After.
+    The blocking `__call__` of `TogetherPipeline` is still available for code
+    paths that grade one pair at a time.
+    """
+    def __init__(self, model_name: str, max_in_flight: int = 8,
+                 requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 max_retries: int = 5, base_url: Optional[str] = None,
+                 retry_backoff: float = 1.0):
+        super().__init__(model_name, max_retries)
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.base_url = base_url or os.getenv("TOGETHER_BASE_URL")
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        if self.base_url:
+            from together import Together
+            self.client = Together(api_key=self.api_key, base_url=self.base_url, max_retries=max_retries)
+
+    def start(self):
+        """Create the async client and limiters; must run inside the event loop that uses them."""
+        from together import AsyncTogether
+        self.async_client = AsyncTogether(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.request_bucket = TokenBucket(self.requests_per_minute)
+        self.token_bucket = TokenBucket(self.tokens_per_minute)
+        self.retry_count = 0
+
+    async def aclose(self):
+        """Close the async client created by `start` (SDK versions without `close` keep no open connections)."""
+        close = getattr(self.async_client, "close", None)
+        if close is not None:
+            result = close()
+            if asyncio.iscoroutine(result):
+                await result
+        self.async_client = None
+
+    @staticmethod
+    def estimate_tokens(messages: List[Dict], max_new_tokens: int) -> int:
+        """Rough token cost of a request (about four characters per token) for rate limiting."""
+        return sum(len(m["content"]) for m in messages) // 4 + max_new_tokens
+
+    async def agenerate(self, messages: List[Dict], max_new_tokens=100) -> str:
+        """Send one chat completion request and return the generated text."""
+        estimated_tokens = self.estimate_tokens(messages, max_new_tokens)
+        for attempt in range(self.max_retries + 1):
+            await self.request_bucket.acquire()
+            await self.token_bucket.acquire(estimated_tokens)
+            try:
+                async with self.semaphore:
+                    with get_run_metrics().stage("generate"):
+                        response = await self.async_client.chat.completions.create(
+                            model=self.model_name,
+                            messages=messages,
+                            do_sample=False,
+                            temperature=None,
+                            top_p=None,
+                        )
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient_api_error(e):
+                    raise
+                self.retry_count += 1
+                delay = backoff_delay(attempt, self.retry_backoff)
+                retry_after = retry_after_seconds(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                await asyncio.sleep(delay)
+                continue
+
+            usage = getattr(response, "usage", None)
+            if usage is not None and getattr(usage, "total_tokens", None):
+                self.token_bucket.adjust(usage.total_tokens - estimated_tokens)
+            if usage is not None:
+                get_run_metrics().record_tokens(usage.prompt_tokens, usage.completion_tokens)
+            return response.choices[0].message.content
+
+
+class APIStatusError(Exception):
+    """Non-200 answer of an OpenAI-compatible server."""
+    def __init__(self, status_code: int, message: str, retry_after: Optional[str] = None):
+        super().__init__(f"HTTP {status_code}: {message}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class OpenAICompatiblePipeline(TogetherPipeline):
+    """
+    Backend for a model served by an OpenAI-compatible HTTP server, such as
+    a local vLLM or llama.cpp server shared by several jobs.
+    
+    It is a `TogetherPipeline`, so every API code path (messages in, text
+    out, JSON cache keys) applies. Requests go through one `requests.Session`
+    whose pool keeps up to `max_in_flight` keep-alive connections; once all
+    are busy, further requests wait for a free one instead of opening more.
+    `generate_batch` sends a batch's requests in parallel over the pool.
+    Timeouts, connection errors, 429 and 5xx answers are retried with
+    jittered backoff, waiting at least as long as the server's Retry-After.
+    """
+    def __init__(self, model_name: str, base_url: str, max_in_flight: int = 8,
+                 timeout: float = 120.0, max_retries: int = 5, api_key: Optional[str] = None,
+                 retry_backoff: float = 1.0):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.model_name = model_name
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retry_count = 0
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight, pool_block=True, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if self.api_key:
+            self.session.headers["Authorization"] = f"Bearer {self.api_key}"
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def complete(self, messages: List[Dict], max_new_tokens=100, logprobs: bool = False,
+                 top_logprobs: int = 20) -> Dict:
+        """Send one chat completion request, retrying transient failures, and return the response JSON."""
+        payload = {
+            "model": self.model_name,
+            "messages": messages,
+            "max_tokens": max_new_tokens,
+            "temperature": 0,
+        }
+        if logprobs:
+            payload["logprobs"] = True
+            payload["top_logprobs"] = top_logprobs
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(f"{self.base_url}/chat/completions",
+                                             json=payload, timeout=self.timeout)
+                if response.status_code != 200:
+                    raise APIStatusError(response.status_code, response.text[:500],
+                                         response.headers.get("Retry-After"))
+                return response.json()
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient_api_error(e):
+                    raise
+                self.retry_count += 1
+                delay = backoff_delay(attempt, self.retry_backoff)
+                retry_after = retry_after_seconds(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                time.sleep(delay)
+
+    @staticmethod
+    def output_from_response(response: Dict) -> Dict:
+        """The `generated_text` (plus `usage` and `logprobs`, when present) of a chat completion."""
+        choice = response["choices"][0]
+        output = {"generated_text": choice["message"]["content"]}
+        usage = response.get("usage")
+        if usage:
+            output["usage"] = {"prompt_tokens": usage.get("prompt_tokens", 0),
+                               "completion_tokens": usage.get("completion_tokens", 0)}
+        if choice.get("logprobs"):
+            output["logprobs"] = choice["logprobs"].get("content") or []
+        return output
+
+    def __call__(self, messages: List[Dict], max_new_tokens=100, **kwargs):
+        return [self.output_from_response(self.complete(messages, max_new_tokens))]
+
+    def generate_batch(self, messages_batch: List[List[Dict]], max_new_tokens=100,
+                       logprobs: bool = False) -> List[Dict]:
+        """Send one request per conversation in parallel; outputs come back in input order."""
+        responses = self.executor.map(lambda messages: self.complete(messages, max_new_tokens, logprobs),
+                                      messages_batch)
+        return [self.output_from_response(response) for response in responses]
+
+
+def configure_cpu_threads(num_threads: Optional[int] = None) -> int:
+    """
+    Size PyTorch's intra-op and inter-op thread pools for CPU inference.
+    
+    Without `num_threads`, uses OMP_NUM_THREADS when set (as the shard
+    launcher does) and otherwise the cores this process may run on.
+    
+    Returns:
+        int: Number of intra-op threads
+    """
+    import torch
+    if num_threads is None:
+        if os.getenv("OMP_NUM_THREADS"):
+            num_threads = int(os.environ["OMP_NUM_THREADS"])
+        elif hasattr(os, "sched_getaffinity"):
+            num_threads = len(os.sched_getaffinity(0))
+        else:
+            num_threads = os.cpu_count() or 1
+    torch.set_num_threads(num_threads)
+    try:
+        # Generation is a chain of dependent ops; a small inter-op pool avoids oversubscription
+        torch.set_num_interop_threads(min(2, num_threads))
+    except RuntimeError:
+        # Can only be set before the first parallel op of the process
+        pass
+    return num_threads
+
 
+def quantize_int8(model):
+    """Apply PyTorch dynamic int8 quantisation to every linear layer of a float32 CPU model."""
+    import torch
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
 
 
+def warm_up(model_pipeline, compiled: bool = False):
+    """
+    Run one short generation so lazy initialisation (and compilation) happens
+    before the first timed pair. A `torch.compile`d forward that fails here is
+    reverted to eager mode.
+    """
+    messages = [{"role": "user", "content": "warm-up"}]
+    prompt = messages if getattr(model_pipeline.tokenizer, "chat_template", None) else "warm-up"
+    try:
+        model_pipeline(prompt, max_new_tokens=2, do_sample=False)
+    except Exception as e:
+        if not compiled:
+            raise
+        print(f"torch.compile failed during warm-up ({type(e).__name__}: {e}); using the eager model")
+        del model_pipeline.model.forward
+        model_pipeline(prompt, max_new_tokens=2, do_sample=False)
 
-def get_model_baseline(name_or_path_to_model: str, use_together: bool = False):
+
+def get_model_baseline(name_or_path_to_model: str, use_together: bool = False,
+                       max_in_flight: Optional[int] = None,
+                       requests_per_minute: Optional[float] = None,
+                       tokens_per_minute: Optional[float] = None,
+                       device: str = "auto", quant: Optional[str] = None,
+                       compile_model: bool = False, num_threads: Optional[int] = None,
+                       base_url: Optional[str] = None, timeout: float = 120.0,
+                       max_retries: Optional[int] = None, retry_backoff: float = 1.0):
     """
     Load and configure a language model for text generation.
     
-    This function handles three types of models:
+    This function handles four types of models:
     1. Together AI models accessed through API
-    2. Flan-T5 models using sequence-to-sequence architecture
-    3. Standard causal language models (like LLaMA)
+    2. Models served by an OpenAI-compatible server at `base_url`
+    3. Flan-T5 models using sequence-to-sequence architecture
+    4. Standard causal language models (like LLaMA)
     
     Args:
         name_or_path_to_model: Model identifier or path (e.g., "meta-llama/Llama-3-70b")
         use_together: Whether to use Together AI API
+        max_in_flight: If set with use_together, return the concurrent
+            `AsyncTogetherPipeline` with this many requests in flight
+        requests_per_minute: Request rate limit for the concurrent client
+        tokens_per_minute: Token rate limit for the concurrent client
+        device: "auto" spreads the model over the available devices;
+            "cpu" loads it on the CPU and sizes the thread pools
+        quant: "int8" applies dynamic int8 quantisation to the linear layers
+            (CPU only; the model is loaded in float32 first)
+        compile_model: Wrap the model's forward in `torch.compile`
+        num_threads: CPU intra-op threads (default: detected cores)
+        base_url: Base URL of an OpenAI-compatible server (e.g.
+            http://localhost:8000/v1); the model name is the served model.
+            `max_in_flight` then sizes the connection pool (default 8)
+        timeout: Seconds before a request to that server times out
+        max_retries: Retries of a transient API error inside the API
+            pipeline (default: its own default); pass 0 when the caller
+            retries, so the two retry loops do not multiply
+        retry_backoff: Base delay in seconds of the pipeline's retry backoff
         
     Returns:
         Configured pipeline ready for text generation
         
     Notes:
-        - Models are loaded with bfloat16 precision for efficiency
-        - Device mapping is automatic based on available hardware
+        - Models are loaded with bfloat16 precision for efficiency (float32
+          before int8 quantisation)
+        - Device mapping is automatic based on available hardware unless
+          `device="cpu"`
         - Flan-T5 models use text2text-generation pipeline
         - Other models use standard text-generation pipeline
     """
     
+    # Model behind an OpenAI-compatible server
+    if base_url:
+        return OpenAICompatiblePipeline(name_or_path_to_model, base_url,
+                                        max_in_flight=max_in_flight or 8, timeout=timeout,
+                                        max_retries=5 if max_retries is None else max_retries,
+                                        retry_backoff=retry_backoff)
+
     # Together AI API-based model
     if use_together:
-        return TogetherPipeline(model_name=name_or_path_to_model)
+        if max_in_flight:
+            return AsyncTogetherPipeline(
+                model_name=name_or_path_to_model,
+                max_in_flight=max_in_flight,
+                requests_per_minute=requests_per_minute,
+                tokens_per_minute=tokens_per_minute,
+                max_retries=5 if max_retries is None else max_retries,
+                retry_backoff=retry_backoff
+            )
+        return TogetherPipeline(model_name=name_or_path_to_model, max_retries=max_retries)
     
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM, AutoModelForSeq2SeqLM, pipeline
+
+    if quant == "int8" and device != "cpu":
+        raise ValueError("Dynamic int8 quantisation runs on the CPU only; use device='cpu'")
+    if device == "cpu":
+        print(f"CPU inference with {configure_cpu_threads(num_threads)} threads")
+    load_kwargs = {
+        # Dynamic quantisation needs float32 weights; otherwise use bfloat16 for efficient memory usage
+        "torch_dtype": torch.float32 if quant == "int8" else torch.bfloat16,
+        # Automatically handle device placement unless pinned to the CPU
+        "device_map": None if device == "cpu" else "auto",
+    }
+
     # Flan-T5 sequence-to-sequence model
-    elif "flan-t5" in name_or_path_to_model.lower():
-        # Initialize tokenizer and model
-        tokenizer = AutoTokenizer.from_pretrained(name_or_path_to_model)
-        model = AutoModelForSeq2SeqLM.from_pretrained(
-            name_or_path_to_model,
-            torch_dtype=torch.bfloat16,  # Use bfloat16 for efficient memory usage
-            device_map="auto"  # Automatically handle device placement
-        )
-        
-        # Create sequence-to-sequence pipeline
-        return pipeline(
-            "text2text-generation",
-            model=model,
-            tokenizer=tokenizer
-        )
-    
+    if "flan-t5" in name_or_path_to_model.lower():
+        task = "text2text-generation"
+        model_class = AutoModelForSeq2SeqLM
     # Standard causal language model
     else:
-        # Initialize tokenizer and model
-        tokenizer = AutoTokenizer.from_pretrained(name_or_path_to_model)
-        model = AutoModelForCausalLM.from_pretrained(
-            name_or_path_to_model,
-            torch_dtype=torch.bfloat16,
-            device_map="auto"
-        )
-        
-        # Create text generation pipeline
-        return pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer
-        )
+        task = "text-generation"
+        model_class = AutoModelForCausalLM
+
+    # Initialize tokenizer and model
+    tokenizer = AutoTokenizer.from_pretrained(name_or_path_to_model)
+    model = model_class.from_pretrained(name_or_path_to_model, **load_kwargs)
+    if quant == "int8":
+        model = quantize_int8(model)
+    model.eval()
+    if compile_model:
+        # Compiling forward (not the module) keeps `generate` and the config intact
+        model.forward = torch.compile(model.forward, dynamic=True)
+
+    # Create the generation pipeline
+    model_pipeline = pipeline(task, model=model, tokenizer=tokenizer)
+    # Settings that change the outputs of the same model id; part of the judgment cache key
+    model_pipeline.backend_settings = {"device": model.device.type, "dtype": str(load_kwargs["torch_dtype"]),
+                                       "quant": quant}
+    if device == "cpu" or compile_model:
+        warm_up(model_pipeline, compiled=compile_model)
+    return model_pipeline
 
 # Note: The quantized model loading function below is commented out but preserved
 # for potential future use. It demonstrates how to load models with 4-bit quantization
@@ -116,6 +480,8 @@ def get_model_baseline(name_or_path_to_model: str, use_together: bool = False):
 
 """
 def get_model_quantized(name_or_path_to_model: str) -> Tuple:
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
     tokenizer = AutoTokenizer.from_pretrained(name_or_path_to_model)
     bnb_config = BitsAndBytesConfig(
         load_in_4bit=True,
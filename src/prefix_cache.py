@@ -0,0 +1,203 @@
+"""
+Shared-prefix KV cache for local causal models.
+Every UMBRELA prompt starts with a long, fixed instruction block (several KB
+for the few-shot templates). This module prefills that block once per prompt
+mode, keeps its past_key_values, and reuses them for every pair so that each
+forward pass only covers the query and passage. A second, smaller cache holds
+the prefix up to and including the query, since consecutive qrel rows usually
+share a qid.
+"""
+
+import copy
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+
+from prompts import get_umbrella_prompt, QUERY_SENTINEL, PASSAGE_SENTINEL
+from early_stop import FinalScoreStoppingCriteria
+from metrics import get_run_metrics
+from relevance_scoring import (
+    GENERATION_PARAMS, apply_chat_template, build_messages,
+    extract_final_score, grade_distributions_from_logits, has_chat_template,
+    judgment_from_distribution, render_logits_prompt
+)
+
+
+def cut_before_line(text: str, sentinel: str) -> str:
+    """
+    Return the part of `text` before the line holding `sentinel`, without
+    the whitespace that separates the two.
+
+    Cutting at a line break (rather than right before the sentinel) keeps
+    the prefix on a natural token boundary.
+    """
+    head = text[:text.index(sentinel)]
+    cut = head.rfind("\n")
+    if cut <= 0:
+        return ""
+    while cut > 0 and head[cut - 1].isspace():
+        cut -= 1
+    return head[:cut]
+
+
+class PrefixKVCache:
+    """
+    Reuses prefilled past_key_values of the static prompt prefix.
+
+    A prefix is only reused when its token ids are an exact prefix of the
+    pair's full token ids, so outputs match the uncached path; otherwise the
+    pair is run without the cache and counted as a mismatch.
+    """
+    def __init__(self, pipeline, system_message: str, max_query_prefixes: int = 4):
+        if pipeline.task != "text-generation":
+            raise ValueError("The prefix KV cache needs a causal text-generation pipeline")
+        self.model = pipeline.model
+        self.tokenizer = pipeline.tokenizer
+        self.system_message = system_message
+        self.max_query_prefixes = max_query_prefixes
+        self.static_prefixes: Dict[Tuple, Tuple[List[int], DynamicCache]] = {}
+        self.query_prefixes: "OrderedDict[Tuple, Tuple[List[int], DynamicCache]]" = OrderedDict()
+        self.static_hits = 0
+        self.query_hits = 0
+        self.prefills = 0
+        self.mismatches = 0
+        self.reused_tokens = 0
+        self.total_tokens = 0
+
+    def render(self, query: str, passage: str, mode: str, scoring: str) -> str:
+        """Render the full model input text the uncached path would use."""
+        prompt = get_umbrella_prompt(query=query, passage=passage, mode=mode)
+        if scoring == "logits":
+            return render_logits_prompt(prompt, self.tokenizer, self.system_message)
+        return apply_chat_template(prompt, build_messages(prompt, self.system_message), self.tokenizer)
+
+    def prefill(self, prefix_ids: List[int], base: Optional[Tuple[List[int], DynamicCache]] = None) -> DynamicCache:
+        """Run the model over `prefix_ids`, extending a copy of `base` when given."""
+        cache = copy.deepcopy(base[1]) if base is not None else DynamicCache()
+        start = len(base[0]) if base is not None else 0
+        input_ids = torch.tensor([prefix_ids[start:]], device=self.model.device)
+        with torch.no_grad():
+            self.model(input_ids=input_ids, past_key_values=cache, use_cache=True)
+        return cache
+
+    def lookup(self, query: str, full_ids: List[int], mode: str, scoring: str,
+               add_special_tokens: bool) -> Tuple[int, int, Optional[DynamicCache]]:
+        """
+        Find the longest cached prefix of `full_ids`, prefilling it first if
+        it is not cached yet.
+
+        Returns:
+            Tuple of (number of cached tokens, number of those served by an
+            entry that existed before this call, copy of their cache or None)
+        """
+        static_key = (mode, scoring)
+        new_static = static_key not in self.static_prefixes
+        if new_static:
+            static_text = cut_before_line(self.render(QUERY_SENTINEL, PASSAGE_SENTINEL, mode, scoring), QUERY_SENTINEL)
+            static_ids = self.tokenizer(static_text, add_special_tokens=add_special_tokens)["input_ids"]
+            self.static_prefixes[static_key] = (static_ids, self.prefill(static_ids))
+        static_entry = self.static_prefixes[static_key]
+
+        query_key = (mode, scoring, query)
+        query_entry = self.query_prefixes.get(query_key)
+        new_query = query_entry is None
+        if new_query:
+            query_text = cut_before_line(self.render(query, PASSAGE_SENTINEL, mode, scoring), PASSAGE_SENTINEL)
+            query_ids = self.tokenizer(query_text, add_special_tokens=add_special_tokens)["input_ids"]
+            if query_ids[:len(static_entry[0])] == static_entry[0] and len(query_ids) > len(static_entry[0]):
+                query_entry = (query_ids, self.prefill(query_ids, static_entry))
+                self.query_prefixes[query_key] = query_entry
+                if len(self.query_prefixes) > self.max_query_prefixes:
+                    self.query_prefixes.popitem(last=False)
+        else:
+            self.query_prefixes.move_to_end(query_key)
+
+        for entry, level in [(query_entry, "query"), (static_entry, "static")]:
+            if entry is None:
+                continue
+            prefix_ids = entry[0]
+            if len(prefix_ids) < len(full_ids) and full_ids[:len(prefix_ids)] == prefix_ids:
+                # A prefix prefilled for this very pair is a prefill, not a hit; only
+                # the part of it extended from an older static prefix was reused
+                if level == "query" and not new_query:
+                    self.query_hits += 1
+                    reused = len(prefix_ids)
+                elif level == "static" and not new_static:
+                    self.static_hits += 1
+                    reused = len(prefix_ids)
+                else:
+                    self.prefills += 1
+                    reused = len(static_entry[0]) if level == "query" and not new_static else 0
+                return len(prefix_ids), reused, copy.deepcopy(entry[1])
+        self.mismatches += 1
+        return 0, 0, None
+
+    def judge(self, query: str, passage: str, mode: str, scoring: str = "generate",
+              stopping_criterion: Optional[FinalScoreStoppingCriteria] = None) -> Dict:
+        """
+        Judge one pair, reusing the cached prefix.
+
+        Returns:
+            Judgment dict in the shape `judge_prompts` produces
+        """
+        metrics = get_run_metrics()
+        add_special_tokens = True if scoring == "generate" else not has_chat_template(self.tokenizer)
+        with metrics.stage("chat_template"):
+            rendered = self.render(query, passage, mode, scoring)
+        with metrics.stage("tokenize"):
+            full_ids = self.tokenizer(rendered, add_special_tokens=add_special_tokens)["input_ids"]
+        cached_length, reused_length, cache = self.lookup(query, full_ids, mode, scoring, add_special_tokens)
+        self.reused_tokens += reused_length
+        self.total_tokens += len(full_ids)
+        input_ids = torch.tensor([full_ids], device=self.model.device)
+
+        if scoring == "logits":
+            with metrics.stage("generate"), torch.no_grad():
+                logits = self.model(
+                    input_ids=input_ids[:, cached_length:],
+                    past_key_values=cache,
+                    use_cache=cache is not None
+                ).logits[:, -1, :]
+            metrics.record_tokens(len(full_ids), 0)
+            return judgment_from_distribution(grade_distributions_from_logits(logits, self.tokenizer)[0])
+
+        generation_kwargs = {}
+        if stopping_criterion is not None:
+            generation_kwargs.update(stopping_criterion.generation_kwargs())
+        terminators = [
+            self.tokenizer.eos_token_id,
+            self.tokenizer.convert_tokens_to_ids("<|eot_id|>")
+        ]
+        with metrics.stage("generate"), torch.no_grad():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=cache,
+                max_new_tokens=GENERATION_PARAMS["max_new_tokens"],
+                eos_token_id=terminators,
+                pad_token_id=128009,
+                do_sample=False,
+                temperature=None,
+                top_p=None,
+                **generation_kwargs
+            )
+        metrics.record_tokens(len(full_ids), outputs.shape[1] - input_ids.shape[1])
+        # Decode the way the text-generation pipeline does, then strip the prompt
+        decode_kwargs = {"skip_special_tokens": True, "clean_up_tokenization_spaces": True}
+        prompt_length = len(self.tokenizer.decode(input_ids[0], **decode_kwargs))
+        generated_text = self.tokenizer.decode(outputs[0], **decode_kwargs)[prompt_length:]
+        if has_chat_template(self.tokenizer):
+            llms_output = generated_text
+        else:
+            llms_output = rendered + generated_text
+        with metrics.stage("parse"):
+            return {"LLMs_output": llms_output, "final_relevance_score": extract_final_score(llms_output)}
+
+    def report(self):
+        """Print how much of the prompt tokens came from earlier cache entries."""
+        reused_share = self.reused_tokens / self.total_tokens if self.total_tokens else 0.0
+        print(f"Prefix KV cache: {self.query_hits} query-prefix hits, {self.static_hits} static-prefix hits, "
+              f"{self.prefills} new prefixes, {self.mismatches} misses; "
+              f"{reused_share:.1%} of prompt tokens reused")
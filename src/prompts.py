@@ -1,9 +1,181 @@
 from pathlib import Path
+from string import Formatter
+from typing import Dict, List, Optional, Tuple
+
+VALID_MODES = ["zeroshot_bing", "zeroshot_basic", "fewshot_bing", "fewshot_basic"]
+
+FILE_MAPPING = {
+    "zeroshot_bing": "qrel_zeroshot_bing.txt",
+    "zeroshot_basic": "qrel_zeroshot_basic.txt",
+    "fewshot_bing": "qrel_fewshot_bing.txt",
+    "fewshot_basic": "qrel_fewshot_basic.txt"
+}
+
+PROMPTS_DIR = Path(__file__).parent.parent / "prompts"
+
+# Placeholders used to split rendered templates into static segments
+QUERY_SENTINEL = "\x00UMBRELA_QUERY\x00"
+PASSAGE_SENTINEL = "\x00UMBRELA_PASSAGE\x00"
+CONTENT_SENTINEL = "\x00UMBRELA_CONTENT\x00"
+
+# Values used to check pre-rendered scaffolding against the real chat template
+SAMPLE_QUERY = "what is the sample query"
+SAMPLE_PASSAGE = "A sample passage, with some text."
+
+
+class PromptTemplateRegistry:
+    """
+    All UMBRELA prompt templates, loaded and validated once.
+
+    Besides plain prompt rendering, the registry pre-renders each tokenizer's
+    chat template around the user message, so chat-templating a pair is string
+    concatenation. It also caches the token ids of the static segments of
+    every mode, which lets length estimates tokenize only the query and
+    passage. Model inputs are still tokenized from the whole rendered prompt.
+    """
+    def __init__(self, prompts_dir: Path = PROMPTS_DIR):
+        self.templates: Dict[str, str] = {}
+        # Modes whose template cannot be rendered, with the reason
+        self.invalid_modes: Dict[str, str] = {}
+        # Static text around the query and passage: (head, middle, tail)
+        self.segments: Dict[str, Tuple[str, str, str]] = {}
+        self.chat_scaffolds: Dict[Tuple[int, str], Optional[Tuple]] = {}
+        self.segment_ids: Dict[Tuple[int, str, str], Tuple[List[int], List[int], List[int]]] = {}
+
+        for mode in VALID_MODES:
+            template_path = Path(prompts_dir) / FILE_MAPPING[mode]
+            if not template_path.exists():
+                raise FileNotFoundError(f"Prompt template file not found: {template_path}")
+            with open(template_path, "r") as f:
+                template = f.read()
+            fields = [field for _, field, _, _ in Formatter().parse(template) if field is not None]
+            self.templates[mode] = template
+            if sorted(fields) != ["passage", "query"]:
+                self.invalid_modes[mode] = (f"Prompt template {template_path} must contain {{query}} and "
+                                            f"{{passage}} exactly once, found fields {fields}")
+                continue
+            self.segments[mode] = split_segments(
+                template.format(query=QUERY_SENTINEL, passage=PASSAGE_SENTINEL))
+
+    def validate(self, mode: str):
+        """Raise ValueError if `mode` is unknown or its template cannot be rendered."""
+        if mode not in VALID_MODES:
+            raise ValueError(f"Mode must be one of {VALID_MODES}")
+        if mode in self.invalid_modes:
+            raise ValueError(self.invalid_modes[mode])
+
+    def render(self, query: str, passage: str, mode: str) -> str:
+        """Render the UMBRELA prompt for one pair (same text as `str.format`)."""
+        if mode not in self.segments:
+            self.validate(mode)
+        head, middle, tail = self.segments[mode]
+        return f"{head}{query}{middle}{passage}{tail}"
+
+    def chat_scaffold(self, tokenizer, system_message: str) -> Optional[Tuple]:
+        """
+        Pre-render the tokenizer's chat template around the user message.
+
+        Returns:
+            Tuple of (text before content, text after content, strip content)
+            or None when the template transforms content in ways plain
+            concatenation cannot reproduce
+        """
+        key = (id(tokenizer), system_message)
+        if key not in self.chat_scaffolds:
+            self.chat_scaffolds[key] = self._build_chat_scaffold(tokenizer, system_message)
+        scaffold = self.chat_scaffolds[key]
+        return scaffold[1:] if scaffold is not None else None
+
+    def _build_chat_scaffold(self, tokenizer, system_message: str) -> Optional[Tuple]:
+        if getattr(tokenizer, "chat_template", None) is None:
+            return None
+
+        def render_chat(content: str) -> str:
+            return tokenizer.apply_chat_template(
+                [{"role": "system", "content": system_message},
+                 {"role": "user", "content": content}],
+                tokenize=False,
+                add_generation_prompt=True
+            )
+
+        padded = render_chat(f" \n{CONTENT_SENTINEL} \n")
+        if f" \n{CONTENT_SENTINEL} \n" in padded:
+            strip_content = False
+            before, after = padded.split(f" \n{CONTENT_SENTINEL} \n")
+        elif CONTENT_SENTINEL in padded:
+            # Templates such as Llama-3's trim message content
+            strip_content = True
+            before, after = render_chat(CONTENT_SENTINEL).split(CONTENT_SENTINEL)
+        else:
+            return None
+
+        for mode in self.segments:
+            prompt = self.render(SAMPLE_QUERY, SAMPLE_PASSAGE, mode)
+            content = prompt.strip() if strip_content else prompt
+            if before + content + after != render_chat(prompt):
+                return None
+        # The tokenizer is kept alive so its id() stays unique
+        return (tokenizer, before, after, strip_content)
+
+    def apply_chat(self, prompt: str, tokenizer, system_message: str) -> Optional[str]:
+        """Chat-template a prompt through the pre-rendered scaffold, or None if unavailable."""
+        scaffold = self.chat_scaffold(tokenizer, system_message)
+        if scaffold is None:
+            return None
+        before, after, strip_content = scaffold
+        return before + (prompt.strip() if strip_content else prompt) + after
+
+    def encode_pair(self, query: str, passage: str, mode: str, tokenizer,
+                    system_message: str) -> List[int]:
+        """
+        Build the chat-templated input ids of one pair from cached segment ids.
+
+        Only the query and passage are tokenized. Segment boundaries can make
+        the result differ slightly from tokenizing the whole rendered prompt,
+        so this is only used for length estimates (batch scheduling, token
+        budgets); the ids fed to the model come from `encode_prompts`, which
+        keeps them identical to the pipeline-based paths.
+        """
+        key = (id(tokenizer), system_message, mode)
+        if key not in self.segment_ids:
+            text = self.render(QUERY_SENTINEL, PASSAGE_SENTINEL, mode)
+            chat_text = self.apply_chat(text, tokenizer, system_message)
+            if chat_text is None:
+                chat_text = text
+            head, middle, tail = split_segments(chat_text)
+            self.segment_ids[key] = (
+                tokenizer(head, add_special_tokens=True)["input_ids"],
+                tokenizer(middle, add_special_tokens=False)["input_ids"],
+                tokenizer(tail, add_special_tokens=False)["input_ids"],
+            )
+        head_ids, middle_ids, tail_ids = self.segment_ids[key]
+        query_ids = tokenizer(query, add_special_tokens=False)["input_ids"]
+        passage_ids = tokenizer(passage, add_special_tokens=False)["input_ids"]
+        return head_ids + query_ids + middle_ids + passage_ids + tail_ids
+
+
+def split_segments(text: str) -> Tuple[str, str, str]:
+    """Split text rendered with the query/passage sentinels into its static segments."""
+    head, rest = text.split(QUERY_SENTINEL)
+    middle, tail = rest.split(PASSAGE_SENTINEL)
+    return head, middle, tail
+
+
+_registry: Optional[PromptTemplateRegistry] = None
+
+
+def get_prompt_registry() -> PromptTemplateRegistry:
+    """Return the process-wide template registry, loading it on first use."""
+    global _registry
+    if _registry is None:
+        _registry = PromptTemplateRegistry()
+    return _registry
+
 
 def get_umbrella_prompt(query: str, passage: str, mode: str) -> str:
     """
     Generates a prompt for evaluating passage relevance to a query.
-    
+
     Args:
         query (str): The search query to evaluate against
         passage (str): The passage to evaluate
@@ -12,38 +184,22 @@ def get_umbrella_prompt(query: str, passage: str, mode: str) -> str:
             - "zeroshot_basic": Zero-shot basic prompt
             - "fewshot_bing": Few-shot Bing-style prompt
             - "fewshot_basic": Few-shot basic prompt
-        
+
     Returns:
         str: Formatted prompt for relevance evaluation
-        
+
     Score meanings:
         0: No relevance
         1: Related but doesn't answer
         2: Contains answer but unclear/with extra info
         3: Dedicated, exact answer
-        
+
     Raises:
-        ValueError: If mode is not one of the supported options
+        ValueError: If mode is not one of the supported options or its
+            template has placeholders other than {query} and {passage}
+        FileNotFoundError: If a template file is missing when the registry loads
     """
-    valid_modes = ["zeroshot_bing", "zeroshot_basic", "fewshot_bing", "fewshot_basic"]
-    
-    if mode not in valid_modes:
-        raise ValueError(f"Mode must be one of {valid_modes}")
-    
-    file_mapping = {
-        "zeroshot_bing": "qrel_zeroshot_bing.txt",
-        "zeroshot_basic": "qrel_zeroshot_basic.txt",
-        "fewshot_bing": "qrel_fewshot_bing.txt",
-        "fewshot_basic": "qrel_fewshot_basic.txt"
-    }
-    
-    file_name = file_mapping[mode]
-    template_path = Path(__file__).parent.parent / "prompts" / file_name
-    
-    if not template_path.exists():
-        raise FileNotFoundError(f"Prompt template file not found: {template_path}")
-    
-    with open(template_path, "r") as f:
-        prompt_template = f.read()
-    
-    return prompt_template.format(query=query, passage=passage)
\ No newline at end of file
+    if mode not in VALID_MODES:
+        raise ValueError(f"Mode must be one of {VALID_MODES}")
+
+    return get_prompt_registry().render(query, passage, mode)
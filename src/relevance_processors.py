@@ -3,18 +3,37 @@ Relevance judgment processor for UMBRELA-style evaluation.
 Implements the Bing Relevance Assessment methodology.
 """
 
+import os
 import json
-import torch
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from pathlib import Path
-from typing import Dict, Tuple, Optional
-from relevance_scoring import grade_each_pq_pair
+from typing import Dict, List, Tuple, Optional
+from model_utils import TogetherPipeline, AsyncTogetherPipeline
+from compact_log import (
+    COMPACT_LOG_MAGIC, LOG_SUFFIXES, decode_record, encode_record, is_compact_log, scan_compact_log
+)
+from batch_scheduler import LengthBucketScheduler
+from relevance_scoring import (
+    grade_each_pq_pair, grade_pq_pair_batch, agrade_pq_pair,
+    build_scoring_log, collate_token_ids, distributions_from_inputs, encode_prompts,
+    extract_final_score, generate_from_inputs, get_grade_token_ids, judgment_from_distribution,
+    lookup_cached_judgment
+)
+from prompts import get_prompt_registry, get_umbrella_prompt
+from staged_pipeline import MonitoredQueue, StageTimer, report_stages
+from metrics import get_run_metrics
+from failure_handling import FailureHandler
 
 class RelevanceProcessor:
     """Base class for processing relevance judgments using UMBRELA methodology."""
     
-    def __init__(self, result_path: str):
+    def __init__(self, result_path: str, log_format: str = "jsonl"):
         self.result_path = Path(result_path)
+        self.log_format = log_format
         self.setup_paths()
             
     def setup_paths(self):
@@ -24,7 +43,7 @@ class RelevanceProcessor:
         """
         # Define paths relative to result path
         self.generation_path = self.result_path.parent / "generation_errors" / self.result_path.name
-        self.logs_path = self.result_path.parent / "logs" / self.result_path.name.replace(".txt", ".jsonl")
+        self.logs_path = self.result_path.parent / "logs" / self.result_path.name.replace(".txt", LOG_SUFFIXES[self.log_format])
         self.cuda_errors_path = self.result_path.parent / "cuda_errors" / self.result_path.name
         
         # Create parent directories for each path
@@ -42,8 +61,278 @@ class RelevanceProcessor:
             print(f"Final Score: {final_score}")
             print("="*30)
 
+
+class CheckpointedResultFile:
+    """
+    TREC result file that only ever holds whole checkpoints.
+    
+    Results are written to two temporary sibling copies and the result file
+    is always a hard link to one of them. At each checkpoint the lines
+    written since the last one are appended and fsynced to the copy that is
+    not published, which is then linked over the result file with
+    `os.replace`; the other copy catches up at the next checkpoint. Readers
+    (or a kill -9) therefore only see complete checkpoints, and each line is
+    written twice instead of the whole file being rewritten every time.
+    
+    The result file is first replaced once the copies hold `publish_after`
+    lines (the pairs a resumed run re-emits from the log), so the previous
+    result file stays in place until the rebuilt one covers it.
+    """
+    def __init__(self, path: Path, publish_after: int = 0):
+        self.path = path
+        self.publish_after = publish_after
+        self.lines: List[str] = []
+        self.lines_written = 0
+        self.copy_paths = [path.with_name(f"{path.name}.tmp{i}") for i in range(2)]
+        self.copies = [open(copy_path, 'w') for copy_path in self.copy_paths]
+        self.pending: List[List[str]] = [[], []]
+        self.live: Optional[int] = None
+
+    @property
+    def published(self) -> bool:
+        return self.live is not None
+
+    def write(self, line: str):
+        self.lines.append(line)
+
+    def checkpoint(self, final: bool = False):
+        if self.lines:
+            chunk = "".join(self.lines)
+            self.lines_written += len(self.lines)
+            self.lines.clear()
+            for pending in self.pending:
+                pending.append(chunk)
+        for i, copy in enumerate(self.copies):
+            if i != self.live and self.pending[i]:
+                copy.write("".join(self.pending[i]))
+                self.pending[i].clear()
+        target = 0 if self.live is None else 1 - self.live
+        self.copies[target].flush()
+        os.fsync(self.copies[target].fileno())
+        if self.published or final or self.lines_written >= self.publish_after:
+            link_path = self.path.with_name(self.path.name + ".link")
+            if link_path.exists():
+                link_path.unlink()
+            os.link(self.copy_paths[target], link_path)
+            os.replace(link_path, self.path)
+            self.live = target
+
+    def close(self, complete: bool = True):
+        """
+        Publish the remaining lines and remove the temporary copies. A run
+        that failed before publishing keeps the previous result file.
+        """
+        self.checkpoint(final=complete)
+        for copy, copy_path in zip(self.copies, self.copy_paths):
+            copy.close()
+            copy_path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close(complete=exc_info[0] is None)
+
+
+class BufferedStream:
+    """Append-only text or binary stream whose writes are held by a `JudgmentLogSink` until it flushes."""
+    def __init__(self, sink: "JudgmentLogSink", path: Path, mode: str):
+        self.sink = sink
+        self.file = open(path, mode)
+        self.empty = b"" if "b" in mode else ""
+        self.buffer = []
+
+    def write(self, text: str):
+        with self.sink.lock:
+            self.buffer.append(text)
+            self.sink.pending_records += 1
+            self.sink.maybe_flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.empty.join(self.buffer))
+            self.buffer.clear()
+        self.file.flush()
+
+    def sync(self):
+        self.flush()
+        os.fsync(self.file.fileno())
+
+
+class JudgmentLogSink:
+    """
+    Owns the output streams of one `grade_pq_pairs` run: the judgment log,
+    the TREC results and the two error files.
+    
+    The log is JSONL or, when the processor's `log_format` is "compact",
+    length-prefixed records without query and passage text (see compact_log).
+    Writes are buffered in memory and handed to the OS once `flush_records`
+    records have accumulated or `flush_interval` seconds have passed, instead
+    of opening and closing the log for every pair. `checkpoint` (also run on
+    exit) fsyncs every stream, the TREC results included.
+    All writes go through one lock, so concurrent workers can share a sink.
+    With a `rubric_writer`, every log record is also emitted in rubric format.
+    """
+    def __init__(self, processor: RelevanceProcessor, resume: bool = False,
+                 flush_interval: float = 5.0, flush_records: int = 64, rubric_writer=None,
+                 resumed_pairs: int = 0):
+        self.lock = threading.RLock()
+        self.flush_interval = flush_interval
+        self.flush_records = flush_records
+        self.pending_records = 0
+        self.last_flush = time.monotonic()
+        error_file_mode = 'a' if resume else 'w'
+        self.results = CheckpointedResultFile(processor.result_path, publish_after=resumed_pairs)
+        self.compact = processor.log_format == "compact"
+        if self.compact:
+            self.logs = BufferedStream(self, processor.logs_path, 'ab')
+            if self.logs.file.tell() == 0:
+                self.logs.file.write(COMPACT_LOG_MAGIC)
+        else:
+            self.logs = BufferedStream(self, processor.logs_path, 'a')
+        self.generation_errors = BufferedStream(self, processor.generation_path, error_file_mode)
+        self.cuda_errors = BufferedStream(self, processor.cuda_errors_path, error_file_mode)
+        self.streams = [self.logs, self.generation_errors, self.cuda_errors]
+        self.rubric_writer = rubric_writer
+
+    def write_log(self, scoring_log: Dict):
+        """Append one judgment record to the log (and the rubric file, if any)."""
+        with self.lock, get_run_metrics().stage("log_io"):
+            if self.compact:
+                self.logs.write(encode_record(scoring_log))
+            else:
+                self.logs.write(json.dumps(scoring_log) + "\n")
+            if self.rubric_writer is not None:
+                self.rubric_writer.write(scoring_log)
+
+    def maybe_flush(self):
+        """Flush the buffers if either flush threshold has been reached."""
+        if (self.pending_records >= self.flush_records
+                or time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Hand all buffered records to the OS (without fsync)."""
+        with self.lock, get_run_metrics().stage("log_io"):
+            for stream in self.streams:
+                stream.flush()
+            self.pending_records = 0
+            self.last_flush = time.monotonic()
+
+    def checkpoint(self):
+        """
+        Make everything written so far durable: sync the log and error
+        streams, then publish the TREC results.
+        """
+        with self.lock, get_run_metrics().stage("log_io"):
+            for stream in self.streams:
+                stream.sync()
+            self.pending_records = 0
+            self.last_flush = time.monotonic()
+            self.results.checkpoint()
+
+    def close(self, complete: bool = True):
+        with self.lock:
+            self.checkpoint()
+            for stream in self.streams:
+                stream.file.close()
+            self.results.close(complete)
+            if self.rubric_writer is not None:
+                self.rubric_writer.close(complete)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close(complete=exc_info[0] is None)
+
+def load_completed_judgments(logs_path: Path) -> Dict[Tuple[str, str], int]:
+    """
+    Stream an existing judgment log and collect the pairs it already covers.
+    
+    A trailing partial line or record (left by a process killed mid-write) is
+    truncated away so the log can be appended to again. When a pair was logged
+    more than once, the first record wins, matching `process_log_to_rubric`.
+    
+    Returns:
+        Dictionary mapping (qid, docid) as strings to the logged final score
+    """
+    completed = {}
+    if not logs_path.exists():
+        return completed
+    if is_compact_log(logs_path):
+        valid_end = 0
+        for payload, valid_end in scan_compact_log(logs_path):
+            log = decode_record(payload)
+            pair_key = (str(log["qidx"]), str(log["docidx"]))
+            completed.setdefault(pair_key, log["final_relevance_score"])
+        with open(logs_path, 'rb+') as f:
+            # Without a single complete record, restart the file (header included)
+            f.truncate(valid_end)
+        return completed
+    with open(logs_path, 'rb+') as f:
+        valid_end = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            valid_end += len(line)
+            try:
+                log = json.loads(line)
+                pair_key = (str(log["qidx"]), str(log["docidx"]))
+                completed.setdefault(pair_key, log["final_relevance_score"])
+            except (json.JSONDecodeError, KeyError):
+                continue
+        f.truncate(valid_end)
+    return completed
+
+def lookup_pair(eachline, docid_to_doc, qid_to_query) -> Tuple[str, str, str, str]:
+    """
+    Resolve the query and passage text for one qrel row.
+    
+    Returns:
+        Tuple of (qidx, docidx, query, passage); docidx is converted to str
+        when the document mapping is keyed by strings.
+    """
+    qidx = eachline.qid
+    docidx = eachline.docid
+    query = qid_to_query[qidx]
+    try:
+        passage = docid_to_doc[docidx]
+    except KeyError:
+        # Try with string conversion
+        docidx = str(docidx)
+        passage = docid_to_doc[docidx]
+    return qidx, docidx, query, passage
+
+def write_judgment(result_file, generation_errors_file, qidx, docidx, final_score):
+    """Write one judgment in TREC format, recording invalid scores as 0."""
+    get_run_metrics().record_pair(final_score)
+    if isinstance(final_score, int) and 0 <= final_score <= 3:
+        result_file.write(f"{qidx} 0 {docidx} {final_score}\n")
+    else:
+        result_file.write(f"{qidx} 0 {docidx} 0\n")
+        generation_errors_file.write(f"Invalid score: {qidx} 0 {docidx} {final_score}\n")
+
+def write_failure(cuda_errors_file, qidx, docidx, error: Exception):
+    """
+    Record a failed pair in the errors file. It gets no TREC line, so an
+    evaluation never counts it as judged non-relevant, and a resumed run
+    judges it again.
+    """
+    get_run_metrics().record_pair("error")
+    cuda_errors_file.write(f"{qidx} {docidx}: {str(error)}\n")
+    print(f"Error processing {qidx}, {docidx}: {str(error)}")
+
 def grade_pq_pairs(test_qrel, docid_to_doc, qid_to_query, result_path: str, 
-                  pipeline, system_message: str, mode: str = "zeroshot_bing", max_pairs: Optional[int] = None):
+                  pipeline, system_message: str, mode: str = "zeroshot_bing", max_pairs: Optional[int] = None,
+                  batch_size: int = 1, cache=None, resume: bool = False,
+                  checkpoint_interval: int = 100, scoring: str = "generate",
+                  early_stop: bool = False, prefix_cache: bool = False,
+                  log_flush_interval: float = 5.0, log_flush_records: int = 64,
+                  log_format: str = "jsonl", rubric_writer=None, cascade=None,
+                  max_batch_tokens: Optional[int] = None, schedule_window: int = 1024,
+                  staged: bool = False, prepare_workers: int = 2, prefetch_batches: int = 4,
+                  max_retries: int = 5, retry_backoff: float = 1.0):
     """
     Process relevance judgments using UMBRELA methodology.
     
@@ -55,61 +344,508 @@ def grade_pq_pairs(test_qrel, docid_to_doc, qid_to_query, result_path: str,
         pipeline: Model pipeline for inference
         system_message: System message (empty for UMBRELA)
         mode: UMBRELA prompt mode (default: "zeroshot_bing")
+        max_pairs: Maximum number of pairs to process (default: all)
+        batch_size: Number of pairs sent to the model per call; 1 keeps the
+            original one-pair-at-a-time path
+        cache: Optional JudgmentCache consulted before every model call
+        resume: Reuse judgments already in the log file and only judge the
+            remaining pairs
+        checkpoint_interval: Number of pairs between durable checkpoints
+        scoring: "generate" for free generation, "logits" for single-step
+            grade logits (local models only)
+        early_stop: Stop local free generation as soon as a final score has
+            been emitted
+        prefix_cache: Prefill the static prompt prefix of a local causal model
+            once and reuse its KV cache (sequential path only; ignored with
+            a message otherwise)
+        log_flush_interval: Seconds after which buffered log records are flushed
+        log_flush_records: Number of buffered records that triggers a flush
+        log_format: "jsonl" (default) or "compact" (ids, scores and outputs only)
+        rubric_writer: Optional RubricWriter fed every judgment as it is logged;
+            on resume it is first given the records already in the log
+        cascade: Optional CascadeJudge; pairs are then scored by its small model
+            and only uncertain ones by `pipeline` (its large model)
+        max_batch_tokens: If set, group each window of pairs into length buckets
+            and form batches under this padded-token budget (local models);
+            `batch_size`, when above 1, caps the pairs per batch
+        schedule_window: Number of pairs planned together by the length scheduler
+        staged: Overlap prompt preparation and output writing with inference
+            (local models; see `grade_pq_pairs_staged`)
+        prepare_workers: Threads preparing batches in the staged pipeline
+        prefetch_batches: Prepared batches the staged pipeline keeps queued
+        max_retries: Retries of a pair after transient API errors before it
+            is recorded as failed (see failure_handling); API pipelines
+            used here should be built with max_retries=0, so that the
+            pipeline does not retry each of these attempts again
+        retry_backoff: Base delay in seconds of the retry backoff
     """
-    processor = RelevanceProcessor(result_path)
+    if isinstance(pipeline, AsyncTogetherPipeline) and cascade is None:
+        # Transient errors are retried with backoff inside AsyncTogetherPipeline.agenerate
+        # (with the max_retries and retry_backoff it was built with)
+        return asyncio.run(grade_pq_pairs_async(
+            test_qrel, docid_to_doc, qid_to_query, result_path,
+            pipeline, system_message, mode, max_pairs, cache, resume, checkpoint_interval,
+            log_flush_interval, log_flush_records, log_format, rubric_writer))
+    failure_handler = FailureHandler(max_retries, retry_backoff)
+    if staged and not isinstance(pipeline, TogetherPipeline):
+        return grade_pq_pairs_staged(
+            test_qrel, docid_to_doc, qid_to_query, result_path, pipeline, system_message,
+            mode, max_pairs, batch_size, cache, resume, checkpoint_interval, scoring, early_stop,
+            log_flush_interval, log_flush_records, log_format, rubric_writer,
+            prepare_workers, prefetch_batches, failure_handler)
+
+    processor = RelevanceProcessor(result_path, log_format)
     total_pairs = len(test_qrel) if max_pairs is None else min(len(test_qrel), max_pairs)
     print(f"Processing {total_pairs} pairs out of {len(test_qrel)} total pairs")
+    completed = load_completed_judgments(processor.logs_path) if resume else {}
+    if resume:
+        print(f"Resuming: {len(completed)} pairs already judged in {processor.logs_path}")
+    stopping_criterion = None
+    if early_stop and scoring == "generate" and not isinstance(pipeline, TogetherPipeline):
+        from early_stop import FinalScoreStoppingCriteria
+        stopping_criterion = FinalScoreStoppingCriteria(pipeline.tokenizer)
+    prefix_kv_cache = None
+    if prefix_cache:
+        if (batch_size > 1 or cascade is not None or max_batch_tokens is not None
+                or isinstance(pipeline, TogetherPipeline) or pipeline.task != "text-generation"):
+            print("Ignoring --prefix_cache: it needs a local causal model on the one-pair-at-a-time path "
+                  "(batch size 1, no cascade, no --max_batch_tokens)")
+        else:
+            from prefix_cache import PrefixKVCache
+            prefix_kv_cache = PrefixKVCache(pipeline, system_message)
+    # Local model that can run out of memory: the cascade's small model or the pipeline itself
+    local_pipeline = cascade.small_pipeline if cascade is not None else pipeline
+    pair_tokens = None
+    if not isinstance(local_pipeline, TogetherPipeline):
+        def pair_tokens(pair):
+            _, _, query, passage = pair
+            return len(get_prompt_registry().encode_pair(query, passage, mode, local_pipeline.tokenizer,
+                                                         system_message))
+    scheduler = None
+    if max_batch_tokens is not None:
+        if isinstance(local_pipeline, TogetherPipeline):
+            print("Ignoring --max_batch_tokens: Together AI requests are not padded into batches")
+        else:
+            scheduler = LengthBucketScheduler(
+                local_pipeline.tokenizer, system_message, max_batch_tokens,
+                max_batch_size=batch_size if batch_size > 1 else None
+            )
+
+    if resume and rubric_writer is not None:
+        rubric_writer.replay(processor.logs_path, docid_to_doc, qid_to_query)
+    with JudgmentLogSink(processor, resume, log_flush_interval, log_flush_records, rubric_writer,
+                         resumed_pairs=len(completed)) as sink:
+        result_file = sink.results
+        generation_errors_file = sink.generation_errors
+        cuda_errors_file = sink.cuda_errors
+
+        pending: List[Tuple[str, str, str, str]] = []
 
-    with open(processor.result_path, 'w') as result_file, \
-         open(processor.generation_path, 'w') as generation_errors_file, \
-         open(processor.cuda_errors_path, 'w') as cuda_errors_file:
+        def judge_batch(batch_pairs):
+            if cascade is not None:
+                return cascade.grade_pairs(
+                    batch_pairs,
+                    log_sink=None,
+                    mode=mode,
+                    cache=cache,
+                    scoring=scoring,
+                    stopping_criterion=stopping_criterion
+                )
+            return grade_pq_pair_batch(
+                batch_pairs,
+                pipeline=pipeline,
+                log_sink=None,
+                system_message=system_message,
+                mode=mode,
+                cache=cache,
+                scoring=scoring,
+                stopping_criterion=stopping_criterion
+            )
+
+        def judge_one(pairs):
+            (qidx, docidx, query, passage), = pairs
+            return [grade_each_pq_pair(
+                query=query,
+                passage=passage,
+                pipeline=pipeline,
+                log_sink=None,
+                system_message=system_message,
+                qidx=qidx,
+                docidx=docidx,
+                mode=mode,
+                cache=cache,
+                scoring=scoring,
+                stopping_criterion=stopping_criterion,
+                prefix_cache=prefix_kv_cache
+            )]
+
+        def flush_pending():
+            """Grade the buffered pairs and write their results in qrel order."""
+            if not pending:
+                return
+            if scheduler is not None:
+                batches = scheduler.plan(pending, mode)
+            else:
+                batches = [list(range(len(pending)))]
+            # Batches may be split or retried out of qrel order, so records are logged below
+            outcomes = [None] * len(pending)
+            for planned_batch in batches:
+                for batch in failure_handler.split(planned_batch):
+                    start = time.perf_counter()
+                    results = failure_handler.run([pending[i] for i in batch], judge_batch, pair_tokens)
+                    if scheduler is not None:
+                        scheduler.record(batch, time.perf_counter() - start)
+                    for i, result in zip(batch, results):
+                        outcomes[i] = result
+
+            for (qidx, docidx, _, _), outcome in zip(pending, outcomes):
+                if isinstance(outcome, Exception):
+                    write_failure(cuda_errors_file, qidx, docidx, outcome)
+                    continue
+                final_score, scoring_log = outcome
+                sink.write_log(scoring_log)
+                processor.debug_print(qidx, docidx, final_score, scoring_log)
+                write_judgment(result_file, generation_errors_file, qidx, docidx, final_score)
+            pending.clear()
         
         for idx, eachline in enumerate(tqdm(test_qrel.itertuples(index=True), total=total_pairs)):
             if max_pairs is not None and idx >= max_pairs:
                 print(f"\nReached maximum pairs limit ({max_pairs})")
                 break
             
+            if idx > 0 and idx % checkpoint_interval == 0:
+                sink.checkpoint()
+
             qidx = eachline.qid
             docidx = eachline.docid
 
+            pair_key = (str(qidx), str(docidx))
+            if pair_key in completed:
+                flush_pending()
+                write_judgment(result_file, generation_errors_file, qidx, docidx, completed[pair_key])
+                continue
+
             try:
-                # Handle document ID type conversion
-                try:
-                    final_score, scoring_log = grade_each_pq_pair(
-                        query=qid_to_query[qidx],
-                        passage=docid_to_doc[docidx],
-                        pipeline=pipeline,
-                        log_file_path=processor.logs_path,
-                        system_message=system_message,
-                        qidx=qidx,
-                        docidx=docidx,
-                        mode=mode
-                    )
-                except KeyError:
-                    # Try with string conversion
-                    docidx = str(docidx)
-                    final_score, scoring_log = grade_each_pq_pair(
-                        query=qid_to_query[qidx],
-                        passage=docid_to_doc[docidx],
-                        pipeline=pipeline,
-                        log_file_path=processor.logs_path,
-                        system_message=system_message,
-                        qidx=qidx,
-                        docidx=docidx,
-                        mode=mode
-                    )
+                qidx, docidx, query, passage = lookup_pair(eachline, docid_to_doc, qid_to_query)
+
+                if batch_size > 1 or cascade is not None or scheduler is not None:
+                    pending.append((qidx, docidx, query, passage))
+                    if len(pending) >= (schedule_window if scheduler is not None else batch_size):
+                        flush_pending()
+                    continue
+
+                outcome = failure_handler.run([(qidx, docidx, query, passage)], judge_one, pair_tokens)[0]
+                if isinstance(outcome, Exception):
+                    raise outcome
+                final_score, scoring_log = outcome
+                sink.write_log(scoring_log)
                 # Debug print for first run
                 processor.debug_print(qidx, docidx, final_score, scoring_log)
 
                 # Write results in TREC format
-                if isinstance(final_score, int) and 0 <= final_score <= 3:
-                    result_file.write(f"{qidx} 0 {docidx} {final_score}\n")
-                else:
-                    result_file.write(f"{qidx} 0 {docidx} 0\n")
-                    generation_errors_file.write(f"Invalid score: {qidx} 0 {docidx} {final_score}\n")
+                write_judgment(result_file, generation_errors_file, qidx, docidx, final_score)
 
             except Exception as e:
+                # Keep the TREC output in qrel order before logging the failure
+                flush_pending()
                 # Log any errors and continue processing
-                cuda_errors_file.write(f"{qidx} {docidx}: {str(e)}\n")
-                result_file.write(f"{qidx} 0 {docidx} 0\n")
-                print(f"Error processing {qidx}, {docidx}: {str(e)}")
\ No newline at end of file
+                write_failure(cuda_errors_file, qidx, docidx, e)
+
+        flush_pending()
+
+    failure_handler.report()
+    if stopping_criterion is not None:
+        stopping_criterion.report(mode)
+    if cascade is not None:
+        cascade.report()
+    if scheduler is not None:
+        scheduler.report()
+    if prefix_kv_cache is not None:
+        prefix_kv_cache.report()
+    if cache is not None:
+        cache.report()
+
+
+def grade_pq_pairs_staged(test_qrel, docid_to_doc, qid_to_query, result_path: str,
+                          pipeline, system_message: str, mode: str = "zeroshot_bing",
+                          max_pairs: Optional[int] = None, batch_size: int = 1, cache=None,
+                          resume: bool = False, checkpoint_interval: int = 100,
+                          scoring: str = "generate", early_stop: bool = False,
+                          log_flush_interval: float = 5.0, log_flush_records: int = 64,
+                          log_format: str = "jsonl", rubric_writer=None,
+                          prepare_workers: int = 2, prefetch_batches: int = 4,
+                          failure_handler: Optional[FailureHandler] = None):
+    """
+    Process relevance judgments as a three-stage pipeline on a local model.
+    
+    A pool of `prepare_workers` threads renders, cache-checks and tokenizes
+    batches of `batch_size` qrel rows ahead of the model; at most
+    `prefetch_batches` prepared batches wait in the queue. The calling thread
+    only runs the model, and a post-processing thread parses scores and
+    writes the log, TREC and error files in qrel order. Out-of-memory
+    batches are split by the `failure_handler`. An exception in any stage
+    stops the other stages and is re-raised once they have shut down.
+    """
+    if failure_handler is None:
+        failure_handler = FailureHandler()
+    processor = RelevanceProcessor(result_path, log_format)
+    total_pairs = len(test_qrel) if max_pairs is None else min(len(test_qrel), max_pairs)
+    print(f"Processing {total_pairs} pairs out of {len(test_qrel)} total pairs "
+          f"in a staged pipeline ({prepare_workers} prepare threads, batches of {batch_size})")
+    completed = load_completed_judgments(processor.logs_path) if resume else {}
+    if resume:
+        print(f"Resuming: {len(completed)} pairs already judged in {processor.logs_path}")
+    stopping_criterion = None
+    if early_stop and scoring == "generate":
+        from early_stop import FinalScoreStoppingCriteria
+        stopping_criterion = FinalScoreStoppingCriteria(pipeline.tokenizer)
+    if scoring == "logits":
+        # Fail early if the tokenizer cannot spell the grades as single tokens
+        get_grade_token_ids(pipeline.tokenizer)
+
+    prepare_stage = StageTimer("prepare", prepare_workers)
+    inference_stage = StageTimer("inference")
+    postprocess_stage = StageTimer("postprocess")
+    prepared_queue = MonitoredQueue("prepared", prefetch_batches)
+    finished_queue = MonitoredQueue("finished", prefetch_batches)
+    errors: List[BaseException] = []
+    # Set when any stage fails, so the others stop instead of blocking on a queue
+    stop = threading.Event()
+
+    def fail(error: BaseException):
+        errors.append(error)
+        stop.set()
+
+    def prepare(rows) -> Dict:
+        """Resolve, cache-check and tokenize one batch of qrel rows."""
+        with prepare_stage.timed(len(rows)):
+            entries = []
+            for eachline in rows:
+                entry = {"qidx": eachline.qid, "docidx": eachline.docid}
+                entries.append(entry)
+                pair_key = (str(eachline.qid), str(eachline.docid))
+                if pair_key in completed:
+                    entry["completed"] = completed[pair_key]
+                    continue
+                try:
+                    entry["qidx"], entry["docidx"], entry["query"], entry["passage"] = \
+                        lookup_pair(eachline, docid_to_doc, qid_to_query)
+                    with get_run_metrics().stage("render"):
+                        entry["prompt"] = get_umbrella_prompt(entry["query"], entry["passage"], mode)
+                    entry["cache_key"], entry["judgment"] = lookup_cached_judgment(
+                        cache, entry["prompt"], pipeline, system_message, scoring, early_stop)
+                except Exception as e:
+                    entry["error"] = e
+            to_judge = [entry for entry in entries
+                        if "prompt" in entry and "error" not in entry and entry["judgment"] is None]
+            batch = {"entries": entries, "to_judge": to_judge}
+            if to_judge:
+                with get_run_metrics().stage("tokenize"):
+                    batch["rendered"], batch["token_ids"] = encode_prompts(
+                        [entry["prompt"] for entry in to_judge], pipeline, system_message, scoring)
+            return batch
+
+    def produce(executor):
+        """Submit batches in qrel order; the bounded queue limits the lookahead."""
+        try:
+            rows = []
+            for eachline in test_qrel.head(total_pairs).itertuples(index=True):
+                rows.append(eachline)
+                if len(rows) >= batch_size:
+                    if not prepared_queue.put_until(executor.submit(prepare, rows), stop):
+                        return
+                    rows = []
+            if rows and not prepared_queue.put_until(executor.submit(prepare, rows), stop):
+                return
+            prepared_queue.put_until(None, stop)
+        except BaseException as e:
+            fail(e)
+
+    def postprocess(sink, progress):
+        """Turn model outputs into judgments and write every pair in qrel order."""
+        written = 0
+        try:
+            while True:
+                batch = finished_queue.get_until(stop)
+                if batch is None:
+                    return
+                with postprocess_stage.timed(len(batch["entries"])):
+                    for entry, output in zip(batch["to_judge"], batch.get("outputs", [])):
+                        if isinstance(output, Exception):
+                            entry["error"] = output
+                            continue
+                        if scoring == "logits":
+                            entry["judgment"] = judgment_from_distribution(output)
+                        else:
+                            with get_run_metrics().stage("parse"):
+                                entry["judgment"] = {"LLMs_output": output,
+                                                     "final_relevance_score": extract_final_score(output)}
+                        if cache is not None:
+                            cache.put(entry["cache_key"], entry["judgment"])
+                    for entry in batch["entries"]:
+                        qidx, docidx = entry["qidx"], entry["docidx"]
+                        if "completed" in entry:
+                            write_judgment(sink.results, sink.generation_errors, qidx, docidx, entry["completed"])
+                        elif "error" in entry:
+                            write_failure(sink.cuda_errors, qidx, docidx, entry["error"])
+                        else:
+                            scoring_log = build_scoring_log(entry["query"], entry["passage"], entry["judgment"],
+                                                            qidx, docidx, mode)
+                            sink.write_log(scoring_log)
+                            processor.debug_print(qidx, docidx, scoring_log["final_relevance_score"], scoring_log)
+                            write_judgment(sink.results, sink.generation_errors, qidx, docidx,
+                                           scoring_log["final_relevance_score"])
+                        written += 1
+                        progress.update(1)
+                        if written % checkpoint_interval == 0:
+                            sink.checkpoint()
+        except BaseException as e:
+            fail(e)
+
+    def infer(batch, rows: List[int]) -> List:
+        """Run the model on the given rows of a prepared batch."""
+        input_ids, attention_mask = collate_token_ids([batch["token_ids"][i] for i in rows], pipeline)
+        if scoring == "logits":
+            return distributions_from_inputs(
+                input_ids.to(pipeline.model.device), attention_mask.to(pipeline.model.device), pipeline)
+        return generate_from_inputs([batch["rendered"][i] for i in rows], input_ids, attention_mask,
+                                    pipeline, stopping_criterion)
+
+    if resume and rubric_writer is not None:
+        rubric_writer.replay(processor.logs_path, docid_to_doc, qid_to_query)
+    start = time.perf_counter()
+    progress = tqdm(total=total_pairs)
+    with JudgmentLogSink(processor, resume, log_flush_interval, log_flush_records, rubric_writer,
+                         resumed_pairs=len(completed)) as sink, \
+         ThreadPoolExecutor(max_workers=prepare_workers) as executor:
+        producer = threading.Thread(target=produce, args=(executor,), daemon=True)
+        writer = threading.Thread(target=postprocess, args=(sink, progress), daemon=True)
+        producer.start()
+        writer.start()
+        try:
+            while True:
+                future = prepared_queue.get_until(stop)
+                if future is None:
+                    break
+                batch = future.result()
+                if batch["to_judge"]:
+                    with inference_stage.timed(len(batch["to_judge"])):
+                        batch["outputs"] = []
+                        for rows in failure_handler.split(list(range(len(batch["to_judge"])))):
+                            batch["outputs"].extend(failure_handler.run(
+                                rows, lambda part, batch=batch: infer(batch, part),
+                                lambda row, batch=batch: len(batch["token_ids"][row])))
+                if not finished_queue.put_until(batch, stop):
+                    break
+            finished_queue.put_until(None, stop)
+        except BaseException as e:
+            fail(e)
+        producer.join()
+        writer.join()
+        if errors:
+            # Raised inside the sink so the run is closed as incomplete
+            executor.shutdown(cancel_futures=True)
+            progress.close()
+            raise errors[0]
+    progress.close()
+
+    report_stages([prepare_stage, inference_stage, postprocess_stage],
+                  [prepared_queue, finished_queue], time.perf_counter() - start)
+    failure_handler.report()
+    if stopping_criterion is not None:
+        stopping_criterion.report(mode)
+    if cache is not None:
+        cache.report()
+
+
+async def grade_pq_pairs_async(test_qrel, docid_to_doc, qid_to_query, result_path: str,
+                               pipeline: AsyncTogetherPipeline, system_message: str,
+                               mode: str = "zeroshot_bing", max_pairs: Optional[int] = None,
+                               cache=None, resume: bool = False,
+                               checkpoint_interval: int = 100,
+                               log_flush_interval: float = 5.0, log_flush_records: int = 64,
+                               log_format: str = "jsonl", rubric_writer=None):
+    """
+    Process relevance judgments with many Together AI requests in flight.
+    
+    `pipeline.max_in_flight` workers pull pairs from the qrel DataFrame.
+    Finished judgments are held back until every earlier pair is done, then
+    written, so the TREC, log and error files keep the qrel order of the
+    sequential path.
+    """
+    processor = RelevanceProcessor(result_path, log_format)
+    total_pairs = len(test_qrel) if max_pairs is None else min(len(test_qrel), max_pairs)
+    print(f"Processing {total_pairs} pairs out of {len(test_qrel)} total pairs "
+          f"with up to {pipeline.max_in_flight} requests in flight")
+    completed = load_completed_judgments(processor.logs_path) if resume else {}
+    if resume:
+        print(f"Resuming: {len(completed)} pairs already judged in {processor.logs_path}")
+
+    rows = enumerate(test_qrel.head(total_pairs).itertuples(index=True))
+    finished = {}
+    next_to_write = 0
+    progress = tqdm(total=total_pairs)
+
+    if resume and rubric_writer is not None:
+        rubric_writer.replay(processor.logs_path, docid_to_doc, qid_to_query)
+    pipeline.start()
+    try:
+        with JudgmentLogSink(processor, resume, log_flush_interval, log_flush_records, rubric_writer,
+                             resumed_pairs=len(completed)) as sink:
+            result_file = sink.results
+            generation_errors_file = sink.generation_errors
+            cuda_errors_file = sink.cuda_errors
+
+            def write_ready():
+                """Write the contiguous run of finished pairs that follows the last written one."""
+                nonlocal next_to_write
+                while next_to_write in finished:
+                    qidx, docidx, outcome = finished.pop(next_to_write)
+                    if isinstance(outcome, Exception):
+                        write_failure(cuda_errors_file, qidx, docidx, outcome)
+                    elif isinstance(outcome, int):
+                        # Judged by an earlier run
+                        write_judgment(result_file, generation_errors_file, qidx, docidx, outcome)
+                    else:
+                        final_score, scoring_log = outcome
+                        sink.write_log(scoring_log)
+                        processor.debug_print(qidx, docidx, final_score, scoring_log)
+                        write_judgment(result_file, generation_errors_file, qidx, docidx, final_score)
+                    next_to_write += 1
+                    progress.update(1)
+                    if next_to_write % checkpoint_interval == 0:
+                        sink.checkpoint()
+
+            async def worker():
+                for idx, eachline in rows:
+                    qidx, docidx = eachline.qid, eachline.docid
+                    pair_key = (str(qidx), str(docidx))
+                    if pair_key in completed:
+                        finished[idx] = (qidx, docidx, completed[pair_key])
+                        write_ready()
+                        continue
+                    try:
+                        qidx, docidx, query, passage = lookup_pair(eachline, docid_to_doc, qid_to_query)
+                        outcome = await agrade_pq_pair(
+                            query=query,
+                            passage=passage,
+                            pipeline=pipeline,
+                            system_message=system_message,
+                            qidx=qidx,
+                            docidx=docidx,
+                            mode=mode,
+                            cache=cache
+                        )
+                    except Exception as e:
+                        outcome = e
+                    finished[idx] = (qidx, docidx, outcome)
+                    write_ready()
+
+            await asyncio.gather(*(worker() for _ in range(pipeline.max_in_flight)))
+    finally:
+        await pipeline.aclose()
+
+    progress.close()
+    print(f"Together requests retried: {pipeline.retry_count}")
+    if cache is not None:
+        cache.report()
@@ -1,24 +1,83 @@
 
 
-from typing import Dict, Tuple, Optional
+from typing import TYPE_CHECKING, Dict, List, Tuple, Optional
 import json
+import math
 import re
-import torch
-from model_utils import TogetherPipeline
-from prompts import get_umbrella_prompt
+from model_utils import TogetherPipeline, AsyncTogetherPipeline, OpenAICompatiblePipeline
+from prompts import get_umbrella_prompt, get_prompt_registry
+from metrics import get_run_metrics
 
+if TYPE_CHECKING:
+    # torch and transformers are imported where a local model is run, so
+    # API-backed runs never load them
+    import torch
+    from early_stop import FinalScoreStoppingCriteria
 
+# Settings of the free-generation path; part of every judgment cache key
+GENERATION_PARAMS = {"max_new_tokens": 100, "do_sample": False}
 
-def get_relevance_score_baseline(prompt: str, pipeline, system_message: str) -> str:
+# Forced answer prefix for single-step logits scoring
+SCORE_PROMPT_SUFFIX = "##final score:"
+SCORE_GRADES = ["0", "1", "2", "3"]
+
+# Score format that ends free generation early; the same pattern
+# `extract_final_score` tries first, so its first match decides the score
+FINAL_SCORE_PATTERN = re.compile(r'##final score:\s*[0-3]')
+# Text preceding the grade token when reading grades from API logprobs
+SCORE_PREFIX_PATTERN = re.compile(r'final score:\s*$', re.IGNORECASE)
+
+# Cache key parameters per scoring mode
+SCORING_PARAMS = {
+    "generate": GENERATION_PARAMS,
+    "logits": {"scoring": "logits", "suffix": SCORE_PROMPT_SUFFIX},
+}
+
+
+def build_messages(prompt: str, system_message: str) -> List[Dict]:
+    """Wrap a UMBRELA prompt into the chat messages sent to every backend."""
+    return [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def has_chat_template(tokenizer) -> bool:
+    """Check whether a tokenizer ships a usable chat template."""
+    return getattr(tokenizer, "chat_template", None) is not None
+
+
+def apply_chat_template(prompt: str, messages: List[Dict], tokenizer) -> str:
+    """
+    Render the messages with the tokenizer's chat template when it has one,
+    otherwise fall back to the bare prompt (dropping the system message).
+    """
+    if hasattr(tokenizer, "apply_chat_template"):
+        if has_chat_template(tokenizer):
+            # Pre-rendered scaffolding from the registry when the template allows it
+            rendered = get_prompt_registry().apply_chat(prompt, tokenizer, messages[0]["content"])
+            if rendered is not None:
+                return rendered
+            return tokenizer.apply_chat_template(
+                messages,
+                tokenize=False,
+                add_generation_prompt=True
+            )
+        if not hasattr(get_relevance_score_baseline, "warning"):
+            get_relevance_score_baseline.warning = True
+            print("Warning: No chat template available, using only the prompt (and not the system message).")
+    return f"{prompt}"
+
+
+def get_relevance_score_baseline(prompt: str, pipeline, system_message: str,
+                                 stopping_criterion: Optional["FinalScoreStoppingCriteria"] = None) -> str:
     """
     Get model response for a given prompt, handling both Together AI and standard pipelines.
     
     The function includes first-run logging to help with debugging and verification.
+    A `stopping_criterion` ends local generation once the final score is out.
     """
-    messages = [
-        {"role": "system", "content": system_message},
-        {"role": "user", "content": prompt},
-    ]
+    messages = build_messages(prompt, system_message)
     
     # First-run logging for debugging
     if not hasattr(get_relevance_score_baseline, "called"):
@@ -26,14 +85,19 @@ def get_relevance_score_baseline(prompt: str, pipeline, system_message: str) ->
         print("Initial messages for verification:")
         print(messages)
 
+    metrics = get_run_metrics()
     # Handle Together AI models
     if isinstance(pipeline, TogetherPipeline):
         if not hasattr(get_relevance_score_baseline, "output_from_together"):
             get_relevance_score_baseline.output_from_together = True
             print("Using Together AI model for inference")
         
-        outputs = pipeline(messages)
+        with metrics.stage("generate"):
+            outputs = pipeline(messages)
         output = outputs[0]["generated_text"]
+        usage = outputs[0].get("usage")
+        if usage is not None:
+            metrics.record_tokens(usage["prompt_tokens"], usage["completion_tokens"])
     
     # Handle standard pipeline models
     else:
@@ -43,44 +107,140 @@ def get_relevance_score_baseline(prompt: str, pipeline, system_message: str) ->
         ]
         
         # Process chat template if available
-        if hasattr(pipeline.tokenizer, "apply_chat_template"):
-            if hasattr(pipeline.tokenizer, 'chat_template') and pipeline.tokenizer.chat_template is not None:
-                prompt = pipeline.tokenizer.apply_chat_template(
-                    messages,
-                    tokenize=False,
-                    add_generation_prompt=True
-                )
-            else:
-                if not hasattr(get_relevance_score_baseline, "warning"):
-                    get_relevance_score_baseline.warning = True
-                    print("Warning: No chat template available, using only the prompt (and not the system message).")
-                prompt = f"{prompt}"
-        else:
-            prompt = f"{prompt}"
+        with metrics.stage("chat_template"):
+            prompt = apply_chat_template(prompt, messages, pipeline.tokenizer)
+
+        generation_kwargs = {}
+        if stopping_criterion is not None:
+            generation_kwargs.update(stopping_criterion.generation_kwargs())
 
         # Generate model output
-        outputs = pipeline(
-            prompt,
-            max_new_tokens=100,
-            eos_token_id=terminators,
-            pad_token_id=128009,
-            do_sample=False,
-            temperature=None,
-            top_p=None,
-        )
+        with metrics.stage("generate"):
+            outputs = pipeline(
+                prompt,
+                max_new_tokens=100,
+                eos_token_id=terminators,
+                pad_token_id=128009,
+                do_sample=False,
+                temperature=None,
+                top_p=None,
+                **generation_kwargs
+            )
         output = outputs[0]["generated_text"]
 
         # Return generated text without the prompt if chat template was used, otherwise return full text
-        if hasattr(pipeline.tokenizer, 'chat_template') and pipeline.tokenizer.chat_template is not None:
+        if has_chat_template(pipeline.tokenizer):
             output =  outputs[0]["generated_text"][len(prompt):]
         else:
             output = outputs[0]["generated_text"]
+        if metrics.enabled:
+            # Without a chat template, text-generation pipelines echo the prompt
+            echoes_prompt = pipeline.task == "text-generation" and not has_chat_template(pipeline.tokenizer)
+            metrics.record_text_tokens(pipeline.tokenizer, [prompt], [output[len(prompt):] if echoes_prompt else output])
     if not hasattr(get_relevance_score_baseline, "print_one_output"):
         get_relevance_score_baseline.print_one_output = True
         print(f"sample output: {output}")   
     return output
 
 
+def get_relevance_scores_batched(prompts: List[str], pipeline, system_message: str,
+                                 stopping_criterion: Optional["FinalScoreStoppingCriteria"] = None) -> List[str]:
+    """
+    Get model responses for several prompts at once.
+    
+    Local HF pipelines receive all prompts as one padded batch (left-padded for
+    causal models so generation continues right after each prompt). Together AI
+    has no batch endpoint, so its prompts are sent one after another.
+    
+    Returns:
+        List[str]: One model output per prompt, in input order
+    """
+    if isinstance(pipeline, TogetherPipeline):
+        return [get_relevance_score_baseline(prompt, pipeline, system_message) for prompt in prompts]
+
+    generation_kwargs = {}
+    if stopping_criterion is not None:
+        generation_kwargs.update(stopping_criterion.generation_kwargs())
+
+    tokenizer = pipeline.tokenizer
+    if pipeline.task == "text-generation":
+        tokenizer.padding_side = "left"
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+
+    terminators = [
+        tokenizer.eos_token_id,
+        tokenizer.convert_tokens_to_ids("<|eot_id|>")
+    ]
+    metrics = get_run_metrics()
+    with metrics.stage("chat_template"):
+        rendered_prompts = [
+            apply_chat_template(prompt, build_messages(prompt, system_message), tokenizer)
+            for prompt in prompts
+        ]
+
+    if not hasattr(get_relevance_score_baseline, "called"):
+        get_relevance_score_baseline.called = True
+        print("Initial messages for verification:")
+        print(build_messages(prompts[0], system_message))
+
+    with metrics.stage("generate"):
+        outputs = pipeline(
+            rendered_prompts,
+            batch_size=len(rendered_prompts),
+            max_new_tokens=100,
+            eos_token_id=terminators,
+            pad_token_id=tokenizer.pad_token_id,
+            do_sample=False,
+            temperature=None,
+            top_p=None,
+            **generation_kwargs
+        )
+
+    results = []
+    for rendered_prompt, output in zip(rendered_prompts, outputs):
+        # text-generation returns a list per input, text2text-generation a dict
+        if isinstance(output, list):
+            output = output[0]
+        text = output["generated_text"]
+        if has_chat_template(tokenizer):
+            text = text[len(rendered_prompt):]
+        results.append(text)
+    if metrics.enabled:
+        generated = results
+        if pipeline.task == "text-generation" and not has_chat_template(tokenizer):
+            generated = [text[len(rendered_prompt):] for rendered_prompt, text in zip(rendered_prompts, results)]
+        metrics.record_text_tokens(tokenizer, rendered_prompts, generated)
+
+    if not hasattr(get_relevance_score_baseline, "print_one_output"):
+        get_relevance_score_baseline.print_one_output = True
+        print(f"sample output: {results[0]}")
+    return results
+
+
+def get_relevance_outputs_api(prompts: List[str], pipeline: TogetherPipeline, system_message: str,
+                              logprobs: bool = False) -> List[Dict]:
+    """
+    Send several prompts to an API backend.
+    
+    OpenAI-compatible servers get the requests in parallel over their
+    connection pool; the Together backend answers them one after another.
+    
+    Returns:
+        List of output dicts with `generated_text` (and `logprobs` when requested)
+    """
+    messages_batch = [build_messages(prompt, system_message) for prompt in prompts]
+    metrics = get_run_metrics()
+    with metrics.stage("generate"):
+        if isinstance(pipeline, OpenAICompatiblePipeline):
+            outputs = pipeline.generate_batch(messages_batch, logprobs=logprobs)
+        else:
+            outputs = [pipeline(messages)[0] for messages in messages_batch]
+    for output in outputs:
+        usage = output.get("usage")
+        if usage is not None:
+            metrics.record_tokens(usage["prompt_tokens"], usage["completion_tokens"])
+    return outputs
 
 
 def find_first_number(text: str) -> Optional[int]:
@@ -114,31 +274,13 @@ def find_first_number(text: str) -> Optional[int]:
 
 
 
-def grade_each_pq_pair(query: str, passage: str, pipeline, 
-                  log_file_path: str, system_message: str,
-                  qidx: str, docidx: str, mode: str ) -> Tuple[Optional[int], Dict[str, int]]:
+def extract_final_score(llms_output: str) -> int:
     """
-    Grade the relevance of a passage-query pair using UMBRELA methodology.
+    Extract the UMBRELA relevance score (0-3) from a model output.
     
-    Args:
-        query (str): The search query
-        passage (str): The passage to evaluate
-        pipeline: The model pipeline (Together AI or standard)
-        log_file_path (str): Path to log results
-        system_message (str): System message (empty for UMBRELA)
-        qidx (str): Query ID
-        docidx (str): Document ID
-        mode (str): UMBRELA prompt mode (default: "zeroshot_bing")
-        
-    Returns:
-        Tuple[Optional[int], Dict[str, int]]: Final relevance score and scoring log
+    Looks for the "##final score: X" format first and falls back to
+    `find_first_number`; anything outside 0-3 becomes 0.
     """
-    # Generate UMBRELA prompt
-    prompt = get_umbrella_prompt(query=query, passage=passage, mode=mode)
-    
-    # Get model response
-    # print(prompt)
-    llms_output = get_relevance_score_baseline(prompt, pipeline, system_message)
     # Extract score using regex pattern specific to UMBRELA format
     score_pattern = r'##final score:\s*([0-3])'
     match = re.search(score_pattern, llms_output)
@@ -152,21 +294,498 @@ def grade_each_pq_pair(query: str, passage: str, pipeline,
     # Ensure score is within valid range
     if final_score not in [0, 1, 2, 3]:
         final_score = 0  # Default to 0 for invalid scores
+    return final_score
+
+
+def build_scoring_log(query: str, passage: str, judgment: Dict,
+                      qidx: str, docidx: str, mode: str) -> Dict:
+    """
+    Build the per-pair record written to the logs JSONL.
     
-    # Log results for analysis
+    `judgment` holds `LLMs_output` and `final_relevance_score`, plus any
+    extra fields of the scoring mode (e.g. the logits score distribution).
+    """
     scoring_log = {
         "prompt_mode":mode,
         "qidx": qidx,
         "docidx": docidx,
         "query": query,
         "passage": passage,
-        "LLMs_output": llms_output,
-        "final_relevance_score": final_score,
+        "LLMs_output": judgment["LLMs_output"],
+        "final_relevance_score": judgment["final_relevance_score"],
         "prompt_mode": mode
     }
+    scoring_log.update(judgment)
+    return scoring_log
+
+
+def get_grade_token_ids(tokenizer) -> List[List[int]]:
+    """
+    Collect the vocabulary ids that spell each grade "0" to "3".
+    
+    A grade can be emitted with or without a leading space (or as a
+    sentencepiece "▁3" piece), so every single-token spelling is kept.
+    """
+    if not hasattr(tokenizer, "umbrella_grade_token_ids"):
+        grade_token_ids = []
+        for grade in SCORE_GRADES:
+            ids = set()
+            for spelling in [grade, f" {grade}"]:
+                encoded = tokenizer.encode(spelling, add_special_tokens=False)
+                if len(encoded) == 1:
+                    ids.add(encoded[0])
+            piece_id = tokenizer.convert_tokens_to_ids(f"\u2581{grade}")
+            if piece_id is not None and piece_id != tokenizer.unk_token_id:
+                ids.add(piece_id)
+            if not ids:
+                raise ValueError(f"Tokenizer has no single token for grade {grade}; use --scoring generate")
+            grade_token_ids.append(sorted(ids))
+        tokenizer.umbrella_grade_token_ids = grade_token_ids
+    return tokenizer.umbrella_grade_token_ids
+
+
+def get_relevance_distributions_logits(prompts: List[str], pipeline,
+                                       system_message: str) -> List[List[float]]:
+    """
+    Score prompts with a single forward pass each instead of free generation.
+    
+    Causal models read the next-token logits after the chat-templated prompt
+    followed by a forced "##final score:"; seq2seq models read the first
+    decoder step. The probability mass of the "0"-"3" tokens is renormalised
+    into a 4-way grade distribution.
+    
+    Returns:
+        List of [p0, p1, p2, p3] distributions, one per prompt
+    """
+    if isinstance(pipeline, TogetherPipeline):
+        raise ValueError("Logits scoring needs a local model; the Together backend only supports --scoring generate")
+
+    tokenizer = pipeline.tokenizer
+    model = pipeline.model
+    # Fail early if the tokenizer cannot spell the grades as single tokens
+    get_grade_token_ids(tokenizer)
+    is_seq2seq = pipeline.task == "text2text-generation"
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+
+    metrics = get_run_metrics()
+    if is_seq2seq:
+        tokenizer.padding_side = "right"
+        with metrics.stage("tokenize"):
+            inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+    else:
+        # Left padding keeps every prompt's last token in the final position
+        tokenizer.padding_side = "left"
+        with metrics.stage("chat_template"):
+            rendered_prompts = [render_logits_prompt(prompt, tokenizer, system_message) for prompt in prompts]
+        with metrics.stage("tokenize"):
+            inputs = tokenizer(
+                rendered_prompts, return_tensors="pt", padding=True,
+                add_special_tokens=not has_chat_template(tokenizer)
+            ).to(model.device)
+
+    return distributions_from_inputs(inputs["input_ids"], inputs["attention_mask"], pipeline)
+
+
+def distributions_from_inputs(input_ids: "torch.Tensor", attention_mask: "torch.Tensor",
+                              pipeline) -> List[List[float]]:
+    """Run the logits forward pass on padded inputs (right-padded for seq2seq, left-padded otherwise)."""
+    import torch
+    model = pipeline.model
+    model_inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+    if pipeline.task == "text2text-generation":
+        model_inputs["decoder_input_ids"] = torch.full(
+            (input_ids.shape[0], 1), model.config.decoder_start_token_id,
+            dtype=torch.long, device=model.device
+        )
+    metrics = get_run_metrics()
+    with metrics.stage("generate"), torch.no_grad():
+        logits = model(**model_inputs).logits[:, -1, :]
+    # A logits pass reads one step and generates no tokens
+    for prompt_tokens in attention_mask.sum(dim=-1).tolist():
+        metrics.record_tokens(prompt_tokens, 0)
+    return grade_distributions_from_logits(logits, pipeline.tokenizer)
+
+
+def render_logits_prompt(prompt: str, tokenizer, system_message: str) -> str:
+    """Render a causal-model prompt for logits scoring, ending in the forced score prefix."""
+    rendered = apply_chat_template(prompt, build_messages(prompt, system_message), tokenizer)
+    if not has_chat_template(tokenizer):
+        rendered += "\n"
+    return rendered + SCORE_PROMPT_SUFFIX
+
+
+def grade_distributions_from_logits(logits: "torch.Tensor", tokenizer) -> List[List[float]]:
+    """Renormalise next-token logits of shape (batch, vocab) into 0-3 grade distributions."""
+    import torch
+    grade_token_ids = get_grade_token_ids(tokenizer)
+    log_probs = torch.log_softmax(logits.float(), dim=-1)
+    grade_log_probs = torch.stack(
+        [torch.logsumexp(log_probs[:, ids], dim=-1) for ids in grade_token_ids], dim=-1
+    )
+    return torch.softmax(grade_log_probs, dim=-1).tolist()
+
+
+def judgment_from_distribution(distribution: List[float]) -> Dict:
+    """Turn a 0-3 grade distribution into the judgment fields of a log record."""
+    final_score = max(range(len(distribution)), key=lambda grade: distribution[grade])
+    return {
+        "LLMs_output": f"{SCORE_PROMPT_SUFFIX} {final_score}",
+        "final_relevance_score": final_score,
+        "score_distribution": distribution,
+        "expected_relevance": sum(grade * p for grade, p in enumerate(distribution)),
+    }
+
+
+def distribution_from_logprobs(token_logprobs: List[Dict]) -> Optional[List[float]]:
+    """
+    Read a 0-3 grade distribution from the OpenAI-style logprobs of a generation.
+    
+    Finds the first generated grade token that follows "final score:" and
+    renormalises the probability mass of the "0"-"3" candidates among that
+    position's top logprobs (grades missing from the top list get 0).
+    
+    Returns:
+        [p0, p1, p2, p3], or None when the output holds no such token
+    """
+    text = ""
+    for entry in token_logprobs:
+        if entry["token"].strip() in SCORE_GRADES and SCORE_PREFIX_PATTERN.search(text):
+            probabilities = [0.0] * len(SCORE_GRADES)
+            for candidate in entry.get("top_logprobs") or [entry]:
+                grade = candidate["token"].strip()
+                if grade in SCORE_GRADES:
+                    probabilities[int(grade)] += math.exp(candidate["logprob"])
+            total = sum(probabilities)
+            return [p / total for p in probabilities]
+        text += entry["token"]
+    return None
+
+
+def get_relevance_judgments_logprobs(prompts: List[str], pipeline: OpenAICompatiblePipeline,
+                                     system_message: str) -> List[Dict]:
+    """
+    Logits scoring on an OpenAI-compatible server: generate with logprobs and
+    read the grade distribution at the final score token.
+    
+    Outputs without a readable grade token fall back to regex parsing and
+    carry no distribution.
+    """
+    outputs = get_relevance_outputs_api(prompts, pipeline, system_message, logprobs=True)
+    judgments = []
+    with get_run_metrics().stage("parse"):
+        for output in outputs:
+            llms_output = output["generated_text"]
+            distribution = distribution_from_logprobs(output.get("logprobs") or [])
+            if distribution is None:
+                judgments.append({"LLMs_output": llms_output,
+                                  "final_relevance_score": extract_final_score(llms_output)})
+            else:
+                judgments.append(dict(judgment_from_distribution(distribution), LLMs_output=llms_output))
+    return judgments
+
+
+def judge_prompts(prompts: List[str], pipeline, system_message: str,
+                  scoring: str = "generate",
+                  stopping_criterion: Optional["FinalScoreStoppingCriteria"] = None) -> List[Dict]:
+    """
+    Judge rendered UMBRELA prompts with the selected scoring mode.
+    
+    Args:
+        prompts: UMBRELA prompts, judged as one batch
+        pipeline: The model pipeline (Together AI or standard)
+        system_message: System message (empty for UMBRELA)
+        scoring: "generate" for free generation plus regex parsing, "logits"
+            for single-step grade logits (grade logprobs on OpenAI-compatible
+            servers)
+        stopping_criterion: Optional early stop for free generation
+        
+    Returns:
+        List of judgment dicts with `LLMs_output` and `final_relevance_score`
+    """
+    if scoring == "logits" and isinstance(pipeline, OpenAICompatiblePipeline):
+        return get_relevance_judgments_logprobs(prompts, pipeline, system_message)
+    if scoring == "logits":
+        distributions = get_relevance_distributions_logits(prompts, pipeline, system_message)
+        return [judgment_from_distribution(distribution) for distribution in distributions]
+    if len(prompts) == 1:
+        llms_outputs = [get_relevance_score_baseline(prompts[0], pipeline, system_message, stopping_criterion)]
+    elif isinstance(pipeline, TogetherPipeline):
+        llms_outputs = [output["generated_text"]
+                        for output in get_relevance_outputs_api(prompts, pipeline, system_message)]
+    else:
+        llms_outputs = get_relevance_scores_batched(prompts, pipeline, system_message, stopping_criterion)
+    with get_run_metrics().stage("parse"):
+        return [{"LLMs_output": llms_output, "final_relevance_score": extract_final_score(llms_output)}
+                for llms_output in llms_outputs]
+
+
+def encode_prompts(prompts: List[str], pipeline, system_message: str,
+                   scoring: str = "generate") -> Tuple[List[str], List[List[int]]]:
+    """
+    Render and tokenize prompts for a local pipeline, without padding.
+    
+    Produces the same token ids the pipeline-based paths feed the model.
+    Tokenizer settings are not changed, so worker threads can call this
+    while the model runs.
+    
+    Returns:
+        Tuple of (rendered model inputs, token ids per prompt)
+    """
+    tokenizer = pipeline.tokenizer
+    is_seq2seq = pipeline.task == "text2text-generation"
+    add_special_tokens = True
+    if scoring == "logits" and not is_seq2seq:
+        rendered = [render_logits_prompt(prompt, tokenizer, system_message) for prompt in prompts]
+        add_special_tokens = not has_chat_template(tokenizer)
+    elif scoring == "logits":
+        rendered = list(prompts)
+    else:
+        rendered = [apply_chat_template(prompt, build_messages(prompt, system_message), tokenizer)
+                    for prompt in prompts]
+        if is_seq2seq:
+            rendered = [(getattr(pipeline, "prefix", None) or "") + text for text in rendered]
+    return rendered, tokenizer(rendered, add_special_tokens=add_special_tokens)["input_ids"]
+
+
+def collate_token_ids(token_ids: List[List[int]], pipeline) -> Tuple["torch.Tensor", "torch.Tensor"]:
+    """Pad token id lists into input_ids/attention_mask tensors the way the pipeline batches them."""
+    import torch
+    pad_token_id = pipeline.tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = pipeline.tokenizer.eos_token_id
+    left = pipeline.task == "text-generation"
+    longest = max(len(ids) for ids in token_ids)
+    input_ids = torch.full((len(token_ids), longest), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(token_ids), longest), dtype=torch.long)
+    for row, ids in enumerate(token_ids):
+        span = slice(longest - len(ids), longest) if left else slice(0, len(ids))
+        input_ids[row, span] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, span] = 1
+    return input_ids, attention_mask
+
+
+def generate_from_inputs(rendered_prompts: List[str], input_ids: "torch.Tensor",
+                         attention_mask: "torch.Tensor", pipeline,
+                         stopping_criterion: Optional["FinalScoreStoppingCriteria"] = None) -> List[str]:
+    """
+    Free generation on pre-tokenized, padded inputs.
+    
+    Decodes like the HF pipelines do, so outputs match
+    `get_relevance_scores_batched` on the same prompts.
+    
+    Returns:
+        List[str]: One model output per prompt, in input order
+    """
+    import torch
+    tokenizer = pipeline.tokenizer
+    model = pipeline.model
+    generation_kwargs = {}
+    if stopping_criterion is not None:
+        generation_kwargs.update(stopping_criterion.generation_kwargs())
+    terminators = [
+        tokenizer.eos_token_id,
+        tokenizer.convert_tokens_to_ids("<|eot_id|>")
+    ]
+    input_ids = input_ids.to(model.device)
+    metrics = get_run_metrics()
+    with metrics.stage("generate"), torch.no_grad():
+        outputs = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask.to(model.device),
+            max_new_tokens=GENERATION_PARAMS["max_new_tokens"],
+            eos_token_id=terminators,
+            pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+            do_sample=False,
+            temperature=None,
+            top_p=None,
+            **generation_kwargs
+        )
+
+    results = []
+    generated = []
+    for row, rendered_prompt in enumerate(rendered_prompts):
+        if pipeline.task == "text2text-generation":
+            results.append(tokenizer.decode(outputs[row], skip_special_tokens=True,
+                                            clean_up_tokenization_spaces=False))
+            generated.append(results[-1])
+            continue
+        decode_kwargs = {"skip_special_tokens": True, "clean_up_tokenization_spaces": True}
+        prompt_length = len(tokenizer.decode(input_ids[row], **decode_kwargs))
+        generated_text = tokenizer.decode(outputs[row], **decode_kwargs)[prompt_length:]
+        results.append(generated_text if has_chat_template(tokenizer) else rendered_prompt + generated_text)
+        generated.append(generated_text)
+    if metrics.enabled:
+        with metrics.stage("token_count"):
+            output_ids = tokenizer(generated, add_special_tokens=False)["input_ids"]
+        for prompt_tokens, ids in zip(attention_mask.sum(dim=-1).tolist(), output_ids):
+            metrics.record_tokens(prompt_tokens, len(ids))
+    return results
+
+
+def backend_cache_params(pipeline) -> Dict:
+    """Backend settings that change a model's outputs; part of every judgment cache key."""
+    if isinstance(pipeline, OpenAICompatiblePipeline):
+        return {"backend": "openai", "base_url": pipeline.base_url}
+    if isinstance(pipeline, TogetherPipeline):
+        return {"backend": "together"}
+    return {"backend": "local", **getattr(pipeline, "backend_settings", {})}
+
+
+def lookup_cached_judgment(cache, prompt: str, pipeline, system_message: str,
+                           scoring: str = "generate",
+                           early_stop: bool = False) -> Tuple[Optional[str], Optional[Dict]]:
+    """
+    Look up a prompt in the judgment cache.
+    
+    The key covers the rendered prompt (the chat-templated text for local
+    pipelines, the JSON messages for API backends), the scoring settings and
+    the backend: the server of an OpenAI-compatible backend, and the device,
+    dtype and quantisation of a local model.
+    
+    Returns:
+        Tuple of (cache key, cached judgment or None); both are None when
+        caching is disabled
+    """
+    if cache is None:
+        return None, None
+    messages = build_messages(prompt, system_message)
+    if isinstance(pipeline, TogetherPipeline):
+        rendered_prompt = json.dumps(messages)
+    else:
+        rendered_prompt = apply_chat_template(prompt, messages, pipeline.tokenizer)
+    params = dict(SCORING_PARAMS[scoring], **backend_cache_params(pipeline))
+    if early_stop and scoring == "generate":
+        params["stop_at_final_score"] = True
+    with get_run_metrics().stage("cache"):
+        cache_key = cache.make_key(rendered_prompt, params)
+        return cache_key, cache.get(cache_key)
+
+
+def grade_each_pq_pair(query: str, passage: str, pipeline, 
+                  log_sink, system_message: str,
+                  qidx: str, docidx: str, mode: str, cache=None,
+                  scoring: str = "generate",
+                  stopping_criterion: Optional["FinalScoreStoppingCriteria"] = None,
+                  prefix_cache=None) -> Tuple[Optional[int], Dict[str, int]]:
+    """
+    Grade the relevance of a passage-query pair using UMBRELA methodology.
+    
+    Args:
+        query (str): The search query
+        passage (str): The passage to evaluate
+        pipeline: The model pipeline (Together AI or standard)
+        log_sink: JudgmentLogSink receiving the scoring log, or None when the
+            caller writes it itself
+        system_message (str): System message (empty for UMBRELA)
+        qidx (str): Query ID
+        docidx (str): Document ID
+        mode (str): UMBRELA prompt mode (default: "zeroshot_bing")
+        cache: Optional JudgmentCache consulted before calling the model
+        scoring (str): "generate" (default) or "logits"
+        stopping_criterion: Optional early stop for free generation
+        prefix_cache: Optional PrefixKVCache reusing the prefilled static prompt prefix
+        
+    Returns:
+        Tuple[Optional[int], Dict[str, int]]: Final relevance score and scoring log
+    """
+    # Generate UMBRELA prompt
+    with get_run_metrics().stage("render"):
+        prompt = get_umbrella_prompt(query=query, passage=passage, mode=mode)
+    
+    cache_key, judgment = lookup_cached_judgment(
+        cache, prompt, pipeline, system_message, scoring, stopping_criterion is not None)
+    if judgment is None:
+        # Get model response
+        # print(prompt)
+        if prefix_cache is not None:
+            judgment = prefix_cache.judge(query, passage, mode, scoring, stopping_criterion)
+        else:
+            judgment = judge_prompts([prompt], pipeline, system_message, scoring, stopping_criterion)[0]
+        if cache is not None:
+            cache.put(cache_key, judgment)
+    
+    # Log results for analysis
+    scoring_log = build_scoring_log(query, passage, judgment, qidx, docidx, mode)
 
     # Append to log file
-    with open(log_file_path, "a") as f:
-        f.write(json.dumps(scoring_log) + "\n")  # Write each log on new line
+    if log_sink is not None:
+        log_sink.write_log(scoring_log)
+
+    return scoring_log["final_relevance_score"], scoring_log
+
+
+def grade_pq_pair_batch(pairs: List[Tuple[str, str, str, str]], pipeline,
+                        log_sink, system_message: str,
+                        mode: str, cache=None, scoring: str = "generate",
+                        stopping_criterion: Optional["FinalScoreStoppingCriteria"] = None) -> List[Tuple[int, Dict]]:
+    """
+    Grade several passage-query pairs with a single batched model call.
+    
+    Pairs found in the judgment cache are left out of the batch.
+    
+    Args:
+        pairs: List of (qidx, docidx, query, passage) tuples
+        pipeline: The model pipeline (Together AI or standard)
+        log_sink: JudgmentLogSink receiving the scoring logs, or None when the
+            caller writes them itself
+        system_message (str): System message (empty for UMBRELA)
+        mode (str): UMBRELA prompt mode
+        cache: Optional JudgmentCache consulted before calling the model
+        scoring (str): "generate" (default) or "logits"
+        stopping_criterion: Optional early stop for free generation
+        
+    Returns:
+        List[Tuple[int, Dict]]: Final score and scoring log per pair, in input order
+    """
+    with get_run_metrics().stage("render"):
+        prompts = [get_umbrella_prompt(query=query, passage=passage, mode=mode)
+                   for _, _, query, passage in pairs]
+    lookups = [lookup_cached_judgment(cache, prompt, pipeline, system_message, scoring,
+                                      stopping_criterion is not None)
+               for prompt in prompts]
+    uncached = [i for i, (_, cached) in enumerate(lookups) if cached is None]
+
+    judgments = [cached for _, cached in lookups]
+    if uncached:
+        new_judgments = judge_prompts([prompts[i] for i in uncached], pipeline, system_message,
+                                      scoring, stopping_criterion)
+        for i, judgment in zip(uncached, new_judgments):
+            judgments[i] = judgment
+            if cache is not None:
+                cache.put(lookups[i][0], judgment)
+
+    results = []
+    for (qidx, docidx, query, passage), judgment in zip(pairs, judgments):
+        scoring_log = build_scoring_log(query, passage, judgment, qidx, docidx, mode)
+        if log_sink is not None:
+            log_sink.write_log(scoring_log)
+        results.append((scoring_log["final_relevance_score"], scoring_log))
+    return results
+
 
-    return final_score, scoring_log
\ No newline at end of file
+
+async def agrade_pq_pair(query: str, passage: str, pipeline: AsyncTogetherPipeline,
+                         system_message: str, qidx: str, docidx: str,
+                         mode: str, cache=None) -> Tuple[int, Dict]:
+    """
+    Grade one passage-query pair through the concurrent Together backend.
+    
+    Unlike `grade_each_pq_pair` this does not write the log record; the caller
+    appends it once earlier pairs have finished so the log stays in qrel order.
+    
+    Returns:
+        Tuple[int, Dict]: Final relevance score and scoring log
+    """
+    metrics = get_run_metrics()
+    with metrics.stage("render"):
+        prompt = get_umbrella_prompt(query=query, passage=passage, mode=mode)
+    cache_key, judgment = lookup_cached_judgment(cache, prompt, pipeline, system_message)
+    if judgment is None:
+        llms_output = await pipeline.agenerate(build_messages(prompt, system_message))
+        with metrics.stage("parse"):
+            judgment = {"LLMs_output": llms_output, "final_relevance_score": extract_final_score(llms_output)}
+        if cache is not None:
+            cache.put(cache_key, judgment)
+    scoring_log = build_scoring_log(query, passage, judgment, qidx, docidx, mode)
+    return scoring_log["final_relevance_score"], scoring_log
@@ -0,0 +1,118 @@
+"""
+Multi-job runner.
+Runs many (dataset, prompt mode) jobs from a manifest while loading each
+model only once, instead of starting `main.py` (and re-importing torch and
+reloading the weights) for every combination.
+
+Manifest format (JSON or YAML), either a plain list of jobs or:
+
+    defaults:
+      model_id: meta-llama/Meta-Llama-3-8B-Instruct
+      batch_size: 8
+    jobs:
+      - test_qrel_path: ./data/dl2019/2019qrels-pass.txt
+        queries_path: ./data/dl2019/msmarco-test2019-queries.tsv
+        docs_path: ./data/dl2019/dl2019_document.jsonl
+        prompt_mode: zeroshot_bing
+        result_file_path: ./results/dl19_test_zeroshot_bing_Llama-3-8B-Instruct.txt
+
+Job keys are the `main.py` option names (`together` for `-together`).
+"""
+
+import argparse
+import gc
+import json
+from pathlib import Path
+from typing import Dict, List
+
+from main import REQUIRED_OPTIONS, build_parser, load_model, load_small_model, run_job, setup_logging, validate_job
+
+# Options that determine the loaded backend; jobs sharing them share a model
+MODEL_KEYS = ["model_id", "together", "concurrency", "requests_per_minute", "tokens_per_minute",
+              "cascade_small_model", "device", "quant", "compile", "num_threads",
+              "openai_base_url", "api_timeout", "max_retries", "retry_backoff"]
+
+
+def load_manifest(manifest_path: str) -> List[Dict]:
+    """
+    Read a job manifest and apply its defaults to every job.
+    
+    Returns:
+        List of job dictionaries
+    """
+    path = Path(manifest_path)
+    with open(path, 'r') as f:
+        if path.suffix in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("YAML manifests need PyYAML: pip install pyyaml")
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    if isinstance(manifest, list):
+        defaults, jobs = {}, manifest
+    else:
+        defaults, jobs = manifest.get("defaults", {}), manifest["jobs"]
+    return [{**defaults, **job} for job in jobs]
+
+
+def make_job_args(job: Dict, parser: argparse.ArgumentParser) -> argparse.Namespace:
+    """Turn a job dictionary into the Namespace `main.run_job` expects."""
+    # Parse placeholder values for the required options to get every default
+    defaults = vars(parser.parse_args([arg for name in REQUIRED_OPTIONS for arg in (f"--{name}", "")]))
+    defaults.update(dict.fromkeys(REQUIRED_OPTIONS))
+    unknown = set(job) - set(defaults)
+    if unknown:
+        raise ValueError(f"Unknown job options: {sorted(unknown)}")
+    args = argparse.Namespace(**{**defaults, **job})
+    missing = [name for name in REQUIRED_OPTIONS if getattr(args, name) is None]
+    if missing:
+        raise ValueError(f"Job {job} is missing required options: {missing}")
+    return args
+
+
+def group_jobs_by_model(jobs: List[argparse.Namespace]) -> Dict[tuple, List[argparse.Namespace]]:
+    """Group jobs by backend options, keeping manifest order within and across groups."""
+    groups = {}
+    for job in jobs:
+        key = tuple(getattr(job, name) for name in MODEL_KEYS)
+        groups.setdefault(key, []).append(job)
+    return groups
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several relevance judgment jobs, loading each model once.")
+    parser.add_argument("--manifest", type=str, required=True,
+                        help="JSON or YAML job manifest")
+    args = parser.parse_args()
+
+    setup_logging()
+    job_parser = build_parser()
+    jobs = [make_job_args(job, job_parser) for job in load_manifest(args.manifest)]
+    for job in jobs:
+        validate_job(job)
+
+    groups = group_jobs_by_model(jobs)
+    print(f"Running {len(jobs)} jobs over {len(groups)} model(s)")
+    for group_jobs in groups.values():
+        model = load_model(group_jobs[0])
+        small_model = load_small_model(group_jobs[0])
+        for index, job in enumerate(group_jobs, start=1):
+            print(f"\n=== [{job.model_id}] job {index}/{len(group_jobs)}: "
+                  f"{job.prompt_mode} -> {job.result_file_path} ===")
+            run_job(job, model, small_model)
+        # Release the weights before loading the next model
+        del model, small_model
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+
+
+if __name__ == "__main__":
+    main()
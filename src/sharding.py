@@ -0,0 +1,246 @@
+"""
+Sharded judging runs.
+`main.py --num_shards N --shard_id i` judges only the qrel pairs whose
+(qid, docid) hash falls into shard i, writing to its own result, log and
+error files (`<name>.shard-i-of-N.txt` and the matching logs/ and errors/
+files). The shard of a pair depends only on its ids, so shards can run in
+separate processes or on separate machines and be resumed independently.
+`merge_shards` then rebuilds the outputs a single-process run would have
+written: TREC lines, log records and error lines in qrel order, duplicate
+records dropped, and every pair of the qrel checked to be judged or
+recorded as failed (failed pairs have an error line but no TREC line).
+
+Usage:
+    python src/sharding.py --test_qrel_path ./data/dl2020/2020qrels-pass.txt \\
+        --result_file_path ./results/dl20_test_zeroshot_bing_Llama-3-8B-Instruct.txt --num_shards 4
+"""
+
+import json
+import zlib
+import argparse
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from compact_log import COMPACT_LOG_MAGIC, LOG_SUFFIXES, RECORD_HEADER, decode_record, is_compact_log, scan_compact_log
+from data_processing import atomic_write_text, fsync_file
+
+PairKey = Tuple[str, str]
+
+
+def shard_of(qid, docid, num_shards: int) -> int:
+    """Return the shard of a pair; stable across processes, machines and Python versions."""
+    return zlib.crc32(f"{qid}\t{docid}".encode("utf-8")) % num_shards
+
+
+def select_shard(test_qrel: pd.DataFrame, num_shards: int, shard_id: int) -> pd.DataFrame:
+    """Keep the qrel rows of one shard, in their original order."""
+    if not 0 <= shard_id < num_shards:
+        raise ValueError(f"--shard_id must be in [0, {num_shards}), got {shard_id}")
+    mask = [shard_of(qid, docid, num_shards) == shard_id
+            for qid, docid in zip(test_qrel["qid"], test_qrel["docid"])]
+    return test_qrel[mask]
+
+
+def shard_result_path(result_path: str, num_shards: int, shard_id: int) -> str:
+    """Result path of one shard; its log and error files follow from it as usual."""
+    path = Path(result_path)
+    return str(path.with_name(path.name.replace(".txt", f".shard-{shard_id}-of-{num_shards}.txt")))
+
+
+def output_paths(result_path, log_format: str) -> Dict[str, Path]:
+    """The four output files of a run, laid out as by `RelevanceProcessor`."""
+    path = Path(result_path)
+    return {
+        "results": path,
+        "logs": path.parent / "logs" / path.name.replace(".txt", LOG_SUFFIXES[log_format]),
+        "generation_errors": path.parent / "generation_errors" / path.name,
+        "cuda_errors": path.parent / "cuda_errors" / path.name,
+    }
+
+
+def detect_log_format(shard_paths: List[str]) -> str:
+    """Return the log format the shards were written in."""
+    formats = set()
+    for shard_path in shard_paths:
+        for log_format in LOG_SUFFIXES:
+            log_path = output_paths(shard_path, log_format)["logs"]
+            if log_path.exists():
+                formats.add("compact" if is_compact_log(log_path) else "jsonl")
+    if len(formats) > 1:
+        raise ValueError(f"Shards were written with different log formats: {sorted(formats)}")
+    return formats.pop() if formats else "jsonl"
+
+
+def read_shard_logs(log_path: Path, compact: bool) -> Dict[PairKey, deque]:
+    """Group the raw records of one shard log by pair, in log order."""
+    records: Dict[PairKey, deque] = {}
+    if not log_path.exists():
+        return records
+    if compact:
+        for payload, _ in scan_compact_log(log_path):
+            log = decode_record(payload)
+            records.setdefault((str(log["qidx"]), str(log["docidx"])), deque()).append(payload)
+        return records
+    with open(log_path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                # Torn tail of a killed shard; its pair is reported as incomplete below
+                break
+            try:
+                log = json.loads(line)
+                qidx, docidx = str(log["qidx"]), str(log["docidx"])
+            except (ValueError, KeyError):
+                continue
+            records.setdefault((qidx, docidx), deque()).append(line)
+    return records
+
+
+def error_pair_key(line: str, kind: str) -> Optional[PairKey]:
+    """Pair of one error-file line ("Invalid score: q 0 d s" or "q d: error")."""
+    if kind == "generation_errors":
+        fields = line.split()
+        return (fields[2], fields[4]) if len(fields) >= 5 else None
+    qidx, _, rest = line.partition(" ")
+    docidx = rest.split(": ", 1)[0]
+    return (qidx, docidx) if docidx else None
+
+
+def merge_shards(test_qrel: pd.DataFrame, result_path: str, num_shards: int,
+                 max_pairs: Optional[int] = None, allow_incomplete: bool = False) -> Dict[str, int]:
+    """
+    Merge the outputs of `num_shards` shard runs into those of a single run.
+
+    Args:
+        test_qrel: The full qrel DataFrame the shards were cut from
+        result_path: Result path of the unsharded run (the merge target)
+        num_shards: Number of shards the run was split into
+        max_pairs: The `--max_pairs` the shards were run with
+        allow_incomplete: Write the merge even if pairs are missing
+
+    Returns:
+        Dictionary with the number of pairs merged, failed (recorded in
+        cuda_errors/ without a judgment), missing and duplicated records
+        dropped
+
+    Raises:
+        FileNotFoundError: If a shard has no result file
+        ValueError: If pairs are missing (unless `allow_incomplete`) or a
+            shard holds pairs that belong to another shard
+    """
+    total_pairs = len(test_qrel) if max_pairs is None else min(len(test_qrel), max_pairs)
+    rows = [(str(qid), str(docid)) for qid, docid in
+            zip(test_qrel["qid"].head(total_pairs), test_qrel["docid"].head(total_pairs))]
+    shard_paths = [shard_result_path(result_path, num_shards, i) for i in range(num_shards)]
+    missing_shards = [p for p in shard_paths if not Path(p).exists()]
+    if missing_shards:
+        raise FileNotFoundError(f"Missing shard result files: {missing_shards}")
+    log_format = detect_log_format(shard_paths)
+    compact = log_format == "compact"
+    target = output_paths(result_path, log_format)
+
+    trec_lines: Dict[PairKey, deque] = {}
+    log_records: Dict[PairKey, deque] = {}
+    error_lines: Dict[str, List[Tuple[PairKey, str]]] = {"generation_errors": [], "cuda_errors": []}
+    misplaced = []
+    for shard_id, shard_path in enumerate(shard_paths):
+        paths = output_paths(shard_path, log_format)
+        with open(paths["results"], 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) != 4:
+                    continue
+                pair_key = (fields[0], fields[2])
+                if shard_of(*pair_key, num_shards) != shard_id:
+                    misplaced.append((shard_id, pair_key))
+                trec_lines.setdefault(pair_key, deque()).append(line)
+        for pair_key, records in read_shard_logs(paths["logs"], compact).items():
+            log_records.setdefault(pair_key, deque()).extend(records)
+        for kind in error_lines:
+            if paths[kind].exists():
+                with open(paths[kind], 'r') as f:
+                    error_lines[kind].extend((error_pair_key(line, kind), line) for line in f)
+    if misplaced:
+        raise ValueError(f"{len(misplaced)} pairs are in the wrong shard (e.g. shard {misplaced[0][0]} "
+                         f"has {misplaced[0][1]}); were the shards run with a different --num_shards?")
+
+    # Rebuild every file in qrel order, one TREC line and at most one log record per qrel row
+    failed_pairs = {pair_key for pair_key, _ in error_lines["cuda_errors"]}
+    results, logs, missing, failed = [], [], [], 0
+    for pair_key in rows:
+        lines = trec_lines.get(pair_key)
+        if not lines:
+            if pair_key in failed_pairs:
+                failed += 1
+            else:
+                missing.append(pair_key)
+            continue
+        results.append(lines.popleft())
+        records = log_records.get(pair_key)
+        if records:
+            logs.append(records.popleft())
+    duplicates = sum(len(lines) for lines in trec_lines.values())
+    duplicate_records = sum(len(records) for records in log_records.values())
+    if missing and not allow_incomplete:
+        raise ValueError(f"{len(missing)} of {total_pairs} pairs have no judgment in any shard "
+                         f"(first: {missing[0]}); resume the unfinished shards or pass --allow_incomplete")
+
+    first_row = {}
+    for i, pair_key in enumerate(rows):
+        first_row.setdefault(pair_key, i)
+    for kind, lines in error_lines.items():
+        # Stable sort: lines of one pair keep their order within the shard
+        lines.sort(key=lambda item: first_row.get(item[0], total_pairs))
+        # Resumed shards re-append the error lines of pairs judged before the restart
+        seen, merged = set(), []
+        for _, line in lines:
+            if line not in seen:
+                seen.add(line)
+                merged.append(line)
+        target[kind].parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(target[kind], "".join(merged))
+
+    target["logs"].parent.mkdir(parents=True, exist_ok=True)
+    tmp_log = target["logs"].with_name(target["logs"].name + ".tmp")
+    with open(tmp_log, 'wb') as f:
+        if compact:
+            f.write(COMPACT_LOG_MAGIC)
+            for payload in logs:
+                f.write(RECORD_HEADER.pack(len(payload)) + payload)
+        else:
+            f.writelines(logs)
+    fsync_file(tmp_log)
+    tmp_log.replace(target["logs"])
+    atomic_write_text(target["results"], "".join(results))
+
+    return {"pairs": len(results), "failed": failed, "missing": len(missing),
+            "duplicate_judgments": duplicates, "duplicate_records": duplicate_records}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the outputs of a sharded judging run.")
+    parser.add_argument("--test_qrel_path", type=str, required=True,
+                        help="Qrel file the shards were run on")
+    parser.add_argument("--result_file_path", type=str, required=True,
+                        help="Result path of the unsharded run (as passed to the shards)")
+    parser.add_argument("--num_shards", type=int, required=True)
+    parser.add_argument("--max_pairs", type=int, default=None,
+                        help="The --max_pairs the shards were run with")
+    parser.add_argument("--allow_incomplete", action="store_true",
+                        help="Write the merged files even if some pairs were never judged")
+    args = parser.parse_args()
+
+    test_qrel = pd.read_csv(args.test_qrel_path, sep=" ", header=None,
+                            names=['qid', 'Q0', 'docid', 'rel_score'])
+    counts = merge_shards(test_qrel, args.result_file_path, args.num_shards,
+                          args.max_pairs, args.allow_incomplete)
+    print(f"Merged {args.num_shards} shards into {args.result_file_path}: {counts['pairs']} pairs, "
+          f"{counts['failed']} failed, {counts['missing']} missing, "
+          f"{counts['duplicate_judgments']} duplicate judgments and "
+          f"{counts['duplicate_records']} duplicate log records dropped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Building blocks of the staged grading pipeline.
+`grade_pq_pairs_staged` splits grading into three stages joined by bounded
+queues: a thread pool renders and tokenizes upcoming batches, the main
+thread runs the model, and a post-processing thread parses scores and
+writes the outputs. These helpers measure each stage's busy time and each
+queue's depth, so the report shows which stage is the bottleneck. The
+stages share a stop event; `put_until`/`get_until` give up once it is set,
+so a failure in one stage never leaves another blocked on a full or empty
+queue.
+"""
+
+import time
+import queue
+import threading
+from contextlib import contextmanager
+from typing import List
+
+
+class MonitoredQueue(queue.Queue):
+    """Bounded FIFO queue that samples its depth every time an item is taken."""
+    def __init__(self, name: str, maxsize: int):
+        super().__init__(maxsize)
+        self.name = name
+        self.depth_samples = 0
+        self.depth_total = 0
+        self.depth_max = 0
+
+    def get(self, *args, **kwargs):
+        self.sample_depth()
+        return super().get(*args, **kwargs)
+
+    def sample_depth(self):
+        depth = self.qsize()
+        self.depth_samples += 1
+        self.depth_total += depth
+        self.depth_max = max(self.depth_max, depth)
+
+    def put_until(self, item, stop: threading.Event, poll: float = 0.1) -> bool:
+        """Put `item`, giving up once `stop` is set. Returns whether the item was queued."""
+        while not stop.is_set():
+            try:
+                self.put(item, timeout=poll)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get_until(self, stop: threading.Event, poll: float = 0.1):
+        """Take the next item, or return None once `stop` is set."""
+        self.sample_depth()
+        while not stop.is_set():
+            try:
+                return super().get(timeout=poll)
+            except queue.Empty:
+                pass
+        return None
+
+    def report(self) -> str:
+        average = self.depth_total / self.depth_samples if self.depth_samples else 0.0
+        return f"{self.name} queue: avg depth {average:.1f}, max {self.depth_max} of {self.maxsize}"
+
+
+class StageTimer:
+    """Accumulates the busy time of one stage, which may run on several threads."""
+    def __init__(self, name: str, workers: int = 1):
+        self.name = name
+        self.workers = workers
+        self.busy = 0.0
+        self.items = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, items: int = 1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.busy += elapsed
+                self.items += items
+
+    def report(self, wall_time: float) -> str:
+        utilisation = self.busy / (wall_time * self.workers) if wall_time else 0.0
+        return (f"{self.name} stage: {self.items} pairs, {self.busy:.1f}s busy "
+                f"over {self.workers} thread(s), {utilisation:.0%} utilised")
+
+
+def report_stages(stages: List[StageTimer], queues: List[MonitoredQueue], wall_time: float):
+    """Print per-stage utilisation and queue depths of a staged run."""
+    print(f"Staged pipeline: {wall_time:.1f}s wall time")
+    for stage in stages:
+        print("  " + stage.report(wall_time))
+    for stage_queue in queues:
+        print("  " + stage_queue.report())
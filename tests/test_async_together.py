@@ -0,0 +1,68 @@
+"""
+`AsyncTogetherPipeline` against the stub chat completions server.
+"""
+
+import json
+import time
+
+import pytest
+
+pytest.importorskip("together")
+pytest.importorskip("tqdm")
+
+from data_processing import load_data_files
+from model_utils import AsyncTogetherPipeline
+from relevance_processors import grade_pq_pairs
+from stub_pipelines import StubOpenAIServer
+from synthetic_data import generate_dataset
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    paths = generate_dataset(str(tmp_path / "data"), num_queries=3, docs_per_query=8, mean_words=20)
+    return load_data_files(paths["docs_path"], paths["queries_path"], paths["test_qrel_path"])
+
+
+@pytest.fixture(autouse=True)
+def api_key(monkeypatch):
+    monkeypatch.setenv("TOGETHER_API_KEY", "stub-key")
+
+
+def judge(dataset, tmp_path, server, **pipeline_kwargs):
+    docid_to_doc, qid_to_query, test_qrel = dataset
+    pipeline = AsyncTogetherPipeline("stub/model", base_url=server.base_url, **pipeline_kwargs)
+    result_path = tmp_path / "out" / "run.txt"
+    grade_pq_pairs(test_qrel, docid_to_doc, qid_to_query, str(result_path), pipeline, "", "zeroshot_bing")
+    return pipeline, result_path
+
+
+def test_in_flight_requests_are_bounded(dataset, tmp_path):
+    with StubOpenAIServer(latency_ms=30) as server:
+        pipeline, _ = judge(dataset, tmp_path, server, max_in_flight=3)
+    assert server.requests == len(dataset[2])
+    assert server.max_active == 3
+    assert pipeline.async_client is None
+
+
+def test_rate_limited_requests_wait_for_retry_after(dataset, tmp_path):
+    with StubOpenAIServer(fail_first=2, fail_status=429, retry_after="0.5") as server:
+        start = time.perf_counter()
+        pipeline, result_path = judge(dataset, tmp_path, server, max_in_flight=2, retry_backoff=0.0)
+        elapsed = time.perf_counter() - start
+    assert pipeline.retry_count == 2
+    assert elapsed >= 0.5
+    assert len(result_path.read_text().splitlines()) == len(dataset[2])
+    assert (tmp_path / "out" / "cuda_errors" / "run.txt").read_text() == ""
+
+
+def test_output_keeps_qrel_order(dataset, tmp_path):
+    test_qrel = dataset[2]
+    expected = [(str(row.qid), str(row.docid)) for row in test_qrel.itertuples()]
+    # Jittered latency makes requests finish out of order
+    with StubOpenAIServer(latency_ms=20, jitter=0.9, seed=1) as server:
+        judge(dataset, tmp_path, server, max_in_flight=6)
+    trec_pairs = [tuple(line.split()[0::2]) for line in (tmp_path / "out" / "run.txt").read_text().splitlines()]
+    with open(tmp_path / "out" / "logs" / "run.jsonl") as f:
+        log_pairs = [(str(log["qidx"]), str(log["docidx"])) for log in map(json.loads, f)]
+    assert trec_pairs == expected
+    assert log_pairs == expected
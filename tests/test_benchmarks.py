@@ -0,0 +1,45 @@
+"""
+The offline benchmark cases (see benchmarks/run_benchmarks.py) as tests.
+
+Each case runs once on a small synthetic dataset with zero-latency stubs
+and must reach a throughput floor. The floors are an order of magnitude
+below what the cases reach on a laptop, so they only catch gross
+regressions (an accidental quadratic loop, a per-item file reopen);
+finer comparisons go through `run_benchmarks.py --baseline --check`.
+"""
+
+import pytest
+
+pytest.importorskip("tqdm")
+
+from run_benchmarks import CASES, build_parser, run_case
+from synthetic_data import generate_dataset
+
+# Minimum items/s per case
+MIN_ITEMS_PER_S = {
+    "load_data_files[lazy]": 1_000,
+    "load_data_files[eager]": 1_000,
+    "get_umbrella_prompt": 20_000,
+    "find_first_number": 5_000,
+    "grade_pq_pairs[together_stub]": 500,
+    "grade_pq_pairs[hf_stub]": 500,
+    "process_log_to_rubric": 300,
+}
+
+
+@pytest.fixture(scope="module")
+def paths(tmp_path_factory):
+    return generate_dataset(str(tmp_path_factory.mktemp("data")), num_queries=10, docs_per_query=20)
+
+
+def test_every_case_has_a_floor():
+    assert set(MIN_ITEMS_PER_S) == set(CASES)
+
+
+@pytest.mark.parametrize("name", list(CASES))
+def test_case_throughput(name, paths):
+    args = build_parser().parse_args(["--rounds", "1", "--parse_outputs", "1000"])
+    result = run_case(name, paths, args)
+    assert result["items"] > 0
+    assert 0 < result["p50_ms"] <= result["p99_ms"]
+    assert result["items_per_s"] >= MIN_ITEMS_PER_S[name], result
@@ -0,0 +1,47 @@
+"""
+`convert_rubrics.py` on a dataset and model outside its built-in tables.
+"""
+
+import gzip
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("tqdm")
+
+from convert_rubrics import DATASETS, resolve_dataset
+from data_processing import load_data_files
+from make_rubric_format import process_log_to_rubric
+from relevance_processors import grade_pq_pairs
+from stub_pipelines import StubTogetherPipeline
+from synthetic_data import generate_dataset
+
+SRC = Path(__file__).parent.parent / "src"
+
+
+def test_unknown_dataset_needs_a_qrel_file():
+    with pytest.raises(ValueError, match="--test_qrel_path"):
+        resolve_dataset("robust04", {"qrel_path": None})
+    assert resolve_dataset("robust04", {"qrel_path": "qrels.txt"}) == {"is_dl23": False, "qrel_path": "qrels.txt"}
+    assert resolve_dataset("dl19", {"qrel_path": None}) == DATASETS["dl19"]
+
+
+def test_custom_dataset_and_model_alias(tmp_path):
+    paths = generate_dataset(str(tmp_path / "data"), num_queries=2, docs_per_query=4, mean_words=20)
+    docid_to_doc, qid_to_query, test_qrel = load_data_files(
+        paths["docs_path"], paths["queries_path"], paths["test_qrel_path"])
+    results = tmp_path / "results"
+    grade_pq_pairs(test_qrel, docid_to_doc, qid_to_query, str(results / "synth_test_zeroshot_bing_Stub-1B.txt"),
+                   StubTogetherPipeline(), "", "zeroshot_bing")
+    log_file = results / "logs" / "synth_test_zeroshot_bing_Stub-1B.jsonl"
+
+    subprocess.run([sys.executable, str(SRC / "convert_rubrics.py"), "--logs", str(log_file), "--workers", "1",
+                    "--test_qrel_path", paths["test_qrel_path"], "--model_alias", "Stub-1B=stub/Stub-1B"],
+                   check=True, capture_output=True)
+    expected = tmp_path / "expected.jsonl.gz"
+    process_log_to_rubric(str(log_file), str(expected), paths["test_qrel_path"], model_name="stub/Stub-1B")
+    converted = results / "rubric_format" / "synth_test_zeroshot_bing_Stub-1B_rubric.jsonl.gz"
+    assert gzip.decompress(converted.read_bytes()) == gzip.decompress(expected.read_bytes())
+    assert len(gzip.decompress(converted.read_bytes()).splitlines()) == len(test_qrel)
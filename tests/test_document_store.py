@@ -0,0 +1,45 @@
+"""
+`DocumentStore` offset index: docid reading and the on-disk `.idx` format.
+"""
+
+import json
+
+import pytest
+
+pytest.importorskip("tqdm")
+
+from data_processing import DocumentStore, read_docid
+
+DOCUMENTS = [
+    {"docid": "plain", "doc": "first document"},
+    {"docid": 7919, "doc": "numeric docid"},
+    {"docid": "7919", "doc": "string docid that looks numeric"},
+    {"docid": "with\ttab", "doc": "tab in the docid"},
+    {"docid": "with\nnewline", "doc": "newline in the docid"},
+    {"docid": "x" * 400, "doc": "docid longer than the peeked prefix"},
+    {"doc": "docid after the text", "docid": "late"},
+    {"docid": "café ☃", "doc": "non-ascii docid"},
+]
+
+
+@pytest.mark.parametrize("document", DOCUMENTS)
+def test_read_docid_matches_full_parse(document):
+    for line in (json.dumps(document), json.dumps(document, ensure_ascii=False),
+                 json.dumps(document, separators=(",", ":"))):
+        assert read_docid(line.encode("utf-8") + b"\n") == document["docid"]
+
+
+def test_index_round_trips_every_docid(tmp_path):
+    docs_path = tmp_path / "docs.jsonl"
+    docs_path.write_text("".join(json.dumps(document) + "\n" for document in DOCUMENTS))
+    expected = {document["docid"]: document["doc"] for document in DOCUMENTS}
+
+    built = DocumentStore(str(docs_path))
+    assert dict(built.items()) == expected
+    built.close()
+    # One index line per docid, whatever characters the docids contain
+    assert len(docs_path.with_name("docs.jsonl.idx").read_text().splitlines()) == len(DOCUMENTS) + 1
+
+    loaded = DocumentStore(str(docs_path))
+    assert dict(loaded.items()) == expected
+    loaded.close()
@@ -0,0 +1,64 @@
+"""
+Pairs that fail permanently: recorded in cuda_errors/, left out of the TREC
+results, and counted as failed (not missing) when shards are merged.
+"""
+
+import pytest
+
+pytest.importorskip("tqdm")
+
+from data_processing import load_data_files
+from relevance_processors import grade_pq_pairs
+from sharding import merge_shards, select_shard, shard_result_path
+from stub_pipelines import StubTogetherPipeline
+from synthetic_data import generate_dataset
+
+
+class FailingPipeline(StubTogetherPipeline):
+    """Stub that fails permanently on every prompt containing one passage."""
+    def __init__(self, bad_passage: str):
+        super().__init__()
+        self.bad_passage = bad_passage
+
+    def __call__(self, messages, max_new_tokens=100, **kwargs):
+        if self.bad_passage in messages[-1]["content"]:
+            raise ValueError("bad pair")
+        return super().__call__(messages, max_new_tokens, **kwargs)
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    paths = generate_dataset(str(tmp_path / "data"), num_queries=2, docs_per_query=6, mean_words=20)
+    return load_data_files(paths["docs_path"], paths["queries_path"], paths["test_qrel_path"])
+
+
+def bad_pair(dataset):
+    docid_to_doc, _, test_qrel = dataset
+    row = test_qrel.iloc[3]
+    return str(row.qid), str(row.docid), docid_to_doc[str(row.docid)]
+
+
+@pytest.mark.parametrize("batch_size", [1, 4])
+def test_failed_pair_has_no_trec_line(dataset, tmp_path, batch_size):
+    docid_to_doc, qid_to_query, test_qrel = dataset
+    qid, docid, passage = bad_pair(dataset)
+    grade_pq_pairs(test_qrel, docid_to_doc, qid_to_query, str(tmp_path / "out" / "run.txt"),
+                   FailingPipeline(passage), "", "zeroshot_bing", batch_size=batch_size, max_retries=0)
+    trec_pairs = [tuple(line.split()[0::2]) for line in (tmp_path / "out" / "run.txt").read_text().splitlines()]
+    assert len(trec_pairs) == len(test_qrel) - 1
+    assert (qid, docid) not in trec_pairs
+    assert (tmp_path / "out" / "cuda_errors" / "run.txt").read_text() == f"{qid} {docid}: bad pair\n"
+
+
+def test_merge_counts_failed_pairs_apart_from_missing_ones(dataset, tmp_path):
+    docid_to_doc, qid_to_query, test_qrel = dataset
+    _, _, passage = bad_pair(dataset)
+    result_path = str(tmp_path / "out" / "run.txt")
+    for shard_id in range(2):
+        grade_pq_pairs(select_shard(test_qrel, 2, shard_id), docid_to_doc, qid_to_query,
+                       shard_result_path(result_path, 2, shard_id), FailingPipeline(passage), "",
+                       "zeroshot_bing", max_retries=0)
+    counts = merge_shards(test_qrel, result_path, 2)
+    assert counts["pairs"] == len(test_qrel) - 1
+    assert counts["failed"] == 1
+    assert counts["missing"] == 0
@@ -0,0 +1,136 @@
+"""
+Out-of-memory handling of `FailureHandler` with a fake judge whose memory
+runs out above a prompt-length budget.
+"""
+
+from failure_handling import FailureHandler, TokenBudgetExceeded
+
+
+class OutOfMemoryError(RuntimeError):
+    pass
+
+
+class FakeJudge:
+    """Judges items (prompt lengths in tokens) while the batch's padded size fits in `memory`."""
+    def __init__(self, memory: int):
+        self.memory = memory
+        self.calls = []
+
+    def __call__(self, group):
+        self.calls.append(list(group))
+        if len(group) * max(group) > self.memory:
+            raise OutOfMemoryError("CUDA out of memory")
+        return [(length % 4, {"final_relevance_score": length % 4}) for length in group]
+
+
+def test_oom_batch_is_halved_and_capped():
+    handler = FailureHandler()
+    judge = FakeJudge(memory=300)
+    outcomes = handler.run([100] * 4, judge, item_tokens=lambda length: length)
+    assert all(not isinstance(outcome, Exception) for outcome in outcomes)
+    assert handler.batch_cap == 2
+    assert handler.downsized == 4
+    assert handler.token_budget is None
+
+
+def test_single_pair_oom_sets_token_budget_and_is_recorded():
+    handler = FailureHandler()
+    judge = FakeJudge(memory=400)
+    outcomes = handler.run([50, 500, 60], judge, item_tokens=lambda length: length)
+    assert isinstance(outcomes[1], OutOfMemoryError)
+    assert [outcome[0] for outcome in (outcomes[0], outcomes[2])] == [50 % 4, 60 % 4]
+    assert handler.token_budget == 499
+    assert handler.gave_up == 1
+
+    # Later pairs over the budget fail without reaching the model
+    judge.calls.clear()
+    outcomes = handler.run([600, 70], judge, item_tokens=lambda length: length)
+    assert isinstance(outcomes[0], TokenBudgetExceeded)
+    assert outcomes[1][0] == 70 % 4
+    assert judge.calls == [[70]]
+    assert handler.over_budget == 1
+
+
+def test_without_item_tokens_no_budget_is_set():
+    handler = FailureHandler()
+    outcomes = handler.run([500], FakeJudge(memory=400))
+    assert isinstance(outcomes[0], OutOfMemoryError)
+    assert handler.token_budget is None
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class ScriptedJudge:
+    """Raises the next scripted error for a call (None: judge normally); permanently fails `bad` items."""
+    def __init__(self, errors=(), bad=()):
+        self.errors = list(errors)
+        self.bad = set(bad)
+        self.calls = []
+
+    def __call__(self, group):
+        self.calls.append(list(group))
+        error = self.errors.pop(0) if self.errors else None
+        if error is not None:
+            raise error
+        if self.bad.intersection(group):
+            raise ValueError(f"bad items {sorted(self.bad.intersection(group))}")
+        return [(item, {"item": item}) for item in group]
+
+
+def test_transient_error_is_retried_after_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr("failure_handling.time.sleep", sleeps.append)
+    monkeypatch.setattr("failure_handling.backoff_delay", lambda attempt, base, cap: 10.0 * (attempt + 1))
+    handler = FailureHandler(max_retries=3)
+    judge = ScriptedJudge(errors=[RateLimitError("slow down"), RateLimitError("slow down")])
+    outcomes = handler.run([1, 2], judge)
+    assert outcomes == [(1, {"item": 1}), (2, {"item": 2})]
+    assert judge.calls == [[1, 2]] * 3
+    # Each retry waits out its growing backoff
+    assert len(sleeps) == 2 and 9 < sleeps[0] <= 10 and 19 < sleeps[1] <= 20
+    assert (handler.retried, handler.recovered, handler.gave_up) == (2, 2, 0)
+
+
+def test_transient_error_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr("failure_handling.time.sleep", lambda seconds: None)
+    handler = FailureHandler(max_retries=2, backoff_base=0.0)
+    judge = ScriptedJudge(errors=[RateLimitError("slow down")] * 10)
+    outcomes = handler.run([1], judge)
+    assert isinstance(outcomes[0], RateLimitError)
+    assert len(judge.calls) == 3
+    assert (handler.retried, handler.recovered, handler.gave_up) == (1, 0, 1)
+
+
+def test_permanent_failure_is_bisected_down_to_the_failing_item():
+    handler = FailureHandler()
+    judge = ScriptedJudge(bad={6})
+    outcomes = handler.run(list(range(8)), judge)
+    assert isinstance(outcomes[6], ValueError)
+    assert [outcome for i, outcome in enumerate(outcomes) if i != 6] == [(i, {"item": i}) for i in range(8) if i != 6]
+    # 8 -> 4 + 4 -> 2 + 2 -> 1 + 1: the failing item is found in log2(8) splits
+    assert [6] in judge.calls
+    assert len(judge.calls) == 7
+    assert handler.gave_up == 1
+    assert handler.batch_cap is None
+
+
+def test_report_counts(capsys, monkeypatch):
+    monkeypatch.setattr("failure_handling.time.sleep", lambda seconds: None)
+    handler = FailureHandler(max_retries=1, backoff_base=0.0)
+    handler.run([1, 2], ScriptedJudge(errors=[RateLimitError("slow down")]))
+    handler.run([100] * 4, FakeJudge(memory=300))
+    handler.run([1, 2], ScriptedJudge(bad={2}))
+    handler.report()
+    assert capsys.readouterr().out == (
+        "Failure handling: 2 pairs retried after transient errors (2 recovered), 4 pairs re-run in "
+        "smaller batches after running out of memory, batch size capped at 2, 0 pairs over the per-pair "
+        "token budget, 1 pairs given up on\n")
+
+
+def test_report_is_silent_without_failures(capsys):
+    handler = FailureHandler()
+    handler.run([1, 2], ScriptedJudge())
+    handler.report()
+    assert capsys.readouterr().out == ""
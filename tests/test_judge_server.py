@@ -0,0 +1,79 @@
+"""
+`MicroBatcher` and request handling of the judging service with the stub
+Together backend.
+"""
+
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from judge_server import JudgeRequest, MicroBatcher, make_server
+from failure_handling import FailureHandler
+from stub_pipelines import StubTogetherPipeline
+
+
+class FlakyPipeline(StubTogetherPipeline):
+    """Fails every request for a passage containing "boom"; rate limits the first `rate_limited` calls."""
+    def __init__(self, rate_limited: int = 0):
+        super().__init__()
+        self.rate_limited = rate_limited
+
+    def __call__(self, messages, max_new_tokens=100, **kwargs):
+        if self.rate_limited:
+            self.rate_limited -= 1
+            error = RuntimeError("rate limited")
+            error.status_code = 429
+            raise error
+        if "boom" in messages[-1]["content"]:
+            raise ValueError("bad pair")
+        return super().__call__(messages, max_new_tokens, **kwargs)
+
+
+def judge_all(batcher, passages):
+    requests = [JudgeRequest("what is a stub", passage, "zeroshot_bing", qid="1", docid=str(i))
+                for i, passage in enumerate(passages)]
+    for request in requests:
+        request.started = request.enqueued
+    batcher.judge(requests)
+    assert all(request.done.is_set() for request in requests)
+    return requests
+
+
+def test_failing_request_does_not_fail_its_batch():
+    batcher = MicroBatcher(FlakyPipeline(), api_workers=4)
+    requests = judge_all(batcher, ["a stub passage", "boom", "another passage", "more text"])
+    assert isinstance(requests[1].error, ValueError)
+    for request in requests[:1] + requests[2:]:
+        assert request.error is None
+        final_score, scoring_log = request.result
+        assert scoring_log["docidx"] == request.docid
+    assert batcher.stats.errors == 1
+
+
+def test_transient_errors_are_retried():
+    handler = FailureHandler(max_retries=3, backoff_base=0.0)
+    batcher = MicroBatcher(FlakyPipeline(rate_limited=2), api_workers=1, failure_handler=handler)
+    requests = judge_all(batcher, ["a stub passage", "another passage"])
+    assert all(request.error is None for request in requests)
+    assert handler.retried > 0
+    assert handler.recovered == handler.retried
+
+
+@pytest.mark.parametrize("body", [b"[1]", b'"x"', b"3", b"null", b"not json", b'{"query": "q"}'])
+def test_malformed_body_is_answered_400(body):
+    server = make_server(MicroBatcher(StubTogetherPipeline()), "stub", "zeroshot_bing", port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        request = urllib.request.Request(f"http://127.0.0.1:{server.server_address[1]}/judge", data=body,
+                                         headers={"Content-Type": "application/json"})
+        with pytest.raises(urllib.error.HTTPError) as excinfo:
+            urllib.request.urlopen(request, timeout=10)
+        assert excinfo.value.code == 400
+        assert json.load(excinfo.value)["error"].startswith("Bad request")
+    finally:
+        server.shutdown()
+        server.server_close()
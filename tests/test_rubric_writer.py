@@ -0,0 +1,57 @@
+"""
+Online rubric output of `grade_pq_pairs` through `RubricWriter`.
+"""
+
+import gzip
+import json
+
+import pytest
+
+pytest.importorskip("tqdm")
+
+from data_processing import load_data_files
+from make_rubric_format import RubricWriter
+from relevance_processors import grade_pq_pairs
+from stub_pipelines import StubTogetherPipeline
+from synthetic_data import generate_dataset
+
+
+class InterruptedPipeline(StubTogetherPipeline):
+    """Stub that is interrupted (as by Ctrl-C) on its `interrupt_at`-th call."""
+    def __init__(self, interrupt_at: int):
+        super().__init__()
+        self.calls = 0
+        self.interrupt_at = interrupt_at
+
+    def __call__(self, messages, max_new_tokens=100, **kwargs):
+        self.calls += 1
+        if self.calls == self.interrupt_at:
+            raise KeyboardInterrupt
+        return super().__call__(messages, max_new_tokens, **kwargs)
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    paths = generate_dataset(str(tmp_path / "data"), num_queries=2, docs_per_query=5, mean_words=20)
+    return load_data_files(paths["docs_path"], paths["queries_path"], paths["test_qrel_path"])
+
+
+def run(dataset, tmp_path, pipeline):
+    docid_to_doc, qid_to_query, test_qrel = dataset
+    rubric_file = tmp_path / "out" / "rubric_format" / "run_rubric.jsonl.gz"
+    writer = RubricWriter(rubric_file, test_qrel, "stub/model")
+    grade_pq_pairs(test_qrel, docid_to_doc, qid_to_query, str(tmp_path / "out" / "run.txt"),
+                   pipeline, "", "zeroshot_bing", rubric_writer=writer)
+    return rubric_file
+
+
+def test_completed_run_writes_every_pair(dataset, tmp_path):
+    rubric_file = run(dataset, tmp_path, StubTogetherPipeline())
+    with gzip.open(rubric_file, "rt") as f:
+        assert len([json.loads(line) for line in f]) == len(dataset[2])
+
+
+def test_interrupted_run_leaves_no_rubric_file(dataset, tmp_path):
+    with pytest.raises(KeyboardInterrupt):
+        run(dataset, tmp_path, InterruptedPipeline(interrupt_at=4))
+    assert list((tmp_path / "out" / "rubric_format").iterdir()) == []
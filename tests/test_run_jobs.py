@@ -0,0 +1,41 @@
+"""
+Manifest jobs of the multi-job runner.
+"""
+
+import pytest
+
+from main import build_parser
+from run_jobs import group_jobs_by_model, make_job_args
+
+JOB = {
+    "model_id": "meta-llama/Meta-Llama-3-8B-Instruct",
+    "test_qrel_path": "./data/dl2019/2019qrels-pass.txt",
+    "queries_path": "./data/dl2019/msmarco-test2019-queries.tsv",
+    "docs_path": "./data/dl2019/dl2019_document.jsonl",
+    "result_file_path": "./results/dl19.txt",
+}
+
+
+def test_job_gets_the_command_line_defaults():
+    args = make_job_args({**JOB, "batch_size": 8}, build_parser())
+    command_line = build_parser().parse_args([arg for name, value in JOB.items() for arg in (f"--{name}", value)])
+    assert vars(args) == {**vars(command_line), "batch_size": 8}
+
+
+def test_job_missing_a_required_option_is_rejected():
+    job = dict(JOB)
+    del job["result_file_path"]
+    with pytest.raises(ValueError, match="result_file_path"):
+        make_job_args(job, build_parser())
+
+
+def test_unknown_job_option_is_rejected():
+    with pytest.raises(ValueError, match="promt_mode"):
+        make_job_args({**JOB, "promt_mode": "zeroshot_bing"}, build_parser())
+
+
+def test_jobs_are_grouped_by_backend():
+    parser = build_parser()
+    jobs = [make_job_args({**JOB, "prompt_mode": mode}, parser) for mode in ("zeroshot_bing", "fewshot_bing")]
+    jobs.append(make_job_args({**JOB, "together": True}, parser))
+    assert [len(group) for group in group_jobs_by_model(jobs).values()] == [2, 1]
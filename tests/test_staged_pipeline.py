@@ -0,0 +1,77 @@
+"""
+Shutdown of the staged pipeline: a failure in one stage must stop the
+others instead of leaving them blocked on a bounded queue.
+"""
+
+import threading
+
+import pytest
+
+pytest.importorskip("tqdm")
+
+import relevance_processors
+from data_processing import load_data_files
+from relevance_processors import grade_pq_pairs_staged
+from staged_pipeline import MonitoredQueue
+from stub_pipelines import StubHFPipeline
+from synthetic_data import generate_dataset
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    paths = generate_dataset(str(tmp_path / "data"), num_queries=4, docs_per_query=50, mean_words=10)
+    return load_data_files(paths["docs_path"], paths["queries_path"], paths["test_qrel_path"])
+
+
+def run_staged(dataset, tmp_path, pipeline):
+    """Run the staged pipeline on a thread, so a hang fails the test instead of the suite."""
+    docid_to_doc, qid_to_query, test_qrel = dataset
+    outcome = {}
+
+    def target():
+        try:
+            grade_pq_pairs_staged(test_qrel, docid_to_doc, qid_to_query, str(tmp_path / "out" / "run.txt"),
+                                  pipeline, "", "zeroshot_bing", batch_size=1, prepare_workers=2,
+                                  prefetch_batches=2)
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive(), "staged pipeline did not shut down"
+    return outcome.get("error")
+
+
+def test_queue_waits_give_up_once_stopped():
+    stop = threading.Event()
+    full = MonitoredQueue("full", 1)
+    assert full.put_until("first", stop)
+    stop.set()
+    assert not full.put_until("second", stop)
+    assert MonitoredQueue("empty", 1).get_until(stop) is None
+
+
+def test_prepare_failure_stops_every_stage(dataset, tmp_path):
+    # The stub tokenizer is not callable, so tokenizing the first batch raises
+    error = run_staged(dataset, tmp_path, StubHFPipeline())
+    assert isinstance(error, TypeError)
+
+
+def test_postprocess_failure_stops_inference(dataset, tmp_path, monkeypatch):
+    _, _, test_qrel = dataset
+    looked_up = []
+
+    def missing_pair(eachline, docid_to_doc, qid_to_query):
+        looked_up.append(eachline)
+        raise KeyError(eachline.docid)
+
+    def broken_write_failure(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(relevance_processors, "lookup_pair", missing_pair)
+    monkeypatch.setattr(relevance_processors, "write_failure", broken_write_failure)
+    error = run_staged(dataset, tmp_path, StubHFPipeline())
+    assert isinstance(error, OSError)
+    # Only the few batches already in flight were prepared, not the whole qrel
+    assert len(looked_up) < len(test_qrel) / 2
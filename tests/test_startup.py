@@ -0,0 +1,46 @@
+"""
+Startup imports of the command-line entry points, measured with
+`python -X importtime` (see benchmarks/bench_startup.py).
+"""
+
+import pytest
+
+from bench_startup import ENTRY_POINTS, measure_import, parse_importtime, run_importtime
+from stub_pipelines import StubOpenAIServer
+from synthetic_data import generate_dataset
+
+
+@pytest.mark.parametrize("module", sorted(set(ENTRY_POINTS.values())))
+def test_entry_point_imports_no_heavy_library(module):
+    _, heavy = measure_import(module)
+    assert heavy == []
+
+
+@pytest.mark.parametrize("script", ["main.py", "run_jobs.py", "convert_rubrics.py", "judge_server.py"])
+def test_help_imports_no_heavy_library(script):
+    _, heavy = parse_importtime(run_importtime([script, "--help"]))
+    assert heavy == []
+
+
+def api_run_command(tmp_path):
+    paths = generate_dataset(str(tmp_path / "data"), num_queries=2, docs_per_query=4, mean_words=20)
+    return ["main.py", "--model_id", "stub/model", "--prompt_mode", "zeroshot_bing", "--no_cache", "--rubric", "off",
+            "--result_file_path", str(tmp_path / "results" / "run.txt"),
+            *[arg for key, path in paths.items() for arg in (f"--{key}", path)]]
+
+
+def test_openai_compatible_run_imports_no_heavy_library(tmp_path):
+    pytest.importorskip("requests")
+    with StubOpenAIServer() as server:
+        stderr = run_importtime([*api_run_command(tmp_path), "--openai_base_url", server.base_url])
+    assert parse_importtime(stderr)[1] == []
+    assert len((tmp_path / "results" / "run.txt").read_text().splitlines()) == 8
+
+
+def test_together_run_imports_neither_torch_nor_transformers(tmp_path):
+    pytest.importorskip("together")
+    with StubOpenAIServer() as server:
+        stderr = run_importtime([*api_run_command(tmp_path), "-together", "--concurrency", "4"],
+                                env={"TOGETHER_API_KEY": "stub-key", "TOGETHER_BASE_URL": server.base_url})
+    assert parse_importtime(stderr)[1] == ["together"]
+    assert len((tmp_path / "results" / "run.txt").read_text().splitlines()) == 8